@@ -1,12 +1,16 @@
 # Copyright (C) 2015 Sebastian Pipping <sebastian@pipping.org>
 # Licensed under AGPL v3 or later
 
+import os
+
 import directory_bootstrap.shared.loaders._argparse as argparse
 from directory_bootstrap.distros.arch import ArchBootstrapper
 from directory_bootstrap.distros.base import (
         BOOTSTRAPPER_CLASS_FIELD, add_general_directory_bootstrapping_options)
 from directory_bootstrap.distros.fedora import FedoraBootstrapper
 from directory_bootstrap.distros.gentoo import GentooBootstrapper
+from directory_bootstrap.shared.artifact_store import ArtifactStore
+from directory_bootstrap.shared.cache_proxy import route_through_http_proxy
 from directory_bootstrap.shared.executor import Executor
 from directory_bootstrap.shared.messenger import VERBOSITY_VERBOSE, Messenger
 from directory_bootstrap.shared.metadata import VERSION_STR
@@ -14,7 +18,55 @@ from directory_bootstrap.shared.output_control import (
         add_output_control_options, is_color_wanted, run_handle_errors)
 
 
+_CACHE_COMMAND_FIELD = 'cache_command'
+_PREFETCH_FIELD = 'prefetch'
+
+_BOOTSTRAPPER_CLASSES = (
+        ArchBootstrapper,
+        FedoraBootstrapper,
+        GentooBootstrapper,
+        )
+
+
+def _collect_cache_garbage(messenger, options):
+    abs_cache_dir = os.path.abspath(options.cache_dir)
+    messenger.info('Cleaning up cache directory "%s"...' % abs_cache_dir)
+    store = ArtifactStore(abs_cache_dir)
+    store.collect_garbage(messenger, options.cache_max_size, options.cache_keep_last)
+
+
+def _add_cache_parser_to(distros):
+    cache = distros.add_parser('cache', help='cache directory maintenance')
+    cache_commands = cache.add_subparsers(title='subcommands',
+            metavar='COMMAND', help='choice of maintenance task, pick from:')
+
+    gc = cache_commands.add_parser('gc',
+            help='evict files from the cache directory, '
+                'according to --cache-max-size and --cache-keep-last')
+    gc.set_defaults(**{_CACHE_COMMAND_FIELD: _collect_cache_garbage})
+
+
+def _add_prefetch_parser_to(distros):
+    prefetch = distros.add_parser('prefetch',
+            help='download and verify files into the cache directory only '
+                '(e.g. from cron, to speed up later runs)')
+    prefetch.set_defaults(**{_PREFETCH_FIELD: True})
+    prefetch_distros = prefetch.add_subparsers(title='subcommands (choice of distribution)',
+            metavar='DISTRIBUTION', help='choice of distribution, pick from:')
+
+    for strategy_clazz in _BOOTSTRAPPER_CLASSES:
+        strategy_clazz.add_parser_to(prefetch_distros, with_target_dir=False)
+
+
 def _main__level_three(messenger, options):
+    cache_command = getattr(options, _CACHE_COMMAND_FIELD, None)
+    if cache_command is not None:
+        cache_command(messenger, options)
+        return
+
+    if options.http_proxy:
+        route_through_http_proxy(messenger, options.http_proxy)
+
     stdout_wanted = options.verbosity is VERBOSITY_VERBOSE
 
     if stdout_wanted:
@@ -29,9 +81,16 @@ def _main__level_three(messenger, options):
     bootstrap = bootstrapper_class.create(messenger, executor, options)
 
     bootstrap.check_for_commands()
-    if bootstrap.wants_to_be_unshared():
-        bootstrap.unshare()
-    bootstrap.run()
+    if getattr(options, _PREFETCH_FIELD, False):
+        bootstrap.prefetch()
+    else:
+        if bootstrap.wants_to_be_unshared():
+            bootstrap.unshare()
+        bootstrap.run()
+    bootstrap.write_lock_file()
+    bootstrap.summarize_downloads()
+    bootstrap.collect_cache_garbage()
+    bootstrap.release_cached_files()
 
 
     if not stdout_wanted:
@@ -54,18 +113,14 @@ def _main__level_two():
     distros = parser.add_subparsers(title='subcommands (choice of distribution)',
             description='Run "%(prog)s DISTRIBUTION --help" for details '
                     'on options specific to that distribution.',
-            metavar='DISTRIBUTION', help='choice of distribution, pick from:')
+            metavar='DISTRIBUTION', help='choice of distribution (or prefetching or cache maintenance), pick from:')
 
 
-    for strategy_clazz in (
-            ArchBootstrapper,
-            FedoraBootstrapper,
-            GentooBootstrapper,
-            ):
+    for strategy_clazz in _BOOTSTRAPPER_CLASSES:
         strategy_clazz.add_parser_to(distros)
 
-
-    parser.add_argument('target_dir', metavar='DIRECTORY')
+    _add_prefetch_parser_to(distros)
+    _add_cache_parser_to(distros)
 
     options = parser.parse_args()
 
@@ -4,24 +4,68 @@
 from __future__ import print_function
 
 import datetime
+import errno
 import os
 import re
 import shutil
 import tempfile
-from tarfile import TarFile
+from textwrap import dedent
 
 from directory_bootstrap.distros.base import (
-        DirectoryBootstrapper, date_argparse_type)
+        DirectoryBootstrapper, DownloadConfig, date_argparse_type,
+        get_abs_target_dir)
 from directory_bootstrap.shared.commands import (
-        COMMAND_CHROOT, COMMAND_GPG, COMMAND_MOUNT, COMMAND_UMOUNT,
-        COMMAND_UNSHARE)
+        COMMAND_CHROOT, COMMAND_GPG, COMMAND_MOUNT, COMMAND_PACMAN_KEY,
+        COMMAND_PACSTRAP, COMMAND_TAR, COMMAND_UMOUNT, COMMAND_UNSHARE,
+        EXIT_COMMAND_NOT_FOUND, find_command)
+from directory_bootstrap.shared.decompression import extract_compressed_tarball
 from directory_bootstrap.shared.mount import try_unmounting
+from directory_bootstrap.shared.pacman_cache import PacmanCache
 from directory_bootstrap.shared.resolv_conf import filter_copy_resolv_conf
 
 SUPPORTED_ARCHITECTURES = ('i686', 'x86_64')
 
+HOST_PACSTRAP_AUTO = 'auto'
+HOST_PACSTRAP_ALWAYS = 'always'
+HOST_PACSTRAP_NEVER = 'never'
+
+_HOST_PACSTRAP_CHOICES = (HOST_PACSTRAP_AUTO, HOST_PACSTRAP_ALWAYS, HOST_PACSTRAP_NEVER)
+
+_ABS_HOST_ARCHLINUX_KEYRING = '/usr/share/pacman/keyrings/archlinux.gpg'
+
+# NOTE: Packages downloaded at once by pacman 6.0 and later
+#       (earlier versions warn about the option and carry on)
+_PACMAN_PARALLEL_DOWNLOADS = 5
+
+# NOTE: Only repositories needed for pacstrap, with nothing taken from the host
+_HOST_PACMAN_CONF_TEMPLATE = dedent("""\
+        # Generated by directory-bootstrap
+        [options]
+        Architecture = %(architecture)s
+        GPGDir = %(gpg_dir)s
+        SigLevel = Required DatabaseOptional
+        LocalFileSigLevel = Optional
+        ParallelDownloads = %(parallel_downloads)d
+
+        [core]
+        Include = %(mirrorlist)s
+
+        [extra]
+        Include = %(mirrorlist)s
+        """)
+
 _GPG_DISPLAY_KEY_FORMAT = '0xlong'
 
+# NOTE: Enough to tell apart different images published under the same name
+_PACSTRAP_ROOT_DIGEST_PREFIX_LENGTH = 12
+
+# NOTE: Bumped whenever prepared roots of earlier releases must not be re-used
+_PACSTRAP_ROOT_REVISION = 2
+
+_ABS_PACMAN_GPG_DIR = '/etc/pacman.d/gnupg'
+
+_ABS_ARCHLINUX_TRUSTED_KEYS = '/usr/share/pacman/keyrings/archlinux-trusted'
+
 _NON_DISK_MOUNT_TASKS = (
         ('/dev', ['-o', 'bind'], 'dev'),
         ('/dev/pts', ['-o', 'bind'], 'dev/pts'),  # for gpgme
@@ -36,24 +80,50 @@ _day = '(0[1-9]|[12][0-9]|3[01])'
 _keyring_package_date_matcher = re.compile('%s%s%s' % (_year, _month, _day))
 _image_date_matcher = re.compile('%s\\.%s\\.%s' % (_year, _month, _day))
 
+_parallel_downloads_line_matcher = re.compile('^#?[ \\t]*ParallelDownloads[ \\t]*=.*$', re.MULTILINE)
+_options_section_matcher = re.compile('^\\[options\\][ \\t]*$', re.MULTILINE)
+
+
+def _set_pacman_parallel_downloads(pacman_conf_content):
+    line = 'ParallelDownloads = %d' % _PACMAN_PARALLEL_DOWNLOADS
+    if _parallel_downloads_line_matcher.search(pacman_conf_content):
+        return _parallel_downloads_line_matcher.sub(line, pacman_conf_content, count=1)
+    return _options_section_matcher.sub(lambda m: '%s\n%s' % (m.group(0), line),
+            pacman_conf_content, count=1)
+
+
+def enable_pacman_parallel_downloads(messenger, abs_pacman_conf):
+    messenger.info('Enabling parallel downloads in "%s"...' % abs_pacman_conf)
+    with open(abs_pacman_conf) as f:
+        content = f.read()
+    with open(abs_pacman_conf, 'w') as f:
+        f.write(_set_pacman_parallel_downloads(content))
+
 
 class ArchBootstrapper(DirectoryBootstrapper):
     DISTRO_KEY = 'arch'
     DISTRO_NAME_LONG = 'Arch Linux'
+    DEFAULT_MIRROR_URL = 'http://mirror.rackspace.com/archlinux/$repo/os/$arch'
+    DEFAULT_IMAGE_MIRROR_URL = 'https://mirrors.kernel.org/archlinux/'
 
     def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir,
-                architecture, image_date_triple_or_none, mirror_url,
-                abs_resolv_conf):
+                download_config, architecture, image_date_triple_or_none, mirror_urls,
+                image_mirror_urls, abs_resolv_conf, host_pacstrap, with_pacman_cache):
         super(ArchBootstrapper, self).__init__(
                 messenger,
                 executor,
                 abs_target_dir,
                 abs_cache_dir,
+                download_config,
                 )
         self._architecture = architecture
         self._image_date_triple_or_none = image_date_triple_or_none
-        self._mirror_url = mirror_url
+        self._mirror_urls = mirror_urls
+        self._image_mirror_base_urls = [url.rstrip('/') for url in image_mirror_urls]
         self._abs_resolv_conf = abs_resolv_conf
+        self._host_pacstrap = host_pacstrap
+        self._pacman_cache = PacmanCache(messenger, executor, abs_cache_dir,
+                architecture, mirror_urls) if with_pacman_cache else None
 
     def wants_to_be_unshared(self):
         return True
@@ -64,6 +134,7 @@ class ArchBootstrapper(DirectoryBootstrapper):
                 COMMAND_CHROOT,
                 COMMAND_GPG,
                 COMMAND_MOUNT,
+                COMMAND_TAR,
                 COMMAND_UMOUNT,
                 ]
 
@@ -71,21 +142,47 @@ class ArchBootstrapper(DirectoryBootstrapper):
         self._messenger.info('Downloading keyring listing...')
         return self.get_url_content('https://sources.archlinux.org/other/archlinux-keyring/')
 
+    def _get_image_listing_url(self, image_mirror_base_url):
+        return '%s/iso/' % image_mirror_base_url
+
     def _get_image_listing(self):
         self._messenger.info('Downloading image listing...')
-        return self.get_url_content('https://mirrors.kernel.org/archlinux/iso/')
+        return self.get_url_content([self._get_image_listing_url(image_mirror_base_url)
+                for image_mirror_base_url in self._image_mirror_base_urls])
+
+    def _find_latest_image_date(self):
+        return self.extract_latest_date(self._get_image_listing(), _image_date_matcher)
+
+    def _find_latest_keyring_date(self):
+        return self.extract_latest_date(self._get_keyring_listing(), _keyring_package_date_matcher)
+
+    def _get_pacman_database_url(self, mirror_url):
+        # NOTE: Large enough for a throughput sample, unlike core.db
+        return '%s/extra.db' % mirror_url.replace('$repo', 'extra') \
+                .replace('$arch', self._architecture).rstrip('/')
+
+    def _get_image_mirror_probe_url(self, image_mirror_base_url):
+        return self._get_pacman_database_url('%s/$repo/os/$arch' % image_mirror_base_url)
+
+    def _rank_package_mirrors(self):
+        self._mirror_urls = self.rank_mirrors(self._mirror_urls,
+                self._get_pacman_database_url)
 
-    def _download_keyring_package(self, package_yyyymmdd, suffix=''):
+    def _rank_mirrors(self):
+        self._image_mirror_base_urls = self.rank_mirrors(self._image_mirror_base_urls,
+                self._get_image_mirror_probe_url)
+        self._rank_package_mirrors()
+
+    def _get_keyring_package_download(self, package_yyyymmdd, suffix=''):
         filename = os.path.join(self._abs_cache_dir, 'archlinux-keyring-%s.tar.gz%s' % (package_yyyymmdd, suffix))
         url = 'https://sources.archlinux.org/other/archlinux-keyring/archlinux-keyring-%s.tar.gz%s' % (package_yyyymmdd, suffix)
-        self.download_url_to_file(url, filename)
-        return filename
+        return url, filename
 
-    def _download_image(self, image_yyyy_mm_dd, suffix=''):
+    def _get_image_download(self, image_yyyy_mm_dd, suffix=''):
         filename = os.path.join(self._abs_cache_dir, 'archlinux-bootstrap-%s-%s.tar.gz%s' % (image_yyyy_mm_dd, self._architecture, suffix))
-        url = 'https://mirrors.kernel.org/archlinux/iso/%s/archlinux-bootstrap-%s-%s.tar.gz%s' % (image_yyyy_mm_dd, image_yyyy_mm_dd, self._architecture, suffix)
-        self.download_url_to_file(url, filename)
-        return filename
+        urls = ['%s/iso/%s/archlinux-bootstrap-%s-%s.tar.gz%s' % (image_mirror_base_url, image_yyyy_mm_dd, image_yyyy_mm_dd, self._architecture, suffix)
+                for image_mirror_base_url in self._image_mirror_base_urls]
+        return urls, filename
 
     def _get_gpg_argv_start(self, abs_gpg_home_dir):
         return [
@@ -103,8 +200,8 @@ class ArchBootstrapper(DirectoryBootstrapper):
         os.mkdir(abs_gpg_home_dir, 0700)
 
         rel_archlinux_gpg_path = 'archlinux-keyring-%s/archlinux.gpg' % package_yyyymmdd
-        with TarFile.open(package_filename) as tf:
-            tf.extract(rel_archlinux_gpg_path, path=abs_temp_dir)
+        extract_compressed_tarball(self._messenger, self._executor,
+                package_filename, abs_temp_dir, member=rel_archlinux_gpg_path)
         abs_archlinux_gpg_path = os.path.join(abs_temp_dir, rel_archlinux_gpg_path)
 
         cmd = self._get_gpg_argv_start(abs_gpg_home_dir) + [
@@ -124,13 +221,73 @@ class ArchBootstrapper(DirectoryBootstrapper):
             ]
         self._executor.check_call(cmd)
 
-    def _extract_image(self, image_filename, abs_temp_dir):
-        abs_pacstrap_outer_root = os.path.join(abs_temp_dir, 'pacstrap_root', '')
+    def _extract_image(self, image_filename, abs_pacstrap_outer_root):
+        abs_pacstrap_inner_root = os.path.join(abs_pacstrap_outer_root, 'root.%s' % self._architecture)
+        os.mkdir(abs_pacstrap_outer_root)
+        extract_compressed_tarball(self._messenger, self._executor,
+                image_filename, abs_pacstrap_outer_root)
+
+        return abs_pacstrap_inner_root
 
-        self._messenger.info('Extracting bootstrap image to "%s"...' % abs_pacstrap_outer_root)
+    def _create_prepared_pacstrap_root(self, image_filename, abs_pacstrap_outer_root):
         abs_pacstrap_inner_root = os.path.join(abs_pacstrap_outer_root, 'root.%s' % self._architecture)
-        with TarFile.open(image_filename) as tf:
-            tf.extractall(path=abs_pacstrap_outer_root)
+        if os.path.exists(abs_pacstrap_outer_root):
+            # NOTE: Never delete through mounts left over from an interrupted run
+            for _, _, target in _NON_DISK_MOUNT_TASKS:
+                abs_path = os.path.join(abs_pacstrap_inner_root, target)
+                if os.path.ismount(abs_path):
+                    raise OSError(errno.EBUSY, 'Directory "%s" is still mounted' % abs_path)
+            self._messenger.info('Removing directory "%s"...' % abs_pacstrap_outer_root)
+            shutil.rmtree(abs_pacstrap_outer_root)
+
+        self._extract_image(image_filename, abs_pacstrap_outer_root)
+
+        self._mount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+        try:
+            self._initialize_pacman_keyring(abs_pacstrap_inner_root)
+            self._remove_pacman_master_key(abs_pacstrap_inner_root)
+        finally:
+            self._unmount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+
+    def _provide_prepared_pacstrap_root(self, image_filename):
+        """
+        Returns the inner root of the image extracted and with the pacman
+        keyring populated (but without a master key),
+        kept in the cache for re-use by later runs,
+        and a lock to release once done with it
+        """
+        tree_name = '%s-%s-r%d' % (
+                os.path.basename(image_filename)[:-len('.tar.gz')],
+                self.get_file_digest(image_filename, 'sha256')[:_PACSTRAP_ROOT_DIGEST_PREFIX_LENGTH],
+                _PACSTRAP_ROOT_REVISION,
+                )
+        abs_pacstrap_outer_root, lock = self.provide_cached_tree(tree_name, image_filename,
+                lambda partial_dirname: self._create_prepared_pacstrap_root(
+                    image_filename, partial_dirname))
+        return os.path.join(abs_pacstrap_outer_root, 'root.%s' % self._architecture), lock
+
+    def _mount_pacstrap_root_overlay(self, abs_prepared_inner_root, abs_temp_dir):
+        """
+        Mounts a writable copy-on-write view of the prepared root,
+        leaving the cached original untouched
+        """
+        abs_overlay_dir = os.path.join(abs_temp_dir, 'pacstrap_overlay')
+        abs_upper_dir = os.path.join(abs_overlay_dir, 'upper')
+        abs_work_dir = os.path.join(abs_overlay_dir, 'work')
+        abs_pacstrap_inner_root = os.path.join(abs_temp_dir, 'pacstrap_root')
+        for abs_dir in (abs_upper_dir, abs_work_dir, abs_pacstrap_inner_root):
+            os.makedirs(abs_dir, 0755)
+
+        self._messenger.info('Mounting overlay of "%s" at "%s"...'
+                % (abs_prepared_inner_root, abs_pacstrap_inner_root))
+        self._executor.check_call([
+                COMMAND_MOUNT,
+                '-t', 'overlay',
+                '-o', 'lowerdir=%s,upperdir=%s,workdir=%s'
+                    % (abs_prepared_inner_root, abs_upper_dir, abs_work_dir),
+                'overlay',
+                abs_pacstrap_inner_root,
+                ])
 
         return abs_pacstrap_inner_root
 
@@ -149,33 +306,34 @@ class ArchBootstrapper(DirectoryBootstrapper):
         with open(abs_mirrorlist, 'a') as f:
             print(file=f)
             print('## Added by directory-bootstrap', file=f)
-            print('Server = %s' % self._mirror_url, file=f)
+            for mirror_url in self._mirror_urls:
+                print('Server = %s' % mirror_url, file=f)
 
     def _copy_etc_resolv_conf(self, abs_pacstrap_inner_root):
         target = os.path.join(abs_pacstrap_inner_root, 'etc/resolv.conf')
         filter_copy_resolv_conf(self._messenger, self._abs_resolv_conf, target)
 
+    def _get_chroot_gpg_argv_start(self, abs_pacstrap_inner_root):
+        return [
+                COMMAND_UNSHARE,
+                '--fork', '--pid',  # to auto-kill started gpg-agent
+                COMMAND_CHROOT,
+                abs_pacstrap_inner_root,
+                ]
+
     def _initialize_pacman_keyring(self, abs_pacstrap_inner_root):
         self._messenger.info('Initializing pacman keyring... (may take 2 to 7 minutes)')
         before = datetime.datetime.now()
 
         env = self._make_chroot_env()
 
-        cmd = [
-                COMMAND_UNSHARE,
-                '--fork', '--pid',  # to auto-kill started gpg-agent
-                COMMAND_CHROOT,
-                abs_pacstrap_inner_root,
+        cmd = self._get_chroot_gpg_argv_start(abs_pacstrap_inner_root) + [
                 'pacman-key',
                 '--init',
                 ]
         self._executor.check_call(cmd, env=env)
 
-        cmd = [
-                COMMAND_UNSHARE,
-                '--fork', '--pid',  # to auto-kill started gpg-agent
-                COMMAND_CHROOT,
-                abs_pacstrap_inner_root,
+        cmd = self._get_chroot_gpg_argv_start(abs_pacstrap_inner_root) + [
                 'pacman-key',
                 '--populate', 'archlinux',
                 ]
@@ -184,6 +342,75 @@ class ArchBootstrapper(DirectoryBootstrapper):
         after = datetime.datetime.now()
         self._messenger.info('Took %d seconds.' % (after - before).total_seconds())
 
+    def _remove_pacman_master_key(self, abs_pacstrap_inner_root):
+        """
+        Removes the master key (secret and public part) generated by
+        pacman-key --init, so that no private key is shared by the runs
+        re-using the prepared root.  Each run generates a master key of its own.
+        """
+        self._messenger.info('Removing pacman keyring master key...')
+        gpg_argv_start = self._get_chroot_gpg_argv_start(abs_pacstrap_inner_root) + [
+                'gpg',
+                '--homedir', _ABS_PACMAN_GPG_DIR,
+                '--batch',
+                ]
+        output = self._executor.check_output(gpg_argv_start + [
+                '--with-colons',
+                '--fingerprint',
+                '--list-secret-keys',
+                ])
+
+        # NOTE: Only the first fingerprint after a "sec" line is that of the key itself
+        fingerprints = []
+        previous_type = None
+        for line in output.split('\n'):
+            fields = line.split(':')
+            if fields[0] == 'fpr' and previous_type == 'sec':
+                fingerprints.append(fields[9])
+            previous_type = fields[0]
+
+        if not fingerprints:
+            raise ValueError('No pacman keyring master key found')
+
+        self._executor.check_call(gpg_argv_start + [
+                '--yes',
+                '--delete-secret-and-public-key',
+                ] + fingerprints, env=self._make_chroot_env())
+
+    def _get_trusted_key_fingerprints(self, abs_pacstrap_inner_root):
+        abs_trusted_keys = os.path.join(abs_pacstrap_inner_root,
+                _ABS_ARCHLINUX_TRUSTED_KEYS.lstrip('/'))
+        fingerprints = []
+        with open(abs_trusted_keys) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                fingerprints.append(line.split(':')[0])
+        return fingerprints
+
+    def _create_pacman_master_key(self, abs_pacstrap_inner_root):
+        """
+        Gives the populated keyring of a prepared root a master key of its own,
+        trusting the same keys that pacman-key --populate did.
+        Unlike populating, there is no need to import all keys again.
+        """
+        self._messenger.info('Creating pacman keyring master key...')
+        env = self._make_chroot_env()
+
+        cmd = self._get_chroot_gpg_argv_start(abs_pacstrap_inner_root) + [
+                'pacman-key',
+                '--init',
+                ]
+        self._executor.check_call(cmd, env=env)
+
+        # NOTE: Owner trust of these keys survived removal of the earlier master key
+        cmd = self._get_chroot_gpg_argv_start(abs_pacstrap_inner_root) + [
+                'pacman-key',
+                '--lsign-key',
+                ] + self._get_trusted_key_fingerprints(abs_pacstrap_inner_root)
+        self._executor.check_call(cmd, env=env)
+
     def _run_pacstrap(self, abs_pacstrap_inner_root, rel_pacstrap_target_dir):
         self._messenger.info('Pacstrapping into "%s"...'
                 % (os.path.join(abs_pacstrap_inner_root, rel_pacstrap_target_dir)))
@@ -196,6 +423,153 @@ class ArchBootstrapper(DirectoryBootstrapper):
                 ]
         self._executor.check_call(cmd, env=env)
 
+    def _run_with_pacman_cache(self, abs_pacstrap_target_dir, run_pacstrap):
+        """
+        Calls run_pacstrap() with the pacman cache (if enabled) in place
+        at the target, as seen by pacstrap at abs_pacstrap_target_dir
+        """
+        if self._pacman_cache is None:
+            run_pacstrap()
+            return
+
+        self._pacman_cache.restore_sync_databases_to(self._abs_target_dir)
+        self._pacman_cache.mount_packages_into(abs_pacstrap_target_dir)
+        try:
+            run_pacstrap()
+        finally:
+            self._pacman_cache.unmount_packages_from(abs_pacstrap_target_dir)
+        self._pacman_cache.save_sync_databases_from(self._abs_target_dir)
+
+    def _find_host_pacstrap_trouble(self):
+        """
+        Returns why the host's pacstrap cannot be used, None if it can
+        """
+        for command in (COMMAND_PACSTRAP, COMMAND_PACMAN_KEY):
+            try:
+                find_command(command)
+            except OSError as e:
+                if e.errno != EXIT_COMMAND_NOT_FOUND:
+                    raise
+                return 'command "%s" not found' % command
+
+        if not os.path.exists(_ABS_HOST_ARCHLINUX_KEYRING):
+            return 'keyring file "%s" not found' % _ABS_HOST_ARCHLINUX_KEYRING
+
+        host_architecture = os.uname()[4]
+        if host_architecture != self._architecture:
+            return 'host architecture "%s" differs' % host_architecture
+
+        return None
+
+    def _find_host_pacstrap_conflict(self):
+        """
+        Returns the option asking for a bootstrap image, None if there is none
+        """
+        if self._image_date_triple_or_none is not None:
+            return '--image-date'
+        if self._download_config.abs_lock_filename is not None:
+            return '--lock'
+        if self._download_config.abs_write_lock_filename is not None:
+            return '--write-lock'
+        return None
+
+    def _should_use_host_pacstrap(self):
+        if self._host_pacstrap == HOST_PACSTRAP_NEVER:
+            return False
+
+        # NOTE: The host's pacstrap has no image to pin or record
+        conflict = self._find_host_pacstrap_conflict()
+        if conflict is not None:
+            if self._host_pacstrap == HOST_PACSTRAP_ALWAYS:
+                raise ValueError('Cannot use pacstrap of the host together with %s.' % conflict)
+            self._messenger.info('Not using pacstrap of the host (%s given).' % conflict)
+            return False
+
+        trouble = self._find_host_pacstrap_trouble()
+        if trouble is None:
+            self._messenger.info('Using pacstrap of the host.')
+            return True
+
+        if self._host_pacstrap == HOST_PACSTRAP_ALWAYS:
+            raise OSError(EXIT_COMMAND_NOT_FOUND, 'Cannot use pacstrap of the host: %s.' % trouble)
+
+        self._messenger.info('Not using pacstrap of the host (%s).' % trouble)
+        return False
+
+    def _initialize_host_pacman_keyring(self, abs_gpg_dir):
+        """
+        Initializes a keyring of our own from the keys shipped with
+        the host's archlinux-keyring package, leaving that of the host alone
+        """
+        self._messenger.info('Initializing temporary pacman keyring at "%s"...' % abs_gpg_dir)
+        os.mkdir(abs_gpg_dir, 0755)
+        for args in (
+                ['--init'],
+                ['--populate', 'archlinux'],
+                ):
+            self._executor.check_call([
+                    COMMAND_UNSHARE,
+                    '--fork', '--pid',  # to auto-kill started gpg-agent
+                    COMMAND_PACMAN_KEY,
+                    '--gpgdir', abs_gpg_dir,
+                    ] + args, env=self._make_chroot_env())
+
+    def _write_host_pacman_conf(self, abs_temp_dir, abs_gpg_dir):
+        abs_mirrorlist = os.path.join(abs_temp_dir, 'mirrorlist')
+        self._messenger.info('Writing file "%s"...' % abs_mirrorlist)
+        with open(abs_mirrorlist, 'w') as f:
+            print('## Generated by directory-bootstrap', file=f)
+            for mirror_url in self._mirror_urls:
+                print('Server = %s' % mirror_url, file=f)
+
+        abs_pacman_conf = os.path.join(abs_temp_dir, 'pacman.conf')
+        self._messenger.info('Writing file "%s"...' % abs_pacman_conf)
+        with open(abs_pacman_conf, 'w') as f:
+            f.write(_HOST_PACMAN_CONF_TEMPLATE % {
+                    'architecture': self._architecture,
+                    'gpg_dir': abs_gpg_dir,
+                    'mirrorlist': abs_mirrorlist,
+                    'parallel_downloads': _PACMAN_PARALLEL_DOWNLOADS,
+                    })
+
+        return abs_pacman_conf, abs_mirrorlist
+
+    def _run_host_pacstrap(self, abs_temp_dir):
+        """
+        Runs pacstrap of the host against the target directly,
+        with configuration and keyring of our own
+        """
+        # NOTE: No need for image mirrors here
+        self._rank_package_mirrors()
+
+        abs_gpg_dir = os.path.join(abs_temp_dir, 'gnupg')
+        self._initialize_host_pacman_keyring(abs_gpg_dir)
+        abs_pacman_conf, abs_mirrorlist = self._write_host_pacman_conf(abs_temp_dir, abs_gpg_dir)
+
+        def run_pacstrap():
+            self._messenger.info('Pacstrapping into "%s"...' % self._abs_target_dir)
+            self._executor.check_call([
+                    COMMAND_PACSTRAP,
+                    '-C', abs_pacman_conf,
+                    '-G',  # i.e. not the keyring of the host
+                    '-M',  # i.e. not the mirror list of the host
+                    '-d',  # i.e. target need not be a mountpoint
+                    self._abs_target_dir,
+                    'base',
+                    ], env=self._make_chroot_env())
+
+        self._run_with_pacman_cache(self._abs_target_dir, run_pacstrap)
+
+        # NOTE: Like pacstrap inside the bootstrap image would have done
+        abs_target_pacman_d = os.path.join(self._abs_target_dir, 'etc/pacman.d')
+        self._messenger.info('Copying mirror list and pacman keyring to "%s"...' % abs_target_pacman_d)
+        shutil.copyfile(abs_mirrorlist, os.path.join(abs_target_pacman_d, 'mirrorlist'))
+        abs_target_gpg_dir = os.path.join(abs_target_pacman_d, 'gnupg')
+        if os.path.exists(abs_target_gpg_dir):
+            shutil.rmtree(abs_target_gpg_dir)
+        shutil.copytree(abs_gpg_dir, abs_target_gpg_dir,
+                ignore=shutil.ignore_patterns('S.*'))  # i.e. no agent sockets
+
     def _mount_disk_chroot_mounts(self, abs_pacstrap_target_dir):
         self._executor.check_call([
                 COMMAND_MOUNT,
@@ -225,51 +599,105 @@ class ArchBootstrapper(DirectoryBootstrapper):
             abs_path = os.path.join(abs_pacstrap_inner_root, target)
             try_unmounting(self._executor, abs_path)
 
-    def run(self):
-        self.ensure_directories_writable()
+    def _fetch_and_verify(self, abs_temp_dir):
+        """
+        Returns the bootstrap image
+        """
+        self._rank_mirrors()
+
+        if self._image_date_triple_or_none is None:
+            image_yyyy_mm_dd = self.resolve('image_date', self._find_latest_image_date)
+        else:
+            image_yyyy_mm_dd = '%04s.%02d.%02d' % self._image_date_triple_or_none
+            self.record_resolved('image_date', image_yyyy_mm_dd)
+
+        package_yyyymmdd = self.resolve('keyring_date', self._find_latest_keyring_date)
+
+        downloads = [
+                self._get_keyring_package_download(package_yyyymmdd, '.sig'),
+                self._get_image_download(image_yyyy_mm_dd, '.sig'),
+                self._get_keyring_package_download(package_yyyymmdd),
+                self._get_image_download(image_yyyy_mm_dd),
+                ]
+        self.download_urls_to_files(downloads)
+        package_sig_filename, image_sig_filename, package_filename, image_filename \
+                = [filename for urls, filename in downloads]
+
+        abs_gpg_home_dirs = []
+
+        def get_gpg_home():
+            # NOTE: Only initialized if anything is left to verify
+            if not abs_gpg_home_dirs:
+                abs_gpg_home_dirs.append(self._initialize_gpg_home(
+                        abs_temp_dir, package_filename, package_yyyymmdd))
+            return abs_gpg_home_dirs[0]
+
+        trust_anchor = self.get_file_digest(package_filename, 'sha256')
+        for candidate_filename, signature_filename in (
+                (package_filename, package_sig_filename),
+                (image_filename, image_sig_filename),
+                ):
+            self.verify_memoized('GnuPG verification', [candidate_filename, signature_filename],
+                    trust_anchor,
+                    lambda: self._verify_file_gpg(candidate_filename, signature_filename,
+                        get_gpg_home()))
+
+        return image_filename
+
+    def prefetch(self):
+        self.ensure_cache_directory_writable()
 
         abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
         try:
-            if self._image_date_triple_or_none is None:
-                image_listing_html = self._get_image_listing()
-                image_yyyy_mm_dd = self.extract_latest_date(image_listing_html, _image_date_matcher)
-            else:
-                image_yyyy_mm_dd = '%04s.%02d.%02d' % self._image_date_triple_or_none
-
-            keyring_listing_html = self._get_keyring_listing()
-            package_yyyymmdd = self.extract_latest_date(keyring_listing_html, _keyring_package_date_matcher)
-
-            package_sig_filename = self._download_keyring_package(package_yyyymmdd, '.sig')
-            package_filename = self._download_keyring_package(package_yyyymmdd)
-
-            abs_gpg_home_dir = self._initialize_gpg_home(abs_temp_dir, package_filename, package_yyyymmdd)
-            self._verify_file_gpg(package_filename, package_sig_filename, abs_gpg_home_dir)
-
-            image_sig_filename = self._download_image(image_yyyy_mm_dd, '.sig')
-            image_filename = self._download_image(image_yyyy_mm_dd)
-            self._verify_file_gpg(image_filename, image_sig_filename, abs_gpg_home_dir)
-
-
-            abs_pacstrap_inner_root = self._extract_image(image_filename, abs_temp_dir)
-            self._adjust_pacman_mirror_list(abs_pacstrap_inner_root)
-            self._copy_etc_resolv_conf(abs_pacstrap_inner_root)
+            self._fetch_and_verify(abs_temp_dir)
+        finally:
+            self._messenger.info('Cleaning up "%s"...' % abs_temp_dir)
+            shutil.rmtree(abs_temp_dir)
 
+    def run(self):
+        self.ensure_directories_writable()
 
-            rel_pacstrap_target_dir = os.path.join('mnt', 'arch_root', '')
-            abs_pacstrap_target_dir = os.path.join(abs_pacstrap_inner_root, rel_pacstrap_target_dir)
+        abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
+        try:
+            if self._should_use_host_pacstrap():
+                self._run_host_pacstrap(abs_temp_dir)
+                return
 
-            os.makedirs(abs_pacstrap_target_dir)
+            image_filename = self._fetch_and_verify(abs_temp_dir)
 
-            self._mount_disk_chroot_mounts(abs_pacstrap_target_dir)
+            abs_prepared_inner_root, prepared_root_lock \
+                    = self._provide_prepared_pacstrap_root(image_filename)
             try:
-                self._mount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+                abs_pacstrap_inner_root = self._mount_pacstrap_root_overlay(
+                        abs_prepared_inner_root, abs_temp_dir)
                 try:
-                    self._initialize_pacman_keyring(abs_pacstrap_inner_root)
-                    self._run_pacstrap(abs_pacstrap_inner_root, rel_pacstrap_target_dir)
+                    self._adjust_pacman_mirror_list(abs_pacstrap_inner_root)
+                    enable_pacman_parallel_downloads(self._messenger,
+                            os.path.join(abs_pacstrap_inner_root, 'etc/pacman.conf'))
+                    self._copy_etc_resolv_conf(abs_pacstrap_inner_root)
+
+                    rel_pacstrap_target_dir = os.path.join('mnt', 'arch_root', '')
+                    abs_pacstrap_target_dir = os.path.join(abs_pacstrap_inner_root, rel_pacstrap_target_dir)
+
+                    os.makedirs(abs_pacstrap_target_dir)
+
+                    self._mount_disk_chroot_mounts(abs_pacstrap_target_dir)
+                    try:
+                        self._mount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+                        try:
+                            # NOTE: A master key of our own, copied to the target by pacstrap
+                            self._create_pacman_master_key(abs_pacstrap_inner_root)
+                            self._run_with_pacman_cache(abs_pacstrap_target_dir,
+                                    lambda: self._run_pacstrap(abs_pacstrap_inner_root,
+                                        rel_pacstrap_target_dir))
+                        finally:
+                            self._unmount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+                    finally:
+                        self._unmount_disk_chroot_mounts(abs_pacstrap_target_dir)
                 finally:
-                    self._unmount_nondisk_chroot_mounts(abs_pacstrap_inner_root)
+                    try_unmounting(self._executor, abs_pacstrap_inner_root)
             finally:
-                self._unmount_disk_chroot_mounts(abs_pacstrap_target_dir)
+                prepared_root_lock.release()
 
         finally:
             self._messenger.info('Cleaning up "%s"...' % abs_temp_dir)
@@ -282,19 +710,42 @@ class ArchBootstrapper(DirectoryBootstrapper):
                 help='architecture (e.g. x86_64)')
         distro.add_argument('--image-date', type=date_argparse_type, metavar='YYYY-MM-DD',
                 help='date to use boostrap image of (e.g. 2015-05-01, default: latest available)')
-        distro.add_argument('--mirror', dest='mirror_url', metavar='URL',
-                default='http://mirror.rackspace.com/archlinux/$repo/os/$arch',
-                help='pacman mirror to use (default: %(default)s)')
+        distro.add_argument('--mirror', dest='mirror_urls', metavar='URL',
+                action='append',
+                help='pacman mirror to use; can be passed several times '
+                    'to have the fastest one picked and fail over to others '
+                    '(default: %s)' % clazz.DEFAULT_MIRROR_URL)
+        distro.add_argument('--image-mirror', dest='image_mirror_urls', metavar='URL',
+                action='append',
+                help='mirror to download the bootstrap image from; '
+                    'can be passed several times (default: %s)'
+                    % clazz.DEFAULT_IMAGE_MIRROR_URL)
+        distro.add_argument('--host-pacstrap', choices=_HOST_PACSTRAP_CHOICES,
+                default=HOST_PACSTRAP_AUTO,
+                help='run pacstrap of the host (with configuration and keyring of its own) '
+                    'rather than that of the bootstrap image, '
+                    'skipping download and extraction of the latter; '
+                    '"%s" uses it if installed and of matching architecture, '
+                    'unless any of --image-date, --lock and --write-lock is given '
+                    '(default: %%(default)s)' % HOST_PACSTRAP_AUTO)
+        distro.add_argument('--pacman-cache', action='store_true',
+                help='keep packages and sync databases downloaded by pacman '
+                    'in the cache directory, for later runs to only download '
+                    'what changed (default: download everything each time)')
 
     @classmethod
     def create(clazz, messenger, executor, options):
         return clazz(
                 messenger,
                 executor,
-                os.path.abspath(options.target_dir),
+                get_abs_target_dir(options),
                 os.path.abspath(options.cache_dir),
+                DownloadConfig.create(options),
                 options.architecture,
                 options.image_date,
-                options.mirror_url,
+                options.mirror_urls or [clazz.DEFAULT_MIRROR_URL],
+                options.image_mirror_urls or [clazz.DEFAULT_IMAGE_MIRROR_URL],
                 os.path.abspath(options.resolv_conf),
+                options.host_pacstrap,
+                options.pacman_cache,
                 )
@@ -6,13 +6,24 @@ from __future__ import print_function
 import errno
 import os
 import re
+import time
 from abc import ABCMeta, abstractmethod
+from multiprocessing.pool import ThreadPool
 
 import directory_bootstrap.shared.loaders._requests as requests
-from directory_bootstrap.shared.commands import (
-        COMMAND_WGET, check_for_commands)
+from directory_bootstrap.shared.artifact_store import ArtifactStore
+from directory_bootstrap.shared.byte_size import format_byte_size, parse_byte_size
+from directory_bootstrap.shared.commands import check_for_commands
+from directory_bootstrap.shared.digests import DIGEST_ALGORITHMS
+from directory_bootstrap.shared.download_stats import DownloadStats, write_download_summary
+from directory_bootstrap.shared.downloader import DownloadError, Downloader
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.listing_cache import ListingCache
+from directory_bootstrap.shared.lockfile import Lockfile, LockfileError, OfflineError
 from directory_bootstrap.shared.loaders._bs4 import BeautifulSoup
+from directory_bootstrap.shared.mirrors import MirrorHealthDatabase, rank_mirrors
 from directory_bootstrap.shared.namespace import unshare_current_process
+from directory_bootstrap.shared.verification_memo import VerificationMemo
 
 BOOTSTRAPPER_CLASS_FIELD = 'bootstrapper_class'
 
@@ -22,6 +33,17 @@ _day = '(0[1-9]|[12][0-9]|3[01])'
 
 _argparse_date_matcher = re.compile('^%s-%s-%s$' % (_year, _month, _day))
 
+_DEFAULT_DOWNLOAD_JOBS = 4
+_DEFAULT_DOWNLOAD_SEGMENTS = 4
+_DEFAULT_METADATA_TTL_SECONDS = 0
+
+_DOWNLOAD_ATTEMPTS = 5
+_DOWNLOAD_ATTEMPTS_BEFORE_FAILOVER = 2
+_DOWNLOAD_RETRY_WAIT_SECONDS = 10
+
+# NOTE: Waiting with a timeout keeps KeyboardInterrupt deliverable in Python 2
+_DOWNLOAD_WAIT_TIMEOUT_SECONDS = 365 * 24 * 60 * 60
+
 
 def date_argparse_type(text):
     m = _argparse_date_matcher.match(text)
@@ -32,39 +54,160 @@ def date_argparse_type(text):
 date_argparse_type.__name__ = 'date'
 
 
+def _as_url_list(url_or_urls):
+    """
+    >>> _as_url_list('http://example.org/')
+    ['http://example.org/']
+    >>> _as_url_list(['http://example.org/', 'http://example.net/'])
+    ['http://example.org/', 'http://example.net/']
+    """
+    if isinstance(url_or_urls, basestring):
+        return [url_or_urls]
+    return list(url_or_urls)
+
+
 def add_general_directory_bootstrapping_options(general):
     general.add_argument('--cache-dir', metavar='DIRECTORY',
             default='/var/cache/directory-bootstrap/',
             help='directory to use for downloads (default: %(default)s)')
+    general.add_argument('--download-jobs', type=int, metavar='JOBS',
+            default=_DEFAULT_DOWNLOAD_JOBS,
+            help='number of downloads to run in parallel (default: %(default)s)')
+    general.add_argument('--download-segments', type=int, metavar='COUNT',
+            default=_DEFAULT_DOWNLOAD_SEGMENTS,
+            help='number of byte ranges to download large files in, '
+                'concurrently and spread over mirrors (default: %(default)s)')
+    general.add_argument('--cache-max-size', type=parse_byte_size, metavar='SIZE',
+            help='evict least recently used files (downloads, prepared trees, '
+                'package caches and proxied files alike) from the cache directory '
+                'after bootstrapping until it takes SIZE (e.g. 20G) or less '
+                '(default: no limit)')
+    general.add_argument('--cache-keep-last', type=int, metavar='COUNT',
+            help='evict all but the COUNT most recent files of each kind '
+                '(e.g. stage3 tarballs of an architecture) from the cache directory '
+                'after bootstrapping (default: keep all)')
+    general.add_argument('--metadata-ttl', type=int, metavar='SECONDS',
+            default=_DEFAULT_METADATA_TTL_SECONDS,
+            help='time to re-use cached listings of releases (for finding latest ones) '
+                'without asking upstream if they changed (default: %(default)s seconds)')
+    general.add_argument('--write-lock', dest='write_lock_filename', metavar='FILE',
+            help='write resolved release dates and downloaded files '
+                '(with URLs, sizes and checksums) to FILE, for use with --lock')
+    general.add_argument('--lock', dest='lock_filename', metavar='FILE',
+            help='use release dates from FILE (written by --write-lock) '
+                'rather than looking for the latest ones, '
+                'and insist on files matching the checksums in FILE')
+    general.add_argument('--offline', action='store_true',
+            help='do not access the network for finding releases or downloading; '
+                'take everything from the cache directory (best combined with --lock)')
+    general.add_argument('--reverify', action='store_true',
+            help='verify signatures and checksums of cached files again '
+                'even if they passed before, unchanged')
+    general.add_argument('--http-proxy', metavar='URL',
+            help='send plain HTTP downloads (including those of debootstrap, pacstrap, '
+                'emerge and yum) through the proxy at URL, '
+                'e.g. one started by "image-bootstrap cache-proxy" '
+                '(default: as configured by variable http_proxy)')
+    general.add_argument('--download-summary', dest='download_summary_filename', metavar='FILE',
+            help='write statistics of all downloads (bytes, duration, time to first byte, '
+                'throughput, retries, mirrors) to FILE, as JSON')
+
+
+def get_abs_target_dir(options):
+    """
+    Returns None for runs without a target directory (i.e. prefetching)
+    """
+    if options.target_dir is None:
+        return None
+    return os.path.abspath(options.target_dir)
+
+
+class DownloadConfig(object):
+    def __init__(self, jobs, segments, cache_max_size_bytes, cache_keep_last, metadata_ttl_seconds,
+            lock_filename, write_lock_filename, offline, reverify, download_summary_filename):
+        if jobs < 1:
+            raise ValueError('Number of download jobs must be 1 or more, %d given' % jobs)
+        if segments < 1:
+            raise ValueError('Number of download segments must be 1 or more, %d given' % segments)
+        if cache_keep_last is not None and cache_keep_last < 1:
+            raise ValueError('Number of files to keep must be 1 or more, %d given' % cache_keep_last)
+        self.jobs = jobs
+        self.segments = segments
+        self.cache_max_size_bytes = cache_max_size_bytes
+        self.cache_keep_last = cache_keep_last
+        self.metadata_ttl_seconds = metadata_ttl_seconds
+        self.abs_lock_filename = os.path.abspath(lock_filename) if lock_filename else None
+        self.abs_write_lock_filename = os.path.abspath(write_lock_filename) if write_lock_filename else None
+        self.offline = offline
+        self.reverify = reverify
+        self.abs_download_summary_filename = os.path.abspath(download_summary_filename) \
+                if download_summary_filename else None
+
+    @classmethod
+    def create(clazz, options):
+        return clazz(
+                options.download_jobs,
+                options.download_segments,
+                options.cache_max_size,
+                options.cache_keep_last,
+                options.metadata_ttl,
+                options.lock_filename,
+                options.write_lock_filename,
+                options.offline,
+                options.reverify,
+                options.download_summary_filename,
+                )
 
 
 class DirectoryBootstrapper(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir):
+    def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir, download_config):
         self._messenger = messenger
         self._executor = executor
         self._abs_target_dir = abs_target_dir
         self._abs_cache_dir = abs_cache_dir
+        self._download_config = download_config
+        self._artifact_store = ArtifactStore(abs_cache_dir)
+        self._session_pool = SessionPool(download_config.jobs * download_config.segments)
+        self._listing_cache = ListingCache(messenger, abs_cache_dir,
+                download_config.metadata_ttl_seconds, self._session_pool,
+                download_config.offline)
+        self._downloader = Downloader(messenger, self._session_pool,
+                _DOWNLOAD_RETRY_WAIT_SECONDS)
+        self._mirror_health = MirrorHealthDatabase(abs_cache_dir)
+        self._verification_memo = VerificationMemo(abs_cache_dir)
+        self._download_stats = []
+        self._cached_file_locks = []
+
+        self._lock_in = None
+        if download_config.abs_lock_filename is not None:
+            self._lock_in = Lockfile.load(download_config.abs_lock_filename)
+            if self._lock_in.distro_key != self.DISTRO_KEY:
+                raise LockfileError('Lock file "%s" is for %s, not %s'
+                        % (download_config.abs_lock_filename, self._lock_in.distro_key, self.DISTRO_KEY))
+        self._lock_out = Lockfile(self.DISTRO_KEY)
 
     @abstractmethod
     def wants_to_be_unshared(self):
         pass
 
     @classmethod
-    def add_parser_to(clazz, distros):
+    def add_parser_to(clazz, distros, with_target_dir=True):
         distro = distros.add_parser(clazz.DISTRO_KEY, help=clazz.DISTRO_NAME_LONG)
         distro.set_defaults(**{BOOTSTRAPPER_CLASS_FIELD: clazz})
         clazz.add_arguments_to(distro)
+        if with_target_dir:
+            distro.add_argument('target_dir', metavar='DIRECTORY')
+        else:
+            distro.set_defaults(target_dir=None)
 
     def check_for_commands(self):
         check_for_commands(self._messenger, self.get_commands_to_check_for())
 
     @staticmethod
     def get_commands_to_check_for():
-        return [
-                COMMAND_WGET,
-                ]
+        return []
 
     def unshare(self):
         unshare_current_process(self._messenger)
@@ -80,6 +223,14 @@ class DirectoryBootstrapper(object):
 
         return sorted(dates)[-1]
 
+    @abstractmethod
+    def prefetch(self):
+        """
+        Resolves, downloads and verifies everything that run() needs
+        into the cache directory, without touching any target directory
+        """
+        pass
+
     @abstractmethod
     def run(self):
         pass
@@ -92,21 +243,269 @@ class DirectoryBootstrapper(object):
     def create(clazz, messenger, executor, options):
         raise NotImplementedError()
 
-    def get_url_content(self, url):
-        return requests.get(url).text
+    def resolve(self, key, find_latest):
+        """
+        Returns the value (e.g. a release date) recorded for key
+        in the --lock file, or else what find_latest() returns.
+        Either way, the value is recorded for --write-lock.
+        """
+        if self._lock_in is None:
+            value = find_latest()
+        else:
+            value = self._lock_in.get_resolved(key)
+            if value is None:
+                raise LockfileError('Lock file "%s" has no entry "%s"'
+                        % (self._download_config.abs_lock_filename, key))
+            self._messenger.info('Using %s "%s" from lock file.' % (key.replace('_', ' '), value))
+        self.record_resolved(key, value)
+        return value
+
+    def record_resolved(self, key, value):
+        """
+        Records a value given explicitly (e.g. --stage3-date) for --write-lock
+        """
+        self._lock_out.set_resolved(key, value)
+
+    def rank_mirrors(self, mirror_urls, get_probe_url):
+        return rank_mirrors(self._messenger, self._session_pool,
+                self._mirror_health, mirror_urls, get_probe_url,
+                probe=not self._download_config.offline)
+
+    def get_url_content(self, url_or_urls):
+        """
+        Fetches a (small) document, failing over to
+        alternative URLs (e.g. on other mirrors) if given a list
+        """
+        urls = _as_url_list(url_or_urls)
+        for i, url in enumerate(urls):
+            try:
+                return self._listing_cache.get_url_content(url)
+            except (requests.RequestException, OfflineError) as e:
+                if not isinstance(e, OfflineError):
+                    self._mirror_health.record_failure(url)
+                if i == len(urls) - 1:
+                    raise
+                self._messenger.warn('Fetching "%s" failed (%s), failing over to "%s"...'
+                        % (url, e, urls[i + 1]))
+
+    def _download_urls_to_partial_file(self, urls, partial_filename, stats):
+        """
+        Downloads from the first URL that works, continuing partial
+        downloads across mirrors.  Returns the URL that worked
+        and digests of the file.
+        """
+        for i, url in enumerate(urls):
+            is_last_url = (i == len(urls) - 1)
+            attempts = _DOWNLOAD_ATTEMPTS if is_last_url else _DOWNLOAD_ATTEMPTS_BEFORE_FAILOVER
+            size_before = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+            before = time.time()
+            try:
+                digests = self._downloader.download(urls[i:], partial_filename, attempts,
+                        stats, self._download_config.segments)
+            except (requests.RequestException, DownloadError) as e:
+                self._mirror_health.record_failure(url)
+                if is_last_url:
+                    raise
+                stats.record_retry(url)
+                self._messenger.warn('Downloading "%s" failed (%s), failing over to "%s"...'
+                        % (url, e, urls[i + 1]))
+            else:
+                self._mirror_health.record_success(url,
+                        os.path.getsize(partial_filename) - size_before,
+                        time.time() - before)
+                return url, digests
+
+    def provide_cached_file(self, filename, create_file):
+        """
+        Makes a cached artifact available at the given filename
+        (named after its basename), calling create_file(partial_filename)
+        on cache misses.  create_file may return the URL the file came from
+        and digests of the file, as a pair.
+        Artifacts only enter the cache once complete,
+        so that anything found in the cache can safely be taken as a hit.
+        Artifacts provided are kept from eviction (by this or other runs)
+        until release_cached_files() is called.
+        Returns the index entry of the artifact.
+        """
+        entry, lock = self._artifact_store.provide(self._messenger, filename, create_file)
+        self._cached_file_locks.append(lock)
+        return entry
+
+    def release_cached_files(self):
+        """
+        Lets go of artifacts provided from cache, once done using them
+        (e.g. extracting or mounting), so that they can be evicted
+        """
+        while self._cached_file_locks:
+            self._cached_file_locks.pop().release()
+
+    def provide_cached_tree(self, tree_name, source_filename, create_tree):
+        """
+        Provides a directory tree derived from a file provided from cache,
+        calling create_tree(partial_dirname) on cache misses.
+        Trees go away once their source file leaves the cache.
+        Returns the directory of the tree and a lock (already acquired,
+        to be released by the caller) that keeps it from being removed.
+        """
+        source_entry = self._artifact_store.lookup(os.path.basename(source_filename))
+        if source_entry is None:
+            raise ValueError('File "%s" is not in the cache' % source_filename)
+
+        lock = self._artifact_store.locked(tree_name)
+        created = False
+        while True:
+            lock.acquire(shared=True)
+            abs_tree_dirname = self._artifact_store.lookup_tree(tree_name)
+            if abs_tree_dirname is not None:
+                if not created:
+                    self._messenger.info('Re-using cache tree "%s".' % abs_tree_dirname)
+                    self._artifact_store.record_tree_access(tree_name)
+                return abs_tree_dirname, lock
+            lock.release()
 
-    def download_url_to_file(self, url, filename):
-        if os.path.exists(filename):
-            self._messenger.info('Re-using cache file "%s".' % filename)
+            with lock:
+                if self._artifact_store.lookup_tree(tree_name) is None:
+                    partial_dirname = self._artifact_store.get_partial_tree_dirname(tree_name)
+                    create_tree(partial_dirname)
+                    self._artifact_store.add_tree(tree_name, partial_dirname, source_entry)
+                    created = True
+
+    def get_file_digest(self, filename, algorithm):
+        """
+        Returns the digest (e.g. "sha512") of a file provided from cache,
+        as recorded when it entered the cache
+        """
+        artifact_name = os.path.basename(filename)
+        with self._artifact_store.locked(artifact_name):
+            entry = self._artifact_store.lookup(artifact_name)
+            if entry is None:
+                raise ValueError('File "%s" is not in the cache' % filename)
+            return self._artifact_store.get_digest(entry, algorithm)
+
+    def verify_memoized(self, kind, filenames, trust_anchor, verify):
+        """
+        Calls verify() unless the very same verification of the very same
+        cached files passed before, with the same trusted keys
+        (trust_anchor, e.g. the digest of a keyring).
+        With --reverify, verify() is called regardless.
+        """
+        key = VerificationMemo.make_key(kind,
+                [(filename, self.get_file_digest(filename, 'sha256')) for filename in filenames],
+                trust_anchor)
+        if not self._download_config.reverify and self._verification_memo.contains(key):
+            self._messenger.info('Skipping %s of file "%s" (passed before, unchanged).'
+                    % (kind, filenames[0]))
+            return
+
+        verify()
+        self._verification_memo.add(key)
+
+    def download_url_to_file(self, url_or_urls, filename):
+        """
+        Downloads a file, given its URL or a list of alternative URLs
+        (e.g. on other mirrors, best first)
+        """
+        urls = _as_url_list(url_or_urls)
+        artifact_name = os.path.basename(filename)
+        stats = DownloadStats(artifact_name)
+
+        def download_to(partial_filename):
+            if self._download_config.offline:
+                raise OfflineError('File "%s" is not in the cache, cannot download "%s" offline'
+                        % (artifact_name, urls[0]))
+            if os.path.exists(partial_filename):
+                self._messenger.info('Resuming download of "%s"...' % urls[0])
+            else:
+                self._messenger.info('Downloading "%s"...' % urls[0])
+            source_url, digests = self._download_urls_to_partial_file(urls, partial_filename, stats)
+            stats.finish(source_url)
+            self._messenger.info(stats.describe())
+            return source_url, digests
+
+        entry = self.provide_cached_file(filename, download_to)
+        if stats.finished is None:
+            stats.finish(None, cached=True)
+        self._download_stats.append(stats)
+
+        digests = dict((algorithm, self._artifact_store.get_digest(entry, algorithm))
+                for algorithm in DIGEST_ALGORITHMS)
+        if self._lock_in is not None:
+            locked_artifact = self._lock_in.get_artifact(artifact_name)
+            if locked_artifact is None:
+                raise LockfileError('Lock file "%s" has no entry for file "%s"'
+                        % (self._download_config.abs_lock_filename, artifact_name))
+            if locked_artifact['sha256'] != digests['sha256']:
+                raise LockfileError('File "%s" does not match lock file "%s" (SHA-256 %s, expected %s)'
+                        % (filename, self._download_config.abs_lock_filename,
+                            digests['sha256'], locked_artifact['sha256']))
+        self._lock_out.add_artifact(artifact_name, urls, entry['size'], digests)
+
+    def download_urls_to_files(self, url_filename_pairs):
+        """
+        Downloads several files at once, using up to --download-jobs
+        parallel downloads.  Pairs are started in the order given,
+        so small files should go first.  Like with download_url_to_file,
+        lists of alternative URLs can be given in place of URLs.
+        """
+        jobs = min(self._download_config.jobs, len(url_filename_pairs))
+        if jobs <= 1:
+            for url, filename in url_filename_pairs:
+                self.download_url_to_file(url, filename)
+            return
+
+        # NOTE: With chunks of one, each job picks up the next pair once free,
+        #       so that one large file does not hold up small ones queued behind it
+        pool = ThreadPool(jobs)
+        try:
+            pool.map_async(lambda (url, filename): self.download_url_to_file(url, filename),
+                    url_filename_pairs, chunksize=1).get(_DOWNLOAD_WAIT_TIMEOUT_SECONDS)
+        except:
+            # NOTE: Not waiting for downloads still running, e.g. on Ctrl+C
+            pool.terminate()
+            raise
+
+        pool.close()
+        pool.join()
+
+    def write_lock_file(self):
+        """
+        Writes what this run resolved and downloaded to the --write-lock file, if any
+        """
+        abs_filename = self._download_config.abs_write_lock_filename
+        if abs_filename is None:
+            return
+
+        self._messenger.info('Writing lock file "%s"...' % abs_filename)
+        self._lock_out.save(abs_filename)
+
+    def summarize_downloads(self):
+        """
+        Reports totals of all downloads so far, writing details
+        to the --download-summary file, if any
+        """
+        downloads = [stats for stats in self._download_stats if not stats.cached]
+        if downloads:
+            self._messenger.info('Downloaded %d file(s), %s in total, %d file(s) taken from cache.'
+                    % (len(downloads),
+                        format_byte_size(sum(stats.byte_count for stats in downloads)),
+                        len(self._download_stats) - len(downloads)))
+
+        abs_filename = self._download_config.abs_download_summary_filename
+        if abs_filename is None:
             return
 
-        self._messenger.info('Downloading "%s"...' % url)
-        cmd = [
-                COMMAND_WGET,
-                '-O%s' % filename,
-                url,
-                ]
-        self._executor.check_call(cmd)
+        self._messenger.info('Writing download summary to "%s"...' % abs_filename)
+        write_download_summary(abs_filename, self._download_stats)
+
+    def collect_cache_garbage(self):
+        if self._download_config.cache_max_size_bytes is None \
+                and self._download_config.cache_keep_last is None:
+            return
+
+        self._messenger.info('Cleaning up cache directory "%s"...' % self._abs_cache_dir)
+        self._artifact_store.collect_garbage(self._messenger,
+                self._download_config.cache_max_size_bytes,
+                self._download_config.cache_keep_last)
 
     def _ensure_directory_writable(self, abs_path, creation_mode):
         try:
@@ -125,6 +524,9 @@ class DirectoryBootstrapper(object):
             # NOTE: Sounding like future is intentional.
             self._messenger.info('Creating directory "%s"...' % abs_path)
 
-    def ensure_directories_writable(self):
+    def ensure_cache_directory_writable(self):
         self._ensure_directory_writable(self._abs_cache_dir, 0755)
+
+    def ensure_directories_writable(self):
+        self.ensure_cache_directory_writable()
         self._ensure_directory_writable(self._abs_target_dir, 0700)
@@ -13,7 +13,8 @@ import urllib
 
 from textwrap import dedent
 
-from directory_bootstrap.distros.base import DirectoryBootstrapper
+from directory_bootstrap.distros.base import (
+        DirectoryBootstrapper, DownloadConfig, get_abs_target_dir)
 from directory_bootstrap.shared.commands import (COMMAND_CHROOT, COMMAND_DB_DUMP,
         COMMAND_FILE, COMMAND_LSB_RELEASE, COMMAND_RPM, COMMAND_YUM, EXIT_COMMAND_NOT_FOUND, find_command)
 
@@ -68,12 +69,14 @@ class FedoraBootstrapper(DirectoryBootstrapper):
     DISTRO_KEY = 'fedora'
     DISTRO_NAME_LONG = 'Fedora'
 
-    def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir, releasever):
+    def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir,
+                download_config, releasever):
         super(FedoraBootstrapper, self).__init__(
                 messenger,
                 executor,
                 abs_target_dir,
                 abs_cache_dir,
+                download_config,
                 )
         self._releasever = releasever
 
@@ -103,8 +106,9 @@ class FedoraBootstrapper(DirectoryBootstrapper):
         return clazz(
                 messenger,
                 executor,
-                os.path.abspath(options.target_dir),
+                get_abs_target_dir(options),
                 os.path.abspath(options.cache_dir),
+                DownloadConfig.create(options),
                 options.release,
                 )
 
@@ -173,10 +177,11 @@ class FedoraBootstrapper(DirectoryBootstrapper):
                     """ % (gpg_public_key_file_url, gpg_public_key_file_url, gpg_public_key_file_url)), file=f)
 
     def _find_latest_release(self):
+        self._messenger.info('Searching for latest release...')
         json_content = self.get_url_content(_COLLECTIONS_URL)
         try:
             content = json.loads(json_content)
-            return sorted([
+            releasever = sorted([
                     int(c['version']) for c in content['collections']
                     if c['name'] == 'Fedora' and c['version'].isdigit()
             ])[-1]
@@ -184,6 +189,8 @@ class FedoraBootstrapper(DirectoryBootstrapper):
             raise ValueError(
                     'Could not extract latest release from %s content' \
                     % _COLLECTIONS_URL)
+        self._messenger.info('Found %s to be latest.' % releasever)
+        return str(releasever)
 
     def _download_fedora_release_public_key(self):
         self._messenger.info('Downloading related GnuPG public key...')
@@ -259,15 +266,25 @@ class FedoraBootstrapper(DirectoryBootstrapper):
         finally:
             os.remove(abs_full_path_temp)
 
+    def _fetch(self):
+        """
+        Returns the release public key.  Packages are left to yum.
+        """
+        if self._releasever is None:
+            self._releasever = self.resolve('release', self._find_latest_release)
+        else:
+            self.record_resolved('release', self._releasever)
+
+        return self._download_fedora_release_public_key()
+
+    def prefetch(self):
+        self.ensure_cache_directory_writable()
+        self._fetch()
+
     def run(self):
         self.ensure_directories_writable()
 
-        if self._releasever is None:
-            self._messenger.info('Searching for latest release...')
-            self._releasever = str(self._find_latest_release())
-            self._messenger.info('Found %s to be latest.' % self._releasever)
-
-        abs_gpg_public_key_filename = self._download_fedora_release_public_key()
+        abs_gpg_public_key_filename = self._fetch()
 
         abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
         try:
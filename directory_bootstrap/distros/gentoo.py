@@ -5,23 +5,26 @@ from __future__ import print_function
 
 import datetime
 import errno
+import hashlib
 import os
 import re
 import shutil
 import subprocess
+import sys
 import tempfile
 
 import directory_bootstrap.resources.gentoo as resources
 from directory_bootstrap.distros.base import (
-        DirectoryBootstrapper, date_argparse_type)
+        DirectoryBootstrapper, DownloadConfig, date_argparse_type,
+        get_abs_target_dir)
 from directory_bootstrap.shared.commands import (
-        COMMAND_GPG, COMMAND_MD5SUM, COMMAND_SHA512SUM, COMMAND_TAR,
-        COMMAND_UNXZ)
+        COMMAND_GPG, COMMAND_MKSQUASHFS, COMMAND_TAR, COMMAND_XZ)
+from directory_bootstrap.shared.decompression import (
+        extract_compressed_tarball, start_extracting_compressed_tarball)
+from directory_bootstrap.shared.digests import hash_file
 from directory_bootstrap.shared.loaders._pkg_resources import resource_filename
-from directory_bootstrap.tools.stage3_latest_parser import \
-        find_latest_stage3_date
+from directory_bootstrap.tools.stage3_latest_parser import find_latest_stage3
 
-_DEFAULT_MIRROR = 'http://distfiles.gentoo.org/'
 _GPG_DISPLAY_KEY_FORMAT = '0xlong'
 
 _year = '([2-9][0-9]{3})'
@@ -29,6 +32,26 @@ _month = '(0[1-9]|1[0-2])'
 _day = '(0[1-9]|[12][0-9]|3[01])'
 
 _snapshot_date_matcher = re.compile('%s%s%s' % (_year, _month, _day))
+_stage3_compression_matcher_template = 'stage3-%s-%s\\.tar\\.(?P<compression>bz2|xz)(?=")'
+_md5sum_line_matcher = re.compile('^(?P<md5sum>[0-9a-fA-F]{32}) [ *](?P<basename>.+)$')
+
+
+def _move_into_place(abs_source_dir, abs_target_dir):
+    """
+    Moves the content of one directory into another, merging with
+    directories already there (like extraction by tar would)
+    """
+    for basename in sorted(os.listdir(abs_source_dir)):
+        abs_source_path = os.path.join(abs_source_dir, basename)
+        abs_target_path = os.path.join(abs_target_dir, basename)
+        if os.path.isdir(abs_target_path) and not os.path.islink(abs_target_path) \
+                and os.path.isdir(abs_source_path) and not os.path.islink(abs_source_path):
+            _move_into_place(abs_source_path, abs_target_path)
+            continue
+        if os.path.lexists(abs_target_path) and os.path.isdir(abs_target_path) \
+                and not os.path.islink(abs_target_path):
+            shutil.rmtree(abs_target_path)
+        os.rename(abs_source_path, abs_target_path)
 
 
 class _ChecksumVerifiationFailed(Exception):
@@ -48,26 +71,32 @@ class _NotFreshEnoughException(Exception):
 class GentooBootstrapper(DirectoryBootstrapper):
     DISTRO_KEY = 'gentoo'
     DISTRO_NAME_LONG = 'Gentoo'
+    DEFAULT_MIRROR_URL = 'http://distfiles.gentoo.org/'
 
     def __init__(self, messenger, executor, abs_target_dir, abs_cache_dir,
-                architecture, mirror_url, max_age_days,
+                download_config, architecture, mirror_urls, max_age_days,
                 stage3_date_triple_or_none, repository_date_triple_or_none,
-                abs_resolv_conf):
+                abs_resolv_conf, with_portage_squashfs):
         super(GentooBootstrapper, self).__init__(
                 messenger,
                 executor,
                 abs_target_dir,
                 abs_cache_dir,
+                download_config,
                 )
         self._architecture = architecture
         self._architecture_family = self._extract_architecture_family(architecture)
-        self._mirror_base_url = mirror_url.rstrip('/')
+        self._mirror_base_urls = [mirror_url.rstrip('/') for mirror_url in mirror_urls]
         self._max_age_days = max_age_days
         self._stage3_date_triple_or_none = stage3_date_triple_or_none
         self._repository_date_triple_or_none = repository_date_triple_or_none
         self._abs_resolv_conf = abs_resolv_conf
+        self._with_portage_squashfs = with_portage_squashfs
 
         self._gpg_supports_no_autostart = None
+        self._abs_gpg_home_dir = None
+        self._latest_stage3_compression = None
+        self._abs_portage_squashfs_filename = None
 
     @staticmethod
     def _extract_architecture_family(architecture):
@@ -85,58 +114,78 @@ class GentooBootstrapper(DirectoryBootstrapper):
     def get_commands_to_check_for():
         return DirectoryBootstrapper.get_commands_to_check_for() + [
                 COMMAND_GPG,
-                COMMAND_MD5SUM,
-                COMMAND_SHA512SUM,
                 COMMAND_TAR,
-                COMMAND_UNXZ,
+                COMMAND_XZ,
                 ]
 
-    def _get_stage3_latest_file_url(self):
+    def _get_mirror_urls(self, rel_path):
+        return ['%s/%s' % (mirror_base_url, rel_path)
+                for mirror_base_url in self._mirror_base_urls]
+
+    def _get_stage3_latest_file_url(self, mirror_base_url):
         return '%s/releases/%s/autobuilds/latest-stage3.txt' % (
-                self._mirror_base_url,
+                mirror_base_url,
                 self._architecture_family,
                 )
 
-    def _get_portage_snapshot_listing_url(self):
-        return '%s/releases/snapshots/current/' % self._mirror_base_url
+    def _get_stage3_latest_file_urls(self):
+        return [self._get_stage3_latest_file_url(mirror_base_url)
+                for mirror_base_url in self._mirror_base_urls]
+
+    def _get_portage_snapshot_listing_urls(self):
+        return self._get_mirror_urls('releases/snapshots/current/')
+
+    def _get_mirror_probe_url(self, mirror_base_url):
+        # NOTE: Large enough for a throughput sample, unlike latest-stage3.txt
+        return '%s/releases/snapshots/current/portage-latest.tar.xz' % mirror_base_url
+
+    def _rank_mirrors(self):
+        self._mirror_base_urls = self.rank_mirrors(self._mirror_base_urls,
+                self._get_mirror_probe_url)
 
     def _find_latest_snapshot_date(self, snapshot_listing):
         return self.extract_latest_date(snapshot_listing, _snapshot_date_matcher)
 
-    def _download_stage3(self, stage3_date_str):
-        res = [None, None]
-        for target_index, basename in (
-                (1, 'stage3-%s-%s.tar.bz2.DIGESTS.asc' % (self._architecture, stage3_date_str)),
-                (0, 'stage3-%s-%s.tar.bz2' % (self._architecture, stage3_date_str)),
+    def _get_stage3_downloads(self, stage3_date_str, stage3_compression):
+        res = []
+        for basename in (
+                'stage3-%s-%s.tar.%s' % (self._architecture, stage3_date_str, stage3_compression),
+                'stage3-%s-%s.tar.%s.DIGESTS.asc' % (self._architecture, stage3_date_str, stage3_compression),
                 ):
             filename = os.path.join(self._abs_cache_dir, basename)
-            url = '%s/releases/%s/autobuilds/%s/%s' \
-                    % (self._mirror_base_url, self._architecture_family, stage3_date_str, basename)
-            self.download_url_to_file(url, filename)
-
-            assert res[target_index] is None
-            res[target_index] = filename
+            urls = self._get_mirror_urls('releases/%s/autobuilds/%s/%s'
+                    % (self._architecture_family, stage3_date_str, basename))
+            res.append((urls, filename))
 
         return res
 
-    def _download_snapshot(self, snapshot_date_str):
-        res = [None, None, None, None]
-        for target_index, basename in (
-                (1, 'portage-%s.tar.xz.gpgsig' % snapshot_date_str),
-                (2, 'portage-%s.tar.xz.md5sum' % snapshot_date_str),
-                (3, 'portage-%s.tar.xz.umd5sum' % snapshot_date_str),
-                (0, 'portage-%s.tar.xz' % snapshot_date_str),
+    def _get_snapshot_downloads(self, snapshot_date_str):
+        res = []
+        for basename in (
+                'portage-%s.tar.xz' % snapshot_date_str,
+                'portage-%s.tar.xz.gpgsig' % snapshot_date_str,
+                'portage-%s.tar.xz.md5sum' % snapshot_date_str,
+                'portage-%s.tar.xz.umd5sum' % snapshot_date_str,
                 ):
             filename = os.path.join(self._abs_cache_dir, basename)
-            url = '%s/releases/snapshots/current/%s' \
-                    % (self._mirror_base_url, basename)
-            self.download_url_to_file(url, filename)
-
-            assert res[target_index] is None
-            res[target_index] = filename
+            urls = self._get_mirror_urls('releases/snapshots/current/%s' % basename)
+            res.append((urls, filename))
 
         return res
 
+    def _download_snapshot_and_stage3(self, snapshot_date_str, stage3_date_str, stage3_compression):
+        snapshot_downloads = self._get_snapshot_downloads(snapshot_date_str)
+        stage3_downloads = self._get_stage3_downloads(stage3_date_str, stage3_compression)
+
+        # NOTE: Small files first so they do not queue up behind tarballs
+        all_downloads = sorted(snapshot_downloads + stage3_downloads,
+                key=lambda (urls, filename): filename.endswith(('.tar.bz2', '.tar.xz')))
+        self.download_urls_to_files(all_downloads)
+
+        snapshot_files = [filename for urls, filename in snapshot_downloads]
+        stage3_files = [filename for urls, filename in stage3_downloads]
+        return snapshot_files, stage3_files
+
     def _verify_sha512_sum(self, testee_file, digests_file):
         self._messenger.info('Verifying SHA512 checksum of file "%s"...' \
                 % testee_file)
@@ -162,64 +211,141 @@ class GentooBootstrapper(DirectoryBootstrapper):
             raise ValueError('File "%s" does not mention "%s"' \
                     % (digests_file, testee_file_basename))
 
-        expected_sha512sum_output = '%s  %s\n' % (expected_sha512sum, testee_file)
-        sha512sum_output = self._executor.check_output([
-                COMMAND_SHA512SUM,
-                testee_file,
-                ])
-
-        if sha512sum_output != expected_sha512sum_output:
+        if self.get_file_digest(testee_file, 'sha512') != expected_sha512sum.lower():
             raise _ChecksumVerifiationFailed('SHA512', testee_file)
 
+    def _read_md5_sum(self, md5sum_file, testee_file):
+        testee_file_basename = os.path.basename(testee_file)
+        expected_md5sums = []
+        with open(md5sum_file, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                m = _md5sum_line_matcher.match(line.rstrip('\n'))
+                if m is None:
+                    raise ValueError('File "%s" is malformed' % md5sum_file)
+                if m.group('basename') == testee_file_basename:
+                    expected_md5sums.append(m.group('md5sum').lower())
+
+        if len(expected_md5sums) != 1:
+            raise ValueError('File "%s" does not mention "%s" exactly once' \
+                    % (md5sum_file, testee_file_basename))
+
+        return expected_md5sums[0]
+
     def _verify_md5_sum(self, snapshot_tarball, snapshot_md5sum):
         self._messenger.info('Verifying MD5 checksum of file "%s"...' \
                 % snapshot_tarball)
 
-        snapshot_tarball_basename = os.path.basename(snapshot_tarball)
-        needle = snapshot_tarball_basename + '\n'
-        with open(snapshot_md5sum, 'r') as f:
-            if f.read().count(needle) != 1:
-                raise ValueError('File "%s" does not mention "%s" exactly once' \
-                        % (snapshot_md5sum, snapshot_tarball_basename))
+        if self.get_file_digest(snapshot_tarball, 'md5') != self._read_md5_sum(snapshot_md5sum, snapshot_tarball):
+            raise _ChecksumVerifiationFailed('MD5', snapshot_tarball)
 
-        cwd = os.path.dirname(snapshot_md5sum)
-        self._executor.check_call([
-                COMMAND_MD5SUM,
-                '--strict',
-                '--check',
-                snapshot_md5sum,
-                ], cwd=cwd)
+    def _extract_tarball_verifying_md5_sum(self, tarball_filename, abs_target_root, expected_uncompressed_md5sum):
+        """
+        Decompresses and extracts in one go, with no uncompressed copy on disk,
+        checking the MD5 sum of the uncompressed tarball on the fly.
+        Extraction goes to a scratch directory next to the target first,
+        so that content only shows up at the target once verified.
+        """
+        abs_scratch_dir = tempfile.mkdtemp(dir=abs_target_root, prefix='.extracting-')
+        try:
+            md5 = hashlib.md5()
+            extract_compressed_tarball(self._messenger, self._executor,
+                    tarball_filename, abs_scratch_dir, observe=md5.update)
 
-    def _uncompress_tarball(self, tarball_filename):
-        extension = '.xz'
+            self._messenger.info('Verifying MD5 checksum of the content of file "%s"...' % tarball_filename)
+            if md5.hexdigest() != expected_uncompressed_md5sum:
+                raise _ChecksumVerifiationFailed('MD5', tarball_filename[:-len('.xz')])
 
-        if not tarball_filename.endswith(extension):
-            raise ValueError('Filename "%s" does not end with "%s"' % (tarball_filename, extension))
+            _move_into_place(abs_scratch_dir, abs_target_root)
+        finally:
+            shutil.rmtree(abs_scratch_dir)
 
-        uncompressed_tarball_filename = tarball_filename[:-len(extension)]
+    def _extract_stage3_while(self, stage3_tarball, function, args):
+        """
+        Extracts the stage3 in the background while calling function(*args),
+        re-raising the first failure once both have finished.
+        No threads are involved, as process creation from threads
+        is not safe with Python 2.
+        """
+        stage3_extraction = start_extracting_compressed_tarball(self._messenger, self._executor,
+                stage3_tarball, self._abs_target_dir)
+        try:
+            function(*args)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                stage3_extraction.wait()
+            except Exception:
+                pass  # i.e. reporting the first failure only
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        stage3_extraction.wait()
+
+    def _extract_stage3_and_snapshot(self, stage3_tarball, snapshot_tarball,
+            expected_uncompressed_md5sum):
+        """
+        Extracts stage3 and portage snapshot concurrently, as they are
+        independent trees (with the snapshot going to usr/portage/)
+        """
+        abs_snapshot_target_root = os.path.join(self._abs_target_dir, 'usr')
+        if not os.path.exists(abs_snapshot_target_root):
+            # NOTE: Mode and owner get fixed up by extraction of the stage3
+            os.mkdir(abs_snapshot_target_root, 0755)
 
-        if os.path.exists(uncompressed_tarball_filename):
-            self._messenger.info('Re-using cache file "%s".' % uncompressed_tarball_filename)
-        else:
-            self._messenger.info('Uncompressing file "%s"...' % tarball_filename)
-            self._executor.check_call([
-                    COMMAND_UNXZ,
-                    '--keep',
-                    tarball_filename,
-                    ])
+        self._extract_stage3_while(stage3_tarball, self._extract_tarball_verifying_md5_sum,
+                (snapshot_tarball, abs_snapshot_target_root, expected_uncompressed_md5sum))
+
+    def _get_portage_squashfs_filename(self, snapshot_tarball):
+        return os.path.join(self._abs_cache_dir,
+                os.path.basename(snapshot_tarball)[:-len('.tar.xz')] + '.squashfs')
 
-            if not os.path.exists(uncompressed_tarball_filename):
-                raise OSError(errno.ENOENT, 'File "%s" does not exists' % uncompressed_tarball_filename)
+    def _provide_portage_squashfs(self, snapshot_tarball, expected_uncompressed_md5sum):
+        """
+        Converts the snapshot to a squashfs image once, keeping it in the cache
+        """
+        def create_squashfs(partial_filename):
+            abs_tree_root = partial_filename + '.tree'
+            if os.path.exists(abs_tree_root):
+                shutil.rmtree(abs_tree_root)  # i.e. left over from an interrupted run
+            os.mkdir(abs_tree_root, 0755)
+            try:
+                self._extract_tarball_verifying_md5_sum(snapshot_tarball, abs_tree_root,
+                        expected_uncompressed_md5sum)
+                self._messenger.info('Creating squashfs image "%s"...' % partial_filename)
+                self._executor.check_call([
+                        COMMAND_MKSQUASHFS,
+                        os.path.join(abs_tree_root, 'portage'),
+                        partial_filename,
+                        '-noappend',
+                        '-no-progress',
+                        ])
+            finally:
+                shutil.rmtree(abs_tree_root)
+
+        self.provide_cached_file(self._get_portage_squashfs_filename(snapshot_tarball),
+                create_squashfs)
+
+    def get_portage_squashfs_filename(self):
+        """
+        Returns the cached squashfs image of the portage snapshot
+        after a run with one requested, None otherwise
+        """
+        return self._abs_portage_squashfs_filename
 
-        return uncompressed_tarball_filename
+    def _extract_stage3_providing_portage_squashfs(self, stage3_tarball, snapshot_tarball,
+            expected_uncompressed_md5sum):
+        """
+        Extracts the stage3 while (if not cached already) a squashfs image
+        of the portage snapshot is created, leaving usr/portage/ empty
+        for the image to be mounted at
+        """
+        self._extract_stage3_while(stage3_tarball, self._provide_portage_squashfs,
+                (snapshot_tarball, expected_uncompressed_md5sum))
 
-    def _extract_tarball(self, tarball_filename, abs_target_root):
-        self._messenger.info('Extracting file "%s" to "%s"...' % (tarball_filename, abs_target_root))
-        self._executor.check_call([
-                COMMAND_TAR,
-                'xpf',
-                tarball_filename,
-            ], cwd=abs_target_root)
+        abs_portage_dir = os.path.join(self._abs_target_dir, 'usr', 'portage')
+        if not os.path.exists(abs_portage_dir):
+            os.mkdir(abs_portage_dir, 0755)
 
     def _require_fresh_enough(self, (year, month, day)):
         date_to_check = datetime.date(year, month, day)
@@ -271,6 +397,18 @@ class GentooBootstrapper(DirectoryBootstrapper):
             self._gpg_supports_no_autostart = True
             self._messenger.info('Yes, it does.')
 
+    def _get_release_pubring_gpg(self):
+        return resource_filename(resources.__name__, 'pubring.gpg')
+
+    def _get_gpg_home(self, abs_temp_dir):
+        """
+        Initializes the GnuPG home on first use only,
+        so that runs with nothing left to verify need no gpg at all
+        """
+        if self._abs_gpg_home_dir is None:
+            self._abs_gpg_home_dir = self._initialize_gpg_home(abs_temp_dir)
+        return self._abs_gpg_home_dir
+
     def _initialize_gpg_home(self, abs_temp_dir):
         abs_gpg_home_dir = os.path.join(abs_temp_dir, 'gpg_home')
 
@@ -279,7 +417,7 @@ class GentooBootstrapper(DirectoryBootstrapper):
 
         self._check_gpg_for_no_autostart_support(abs_gpg_home_dir)
 
-        release_pubring_gpg = resource_filename(resources.__name__, 'pubring.gpg')
+        release_pubring_gpg = self._get_release_pubring_gpg()
         cmd = self._get_gpg_argv_start(abs_gpg_home_dir) + [
                 '--import', release_pubring_gpg,
             ]
@@ -312,51 +450,118 @@ class GentooBootstrapper(DirectoryBootstrapper):
         if not os.path.exists(output_filename):
             raise OSError(errno.ENOENT, 'File "%s" does not exists' % output_filename)
 
-    def run(self):
-        self.ensure_directories_writable()
+    def _find_latest_stage3_date_str(self):
+        self._messenger.info('Searching for available stage3 tarballs...')
+        stage3_latest_file_urls = self._get_stage3_latest_file_urls()
+        stage3_latest_file_content = self.get_url_content(stage3_latest_file_urls)
+        stage3_date_triple, self._latest_stage3_compression = find_latest_stage3(
+                stage3_latest_file_content, stage3_latest_file_urls[0], self._architecture)
+        stage3_date_str = self._format_date_stage3_tarball_filename(stage3_date_triple)
+        self._messenger.info('Found "%s" to be latest.' % stage3_date_str)
+        self._require_fresh_enough(stage3_date_triple)
+        return stage3_date_str
+
+    def _find_stage3_compression(self, stage3_date_str):
+        """
+        Returns "bz2" or "xz", depending on the stage3 flavour published that day
+        """
+        if self._latest_stage3_compression is not None:
+            return self._latest_stage3_compression
+
+        self._messenger.info('Searching for stage3 tarball of %s...' % stage3_date_str)
+        listing_html = self.get_url_content(self._get_mirror_urls('releases/%s/autobuilds/%s/'
+                % (self._architecture_family, stage3_date_str)))
+        m = re.search(_stage3_compression_matcher_template
+                % (re.escape(self._architecture), stage3_date_str), listing_html)
+        if m is None:
+            raise ValueError('No stage3 tarball for %s found for %s'
+                    % (self._architecture, stage3_date_str))
+        return m.group('compression')
+
+    def _find_latest_snapshot_date_str(self):
+        self._messenger.info('Searching for available portage repository snapshots...')
+        snapshot_listing = self.get_url_content(self._get_portage_snapshot_listing_urls())
+        snapshot_date_str = self._find_latest_snapshot_date(snapshot_listing)
+        self._messenger.info('Found "%s" to be latest.' % snapshot_date_str)
+        self._require_fresh_enough(self._parse_snapshot_listing_date(snapshot_date_str))
+        return snapshot_date_str
+
+    def _fetch_and_verify(self, abs_temp_dir):
+        """
+        Returns the stage3 tarball, the portage snapshot tarball
+        and the expected MD5 sum of the latter uncompressed
+        """
+        self._rank_mirrors()
 
-        abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
-        try:
-            abs_gpg_home_dir = self._initialize_gpg_home(abs_temp_dir)
-
-            if self._stage3_date_triple_or_none is None:
-                self._messenger.info('Searching for available stage3 tarballs...')
-                stage3_latest_file_url = self._get_stage3_latest_file_url()
-                stage3_latest_file_content = self.get_url_content(stage3_latest_file_url)
-                stage3_date_triple = find_latest_stage3_date(stage3_latest_file_content, stage3_latest_file_url, self._architecture)
-                stage3_date_str = self._format_date_stage3_tarball_filename(stage3_date_triple)
-                self._messenger.info('Found "%s" to be latest.' % stage3_date_str)
-                self._require_fresh_enough(stage3_date_triple)
-            else:
-                stage3_date_str = self._format_date_stage3_tarball_filename(self._stage3_date_triple_or_none)
-
-            if self._repository_date_triple_or_none is None:
-                self._messenger.info('Searching for available portage repository snapshots...')
-                snapshot_listing = self.get_url_content(self._get_portage_snapshot_listing_url())
-                snapshot_date_str = self._find_latest_snapshot_date(snapshot_listing)
-                self._messenger.info('Found "%s" to be latest.' % snapshot_date_str)
-                self._require_fresh_enough(self._parse_snapshot_listing_date(snapshot_date_str))
-            else:
-                snapshot_date_str = '%04d%02d%02d' % self._repository_date_triple_or_none
+        if self._stage3_date_triple_or_none is None:
+            stage3_date_str = self.resolve('stage3_date', self._find_latest_stage3_date_str)
+        else:
+            stage3_date_str = self._format_date_stage3_tarball_filename(self._stage3_date_triple_or_none)
+            self.record_resolved('stage3_date', stage3_date_str)
+
+        stage3_compression = self.resolve('stage3_compression',
+                lambda: self._find_stage3_compression(stage3_date_str))
+
+        if self._repository_date_triple_or_none is None:
+            snapshot_date_str = self.resolve('snapshot_date', self._find_latest_snapshot_date_str)
+        else:
+            snapshot_date_str = '%04d%02d%02d' % self._repository_date_triple_or_none
+            self.record_resolved('snapshot_date', snapshot_date_str)
+
+        self._messenger.info('Downloading portage repository snapshot and stage3 tarball...')
+        snapshot_files, stage3_files = self._download_snapshot_and_stage3(
+                snapshot_date_str, stage3_date_str, stage3_compression)
 
-            self._messenger.info('Downloading portage repository snapshot...')
-            snapshot_tarball, snapshot_gpgsig, snapshot_md5sum, snapshot_uncompressed_md5sum \
-                    = self._download_snapshot(snapshot_date_str)
-            self._verify_detachted_gpg_signature(snapshot_tarball, snapshot_gpgsig, abs_gpg_home_dir)
-            self._verify_md5_sum(snapshot_tarball, snapshot_md5sum)
+        snapshot_tarball, snapshot_gpgsig, snapshot_md5sum, snapshot_uncompressed_md5sum \
+                = snapshot_files
+        stage3_tarball, stage3_digests_asc = stage3_files
+        trust_anchor = hash_file(self._get_release_pubring_gpg())['sha256']
 
-            self._messenger.info('Downloading stage3 tarball...')
-            stage3_tarball, stage3_digests_asc \
-                    = self._download_stage3(stage3_date_str)
+        self.verify_memoized('GnuPG verification', [snapshot_tarball, snapshot_gpgsig], trust_anchor,
+                lambda: self._verify_detachted_gpg_signature(snapshot_tarball, snapshot_gpgsig,
+                    self._get_gpg_home(abs_temp_dir)))
+        self._verify_md5_sum(snapshot_tarball, snapshot_md5sum)
+
+        def verify_stage3():
             stage3_digests = os.path.join(abs_temp_dir, os.path.basename(stage3_digests_asc)[:-len('.asc')])
-            self._verify_clearsigned_gpg_signature(stage3_digests_asc, stage3_digests, abs_gpg_home_dir)
+            self._verify_clearsigned_gpg_signature(stage3_digests_asc, stage3_digests,
+                    self._get_gpg_home(abs_temp_dir))
             self._verify_sha512_sum(stage3_tarball, stage3_digests)
 
-            snapshot_tarball_uncompressed = self._uncompress_tarball(snapshot_tarball)
-            self._verify_md5_sum(snapshot_tarball_uncompressed, snapshot_uncompressed_md5sum)
+        self.verify_memoized('GnuPG and SHA512 verification', [stage3_tarball, stage3_digests_asc],
+                trust_anchor, verify_stage3)
+
+        expected_uncompressed_md5sum = self._read_md5_sum(snapshot_uncompressed_md5sum,
+                snapshot_tarball[:-len('.xz')])
+
+        return stage3_tarball, snapshot_tarball, expected_uncompressed_md5sum
+
+    def prefetch(self):
+        self.ensure_cache_directory_writable()
+
+        abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
+        try:
+            self._fetch_and_verify(abs_temp_dir)
+        finally:
+            self._messenger.info('Cleaning up "%s"...' % abs_temp_dir)
+            shutil.rmtree(abs_temp_dir)
+
+    def run(self):
+        self.ensure_directories_writable()
 
-            self._extract_tarball(stage3_tarball, self._abs_target_dir)
-            self._extract_tarball(snapshot_tarball_uncompressed, os.path.join(self._abs_target_dir, 'usr'))
+        abs_temp_dir = os.path.abspath(tempfile.mkdtemp())
+        try:
+            stage3_tarball, snapshot_tarball, expected_uncompressed_md5sum \
+                    = self._fetch_and_verify(abs_temp_dir)
+
+            if self._with_portage_squashfs:
+                self._extract_stage3_providing_portage_squashfs(stage3_tarball,
+                        snapshot_tarball, expected_uncompressed_md5sum)
+                self._abs_portage_squashfs_filename \
+                        = self._get_portage_squashfs_filename(snapshot_tarball)
+            else:
+                self._extract_stage3_and_snapshot(stage3_tarball, snapshot_tarball,
+                        expected_uncompressed_md5sum)
         finally:
             self._messenger.info('Cleaning up "%s"...' % abs_temp_dir)
             shutil.rmtree(abs_temp_dir)
@@ -371,21 +576,25 @@ class GentooBootstrapper(DirectoryBootstrapper):
                 help='date to use portage repository snapshot of (e.g. 2015-05-01, default: latest available)')
         distro.add_argument('--max-age-days', type=int, metavar='DAYS', default=14,
                 help='age in days to tolerate as recent enough (security feature, default: %(default)s days)')
-        distro.add_argument('--mirror', dest='mirror_url', metavar='URL',
-                default=_DEFAULT_MIRROR,
-                help='mirror to use (default: %(default)s)')
+        distro.add_argument('--mirror', dest='mirror_urls', metavar='URL',
+                action='append',
+                help='mirror to use; can be passed several times '
+                    'to have the fastest one picked and fail over to others '
+                    '(default: %s)' % clazz.DEFAULT_MIRROR_URL)
 
     @classmethod
     def create(clazz, messenger, executor, options):
         return clazz(
                 messenger,
                 executor,
-                os.path.abspath(options.target_dir),
+                get_abs_target_dir(options),
                 os.path.abspath(options.cache_dir),
+                DownloadConfig.create(options),
                 options.architecture,
-                options.mirror_url,
+                options.mirror_urls or [clazz.DEFAULT_MIRROR_URL],
                 options.max_age_days,
                 options.stage3_date,
                 options.repository_date,
                 os.path.abspath(options.resolv_conf),
+                False,
                 )
@@ -0,0 +1,71 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import directory_bootstrap.shared.mirrors as mirrors
+from directory_bootstrap.distros.arch import HOST_PACSTRAP_ALWAYS, ArchBootstrapper
+from directory_bootstrap.distros.base import DownloadConfig
+from directory_bootstrap.shared.commands import COMMAND_PACSTRAP
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.test.http_server import HttpServer
+
+_DEAD_MIRROR_URL = 'http://127.0.0.1:1/$repo/os/$arch'
+_DATABASE_PATH = '/extra/os/x86_64/extra.db'
+
+
+class _RecordingExecutor(object):
+    def __init__(self):
+        self.argvs = []
+
+    def check_call(self, argv, env=None, cwd=None):
+        self.argvs.append(argv)
+
+
+class TestArchBootstrapper(TestCase):
+    def setUp(self):
+        self._abs_temp_dir = tempfile.mkdtemp()
+        self._abs_target_dir = os.path.join(self._abs_temp_dir, 'target')
+        os.makedirs(os.path.join(self._abs_target_dir, 'etc/pacman.d'))
+        self._server = HttpServer()
+        self._server.start()
+        self._server.set_document(_DATABASE_PATH, 'x' * mirrors._MIN_THROUGHPUT_SAMPLE_BYTES)
+        self._probe_max_bytes = mirrors._PROBE_MAX_BYTES
+        mirrors._PROBE_MAX_BYTES = mirrors._MIN_THROUGHPUT_SAMPLE_BYTES
+
+    def tearDown(self):
+        mirrors._PROBE_MAX_BYTES = self._probe_max_bytes
+        self._server.stop()
+        shutil.rmtree(self._abs_temp_dir)
+
+    def _create_bootstrapper(self, executor, mirror_urls):
+        download_config = DownloadConfig(1, 1, None, None, 0, None, None, False, False, None)
+        bootstrapper = ArchBootstrapper(Messenger(VERBOSITY_QUIET, False), executor,
+                self._abs_target_dir, os.path.join(self._abs_temp_dir, 'cache'),
+                download_config, 'x86_64', None, mirror_urls,
+                [ArchBootstrapper.DEFAULT_IMAGE_MIRROR_URL], '/etc/resolv.conf',
+                HOST_PACSTRAP_ALWAYS, False)
+        bootstrapper._session_pool = SessionPool(1, trust_env=False)
+        return bootstrapper
+
+    def test_host_pacstrap_uses_ranked_mirrors(self):
+        live_mirror_url = self._server.get_url('/$repo/os/$arch')
+        executor = _RecordingExecutor()
+        bootstrapper = self._create_bootstrapper(executor, [_DEAD_MIRROR_URL, live_mirror_url])
+
+        abs_run_temp_dir = os.path.join(self._abs_temp_dir, 'run')
+        os.mkdir(abs_run_temp_dir)
+        bootstrapper._run_host_pacstrap(abs_run_temp_dir)
+
+        self.assertEquals(len(self._server.get_requests(_DATABASE_PATH)), 1)
+        self.assertTrue(any(argv[0] == COMMAND_PACSTRAP for argv in executor.argvs))
+        with open(os.path.join(self._abs_target_dir, 'etc/pacman.d/mirrorlist')) as f:
+            server_urls = [line.split(' = ', 1)[1].rstrip('\n')
+                    for line in f if line.startswith('Server = ')]
+        self.assertEquals(server_urls, [live_mirror_url, _DEAD_MIRROR_URL])
@@ -0,0 +1,691 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import fcntl
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from directory_bootstrap.shared.byte_size import format_byte_size
+from directory_bootstrap.shared.digests import DIGEST_ALGORITHMS, hash_file
+
+_STORE_DIR = 'store'
+_BLOBS_DIR = 'blobs'
+_INDEX_DIR = 'index'
+_INCOMING_DIR = 'incoming'
+_LOCKS_DIR = 'locks'
+_TREES_DIR = 'trees'
+
+_PARTIAL_SUFFIX = '.part'
+_PARTIAL_TREE_SUFFIX = '.tree'
+_INDEX_SUFFIX = '.json'
+_LOCK_SUFFIX = '.lock'
+_BLOB_LOCK_PREFIX = 'blob-'
+_POOL_LOCK_PREFIX = 'pool-'
+
+# NOTE: Blobs need to be orphaned for a while before removal, so that
+#       runs in the middle of adding them are not affected
+_ORPHAN_BLOB_GRACE_SECONDS = 60 * 60
+
+_artifact_date_matcher = re.compile('([2-9][0-9]{3})\\.?(0[1-9]|1[0-2])\\.?(0[1-9]|[12][0-9]|3[01])')
+
+
+def _ensure_directory(abs_path):
+    try:
+        os.makedirs(abs_path, 0755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _remove_if_exists(abs_path):
+    try:
+        os.remove(abs_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _get_artifact_family(artifact_name):
+    """
+    >>> _get_artifact_family('stage3-amd64-20151001.tar.bz2')
+    'stage3-amd64-*.tar.bz2'
+    >>> _get_artifact_family('archlinux-bootstrap-2016.12.01-x86_64.tar.gz.sig')
+    'archlinux-bootstrap-*-x86_64.tar.gz.sig'
+    """
+    return _artifact_date_matcher.sub('*', artifact_name, count=1)
+
+
+def _get_artifact_recency_key(entry):
+    m = _artifact_date_matcher.search(entry['name'])
+    date_str = ''.join(m.groups()) if m else ''
+    return (date_str, entry['stored'])
+
+
+def _get_artifact_access_time(entry):
+    return entry.get('accessed', entry['stored'])
+
+
+def _get_tree_size(abs_dirname):
+    size_bytes = 0
+    for abs_root, dirnames, basenames in os.walk(abs_dirname):
+        for basename in basenames:
+            size_bytes += os.lstat(os.path.join(abs_root, basename)).st_size
+    return size_bytes
+
+
+def _list_pool_files(abs_pool_dir):
+    """
+    Returns (access time, size, filename) triples of all files in a pool,
+    with access time as the later of atime and mtime, as atime may not
+    be updated on every read (e.g. mount option relatime)
+    """
+    files = []
+    for abs_root, dirnames, basenames in os.walk(abs_pool_dir):
+        for basename in basenames:
+            abs_filename = os.path.join(abs_root, basename)
+            stat_result = os.lstat(abs_filename)
+            files.append((max(stat_result.st_atime, stat_result.st_mtime),
+                    stat_result.st_size, abs_filename))
+    return files
+
+
+class _ArtifactLock(object):
+    """
+    Lock on a single artifact, across processes; exclusive unless
+    acquired as shared (e.g. by several runs using the same artifact)
+    """
+    def __init__(self, abs_lock_filename):
+        self._abs_lock_filename = abs_lock_filename
+        self._file = None
+
+    def acquire(self, blocking=True, shared=False):
+        flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        while True:
+            self._file = open(self._abs_lock_filename, 'w')
+            try:
+                fcntl.flock(self._file.fileno(), flags)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                self.release()
+                return False
+
+            # NOTE: The lock file may have been removed (see remove) while
+            #       waiting, in which case locking it means nothing
+            try:
+                if os.fstat(self._file.fileno()).st_ino == os.stat(self._abs_lock_filename).st_ino:
+                    return True
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.release()
+
+    def remove(self):
+        """
+        Removes the lock file, e.g. along with the artifact it guards.
+        Must only be called while holding the lock exclusively.
+        """
+        _remove_if_exists(self._abs_lock_filename)
+
+    def release(self):
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class ArtifactStore(object):
+    """
+    Content-addressed store of downloaded (and derived) files.
+
+    Files are kept once per SHA-256 digest in blobs/, no matter how many
+    URLs or mirrors they came from.  Artifact names (e.g.
+    "stage3-amd64-20151001.tar.bz2", carrying distro, date and architecture)
+    map to blobs through one small JSON file per artifact in index/,
+    so that concurrent runs sharing a cache directory never write the same file.
+
+    Directory trees derived from an artifact (e.g. an extracted and
+    initialized image) are kept in trees/, for as long as the artifact
+    they were made from stays in the store.
+
+    Other subdirectories of the cache directory (e.g. package caches)
+    are treated as pools of files that can be evicted one by one.
+    Users of a pool hold its lock (see locked_pool) shared.
+    """
+    def __init__(self, abs_cache_dir):
+        abs_store_dir = os.path.join(abs_cache_dir, _STORE_DIR)
+        self._abs_cache_dir = abs_cache_dir
+        self._abs_blobs_dir = os.path.join(abs_store_dir, _BLOBS_DIR)
+        self._abs_index_dir = os.path.join(abs_store_dir, _INDEX_DIR)
+        self._abs_incoming_dir = os.path.join(abs_store_dir, _INCOMING_DIR)
+        self._abs_locks_dir = os.path.join(abs_store_dir, _LOCKS_DIR)
+        self._abs_trees_dir = os.path.join(abs_store_dir, _TREES_DIR)
+
+    def _ensure_directories(self):
+        for abs_path in (
+                self._abs_blobs_dir,
+                self._abs_index_dir,
+                self._abs_incoming_dir,
+                self._abs_locks_dir,
+                self._abs_trees_dir,
+                ):
+            _ensure_directory(abs_path)
+
+    def _get_index_filename(self, artifact_name):
+        return os.path.join(self._abs_index_dir, artifact_name + _INDEX_SUFFIX)
+
+    def get_blob_filename(self, sha256):
+        return os.path.join(self._abs_blobs_dir, sha256[:2], sha256)
+
+    def get_partial_filename(self, artifact_name):
+        self._ensure_directories()
+        return os.path.join(self._abs_incoming_dir, artifact_name + _PARTIAL_SUFFIX)
+
+    def locked(self, artifact_name):
+        self._ensure_directories()
+        return _ArtifactLock(os.path.join(self._abs_locks_dir, artifact_name + _LOCK_SUFFIX))
+
+    def _locked_blob(self, sha256):
+        """
+        Lock held shared for as long as a blob is in use (e.g. extracted from
+        or mounted), no matter under which artifact name
+        """
+        self._ensure_directories()
+        return _ArtifactLock(os.path.join(self._abs_locks_dir,
+                _BLOB_LOCK_PREFIX + sha256 + _LOCK_SUFFIX))
+
+    def locked_pool(self, pool_dirname):
+        """
+        Lock to hold shared while using files of a pool (i.e. a subdirectory
+        of the cache directory, e.g. "pacman"), keeping them from eviction
+        """
+        self._ensure_directories()
+        return _ArtifactLock(os.path.join(self._abs_locks_dir,
+                _POOL_LOCK_PREFIX + pool_dirname + _LOCK_SUFFIX))
+
+    def _write_entry(self, entry):
+        abs_index_filename = self._get_index_filename(entry['name'])
+        fd, abs_temp_filename = tempfile.mkstemp(dir=self._abs_index_dir,
+                prefix='.', suffix=_INDEX_SUFFIX)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(entry, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, abs_index_filename)
+
+    def _read_entry(self, artifact_name):
+        try:
+            with open(self._get_index_filename(artifact_name)) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def lookup(self, artifact_name):
+        """
+        Returns the index entry of an artifact, or None if not in the store
+        """
+        entry = self._read_entry(artifact_name)
+        if entry is None:
+            return None
+
+        if not os.path.exists(self.get_blob_filename(entry['sha256'])):
+            return None
+
+        return entry
+
+    def record_access(self, entry):
+        """
+        Keeps track of use, for least-recently-used eviction
+        """
+        entry['accessed'] = int(time.time())
+        self._write_entry(entry)
+
+    def _read_all_entries(self):
+        try:
+            basenames = os.listdir(self._abs_index_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        entries = []
+        for basename in sorted(basenames):
+            if basename.startswith('.') or not basename.endswith(_INDEX_SUFFIX):
+                continue
+            entry = self._read_entry(basename[:-len(_INDEX_SUFFIX)])
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def get_digest(self, entry, algorithm):
+        """
+        Returns the digest of an artifact, computing it for entries
+        from before digests other than SHA-256 were recorded
+        """
+        if algorithm not in entry:
+            entry.update(hash_file(self.get_blob_filename(entry['sha256'])))
+            self._write_entry(entry)
+        return entry[algorithm]
+
+    def add(self, artifact_name, abs_filename, url=None, digests=None):
+        """
+        Moves the given file into the store, de-duplicating by content.
+        Digests already computed (e.g. while downloading) can be passed
+        to save a pass over the file.
+        """
+        if digests is None:
+            digests = hash_file(abs_filename)
+        sha256 = digests['sha256']
+        abs_blob_filename = self.get_blob_filename(sha256)
+
+        # NOTE: Held until the index entry refers to the blob, so that
+        #       eviction cannot remove a blob we are about to re-use
+        blob_lock = self._locked_blob(sha256)
+        blob_lock.acquire(shared=True)
+        try:
+            if os.path.exists(abs_blob_filename):
+                os.remove(abs_filename)
+                os.utime(abs_blob_filename, None)  # i.e. no longer an old orphan
+            else:
+                _ensure_directory(os.path.dirname(abs_blob_filename))
+                os.chmod(abs_filename, 0444)
+                os.rename(abs_filename, abs_blob_filename)
+
+            entry = self._read_entry(artifact_name)
+            if entry is None or entry['sha256'] != sha256:
+                entry = {
+                    'name': artifact_name,
+                    'sha256': sha256,
+                    'size': os.path.getsize(abs_blob_filename),
+                    'urls': [],
+                    'stored': int(time.time()),
+                }
+            for algorithm in DIGEST_ALGORITHMS:
+                entry[algorithm] = digests[algorithm]
+            entry['accessed'] = int(time.time())
+            if url is not None and url not in entry['urls']:
+                entry['urls'].append(url)
+
+            self._write_entry(entry)
+        finally:
+            blob_lock.release()
+        return entry
+
+    def provide(self, messenger, abs_filename, create_file):
+        """
+        Makes an artifact (named after the basename of abs_filename)
+        available at abs_filename, calling create_file(partial_filename)
+        on cache misses.  create_file may return the URL the file came from
+        and digests of the file, as a pair.
+        Returns the index entry of the artifact and a lock (already acquired,
+        to be released by the caller once done with the file) that keeps
+        the artifact from being evicted.
+        """
+        artifact_name = os.path.basename(abs_filename)
+        with self.locked(artifact_name):
+            entry = self.lookup(artifact_name)
+            if entry is None:
+                partial_filename = self.get_partial_filename(artifact_name)
+                source_url, digests = create_file(partial_filename) or (None, None)
+                entry = self.add(artifact_name, partial_filename, source_url, digests)
+            else:
+                messenger.info('Re-using cache file "%s".' % abs_filename)
+                self.record_access(entry)
+
+            self.link_to(entry, abs_filename)
+
+            # NOTE: Acquired before letting go of the artifact, so that
+            #       there is no moment where eviction could get in between
+            lock = self._locked_blob(entry['sha256'])
+            lock.acquire(shared=True)
+            return entry, lock
+
+    def link_to(self, entry, abs_filename):
+        """
+        Makes a blob available at the given location, through a symlink
+        """
+        abs_blob_filename = self.get_blob_filename(entry['sha256'])
+        link_target = os.path.relpath(abs_blob_filename, os.path.dirname(abs_filename))
+
+        # NOTE: Symlink and rename for atomic replacement of earlier links
+        abs_temp_filename = '%s.%d.link' % (abs_filename, os.getpid())
+        _remove_if_exists(abs_temp_filename)
+        os.symlink(link_target, abs_temp_filename)
+        os.rename(abs_temp_filename, abs_filename)
+
+    def _get_tree_index_filename(self, tree_name):
+        return os.path.join(self._abs_trees_dir, tree_name + _INDEX_SUFFIX)
+
+    def get_tree_dirname(self, tree_name):
+        return os.path.join(self._abs_trees_dir, tree_name)
+
+    def get_partial_tree_dirname(self, tree_name):
+        self._ensure_directories()
+        return os.path.join(self._abs_incoming_dir, tree_name + _PARTIAL_TREE_SUFFIX)
+
+    def _write_tree_entry(self, tree):
+        fd, abs_temp_filename = tempfile.mkstemp(dir=self._abs_trees_dir,
+                prefix='.', suffix=_INDEX_SUFFIX)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(tree, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, self._get_tree_index_filename(tree['name']))
+
+    def _read_all_tree_entries(self):
+        try:
+            basenames = os.listdir(self._abs_trees_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        trees = []
+        for basename in sorted(basenames):
+            if basename.startswith('.') or not basename.endswith(_INDEX_SUFFIX):
+                continue
+            try:
+                with open(os.path.join(self._abs_trees_dir, basename)) as f:
+                    trees.append(json.load(f))
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        return trees
+
+    def lookup_tree(self, tree_name):
+        """
+        Returns the directory of a tree, or None if not in the store
+        """
+        if not os.path.exists(self._get_tree_index_filename(tree_name)):
+            return None
+        return self.get_tree_dirname(tree_name)
+
+    def record_tree_access(self, tree_name):
+        """
+        Keeps track of use of a tree, for least-recently-used eviction
+        """
+        with open(self._get_tree_index_filename(tree_name)) as f:
+            tree = json.load(f)
+        tree['accessed'] = int(time.time())
+        self._write_tree_entry(tree)
+
+    def add_tree(self, tree_name, abs_dirname, source_entry):
+        """
+        Moves the given directory into the store, as derived from
+        the artifact of the given index entry
+        """
+        abs_tree_dirname = self.get_tree_dirname(tree_name)
+        if os.path.exists(abs_tree_dirname):
+            shutil.rmtree(abs_tree_dirname)  # i.e. left over from an interrupted run
+        os.rename(abs_dirname, abs_tree_dirname)
+
+        self._write_tree_entry({
+                'name': tree_name,
+                'source': source_entry['name'],
+                'sha256': source_entry['sha256'],
+                'size': _get_tree_size(abs_tree_dirname),
+                'stored': int(time.time()),
+                })
+
+        return abs_tree_dirname
+
+    def _remove_tree(self, messenger, tree):
+        """
+        Removes a tree unless in use, returns whether it was removed
+        """
+        lock = self.locked(tree['name'])
+        if not lock.acquire(blocking=False):
+            messenger.info('Keeping tree "%s" in cache (in use).' % tree['name'])
+            return False
+
+        try:
+            messenger.info('Removing tree "%s" from cache...' % tree['name'])
+            _remove_if_exists(self._get_tree_index_filename(tree['name']))
+            if os.path.exists(self.get_tree_dirname(tree['name'])):
+                shutil.rmtree(self.get_tree_dirname(tree['name']))
+            lock.remove()
+        finally:
+            lock.release()
+
+        return True
+
+    def _remove_stale_trees(self, messenger):
+        """
+        Removes trees derived from artifacts no longer in the store
+        """
+        for tree in self._read_all_tree_entries():
+            source_entry = self.lookup(tree['source'])
+            if source_entry is not None and source_entry['sha256'] == tree['sha256']:
+                continue
+            self._remove_tree(messenger, tree)
+
+    def _evict(self, messenger, entry):
+        artifact_name = entry['name']
+        lock = self.locked(artifact_name)
+        if not lock.acquire(blocking=False):
+            messenger.info('Keeping "%s" in cache (in use).' % artifact_name)
+            return False
+
+        try:
+            blob_lock = self._locked_blob(entry['sha256'])
+            if not blob_lock.acquire(blocking=False):
+                messenger.info('Keeping "%s" in cache (in use).' % artifact_name)
+                return False
+
+            try:
+                messenger.info('Evicting "%s" (%s) from cache...'
+                        % (artifact_name, format_byte_size(entry['size'])))
+                _remove_if_exists(self._get_index_filename(artifact_name))
+
+                abs_link_filename = os.path.join(self._abs_cache_dir, artifact_name)
+                if os.path.islink(abs_link_filename):
+                    os.remove(abs_link_filename)
+                lock.remove()
+            finally:
+                blob_lock.release()
+        finally:
+            lock.release()
+
+        return True
+
+    def _remove_blob(self, messenger, sha256, blob_lock):
+        """
+        Must only be called while holding blob_lock exclusively
+        """
+        abs_blob_filename = self.get_blob_filename(sha256)
+        if os.path.exists(abs_blob_filename):
+            messenger.info('Removing unreferenced blob "%s" (%s)...'
+                    % (abs_blob_filename, format_byte_size(os.path.getsize(abs_blob_filename))))
+            os.remove(abs_blob_filename)
+        blob_lock.remove()
+
+    def _remove_unreferenced_blob(self, messenger, sha256):
+        """
+        Removes a blob right away once no artifact refers to it anymore,
+        unless in use.  Returns whether it was removed.
+        """
+        blob_lock = self._locked_blob(sha256)
+        if not blob_lock.acquire(blocking=False):
+            messenger.info('Keeping unreferenced blob "%s" (in use).'
+                    % self.get_blob_filename(sha256))
+            return False
+
+        try:
+            # NOTE: Another run may have added an artifact of the same
+            #       content in the meantime (see add)
+            if any(entry['sha256'] == sha256 for entry in self._read_all_entries()):
+                return False
+            self._remove_blob(messenger, sha256, blob_lock)
+        finally:
+            blob_lock.release()
+
+        return True
+
+    def _remove_orphan_blobs(self, messenger, entries):
+        referenced_sha256s = set(entry['sha256'] for entry in entries)
+        now = time.time()
+        try:
+            blob_subdirs = os.listdir(self._abs_blobs_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+
+        for blob_subdir in sorted(blob_subdirs):
+            abs_blob_subdir = os.path.join(self._abs_blobs_dir, blob_subdir)
+            for sha256 in sorted(os.listdir(abs_blob_subdir)):
+                if sha256 in referenced_sha256s:
+                    continue
+                abs_blob_filename = os.path.join(abs_blob_subdir, sha256)
+                if now - os.path.getmtime(abs_blob_filename) < _ORPHAN_BLOB_GRACE_SECONDS:
+                    continue
+
+                blob_lock = self._locked_blob(sha256)
+                if not blob_lock.acquire(blocking=False):
+                    messenger.info('Keeping unreferenced blob "%s" (in use).' % abs_blob_filename)
+                    continue
+
+                try:
+                    self._remove_blob(messenger, sha256, blob_lock)
+                finally:
+                    blob_lock.release()
+
+    def _list_pool_dirnames(self):
+        try:
+            basenames = os.listdir(self._abs_cache_dir)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+
+        return [basename for basename in sorted(basenames)
+                if basename != _STORE_DIR
+                and os.path.isdir(os.path.join(self._abs_cache_dir, basename))
+                and not os.path.islink(os.path.join(self._abs_cache_dir, basename))]
+
+    def _evict_to_fit(self, messenger, entries, pool_locks, max_size_bytes):
+        """
+        Evicts least-recently-used artifacts, trees and files of pools
+        (for those of pool_locks, i.e. not in use) until all of them
+        together fit max_size_bytes.  Returns the entries kept.
+        """
+        references_of_sha256 = {}
+        size_of_sha256 = {}
+        for entry in entries:
+            references_of_sha256[entry['sha256']] = references_of_sha256.get(entry['sha256'], 0) + 1
+            size_of_sha256[entry['sha256']] = entry['size']
+        total_size_bytes = sum(size_of_sha256.values())
+
+        # NOTE: Trees go away with the artifact they were derived from
+        trees_of_sha256 = {}
+        candidates = []
+        for tree in self._read_all_tree_entries():
+            tree.setdefault('size', _get_tree_size(self.get_tree_dirname(tree['name'])))
+            total_size_bytes += tree['size']
+            trees_of_sha256.setdefault(tree['sha256'], []).append(tree)
+            candidates.append((_get_artifact_access_time(tree), 'tree', tree))
+
+        for pool_dirname in self._list_pool_dirnames():
+            for access_time, size_bytes, abs_filename in _list_pool_files(
+                    os.path.join(self._abs_cache_dir, pool_dirname)):
+                total_size_bytes += size_bytes
+                # NOTE: Dot files are incomplete files of runs in progress
+                if pool_dirname in pool_locks and not os.path.basename(abs_filename).startswith('.'):
+                    candidates.append((access_time, 'file', (abs_filename, size_bytes)))
+
+        candidates += [(_get_artifact_access_time(entry), 'artifact', entry) for entry in entries]
+
+        kept_entries = []
+        removed_tree_names = set()
+        for access_time, kind, candidate in sorted(candidates, key=lambda candidate: candidate[0]):
+            if kind == 'artifact':
+                entry = candidate
+                if total_size_bytes <= max_size_bytes or not self._evict(messenger, entry):
+                    kept_entries.append(entry)
+                    continue
+                references_of_sha256[entry['sha256']] -= 1
+                if not references_of_sha256[entry['sha256']]:
+                    # NOTE: Only counting space actually freed
+                    if self._remove_unreferenced_blob(messenger, entry['sha256']):
+                        total_size_bytes -= entry['size']
+                    for tree in trees_of_sha256.get(entry['sha256'], []):
+                        if tree['name'] not in removed_tree_names \
+                                and self._remove_tree(messenger, tree):
+                            removed_tree_names.add(tree['name'])
+                            total_size_bytes -= tree['size']
+            elif total_size_bytes <= max_size_bytes:
+                continue
+            elif kind == 'tree':
+                tree = candidate
+                if tree['name'] not in removed_tree_names and self._remove_tree(messenger, tree):
+                    removed_tree_names.add(tree['name'])
+                    total_size_bytes -= tree['size']
+            else:
+                abs_filename, size_bytes = candidate
+                messenger.info('Evicting "%s" (%s) from cache...'
+                        % (abs_filename, format_byte_size(size_bytes)))
+                _remove_if_exists(abs_filename)
+                total_size_bytes -= size_bytes
+
+        if total_size_bytes > max_size_bytes:
+            messenger.warn('Cache still takes %s, more than the %s requested.'
+                    % (format_byte_size(total_size_bytes), format_byte_size(max_size_bytes)))
+
+        return kept_entries
+
+    def collect_garbage(self, messenger, max_size_bytes=None, keep_last=None):
+        """
+        Applies retention (keep_last artifacts per family, newest by date)
+        and then evicts least-recently-used artifacts, trees and files of
+        pools until the cache directory fits max_size_bytes.
+        Small files directly inside the cache directory (e.g. bookkeeping)
+        do not count.  Anything in use by other runs is skipped.
+        """
+        entries = self._read_all_entries()
+
+        if keep_last is not None:
+            families = {}
+            for entry in entries:
+                families.setdefault(_get_artifact_family(entry['name']), []).append(entry)
+
+            kept_entries = []
+            for family in sorted(families.keys()):
+                family_entries = sorted(families[family], key=_get_artifact_recency_key, reverse=True)
+                kept_entries += family_entries[:keep_last]
+                for entry in family_entries[keep_last:]:
+                    if not self._evict(messenger, entry):
+                        kept_entries.append(entry)
+            entries = kept_entries
+
+        if max_size_bytes is not None:
+            pool_locks = {}
+            try:
+                for pool_dirname in self._list_pool_dirnames():
+                    lock = self.locked_pool(pool_dirname)
+                    if lock.acquire(blocking=False):
+                        pool_locks[pool_dirname] = lock
+                    else:
+                        messenger.info('Keeping files of "%s" in cache (in use).'
+                                % os.path.join(self._abs_cache_dir, pool_dirname))
+                entries = self._evict_to_fit(messenger, entries, pool_locks, max_size_bytes)
+            finally:
+                for lock in pool_locks.values():
+                    lock.release()
+
+        self._remove_stale_trees(messenger)
+        self._remove_orphan_blobs(messenger, entries)
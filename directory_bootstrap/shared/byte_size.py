@@ -3,6 +3,8 @@
 
 from __future__ import print_function
 
+import re
+
 _UNIT_LABELS = (
     'byte',
     'KiB',
@@ -11,6 +13,8 @@ _UNIT_LABELS = (
     'TiB',
 )
 
+_byte_size_matcher = re.compile('^(?P<value>[0-9]+(\\.[0-9]+)?) *(?P<unit>[KMGT]?)(iB|B)?$', re.IGNORECASE)
+
 
 def format_byte_size(size_bytes):
     FACTOR = 1024
@@ -28,3 +32,17 @@ def format_byte_size(size_bytes):
         size_bytes /= float(FACTOR)
     else:
         raise ValueError('Byte size too large to be supported')
+
+
+def parse_byte_size(text):
+    """
+    Parses sizes like "512", "100M", "1.5G" or "2 GiB" (with binary units)
+    """
+    m = _byte_size_matcher.match(text.strip())
+    if m is None:
+        raise ValueError('Not a well-formed byte size: "%s"' % text)
+
+    exponent = ' KMGT'.index(m.group('unit').upper() or ' ')
+    return int(float(m.group('value')) * 1024**exponent)
+
+parse_byte_size.__name__ = 'byte size'
@@ -0,0 +1,453 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import errno
+import hashlib
+import json
+import os
+import re
+import SocketServer
+import tempfile
+import time
+from urlparse import urlsplit
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.artifact_store import ArtifactStore
+from directory_bootstrap.shared.http_sessions import SessionPool
+
+DEFAULT_CACHE_PROXY_HOST = '127.0.0.1'
+DEFAULT_CACHE_PROXY_PORT = 3128
+
+_PROXY_DIR = 'proxy'
+_META_SUFFIX = '.json'
+
+CACHING_IMMUTABLE = 'immutable'
+CACHING_REVALIDATE = 'revalidate'
+
+_HTTP_NOT_MODIFIED = 304
+
+_CONNECT_TIMEOUT_SECONDS = 30
+_READ_TIMEOUT_SECONDS = 60
+_CHUNK_SIZE_BYTES = 64 * 1024
+_CONNECTIONS_PER_HOST = 8
+
+# NOTE: Files with these names never change once published
+#       (packages, Gentoo distfiles, content-addressed metadata)
+_immutable_matcher = re.compile('|'.join((
+        '\\.(deb|udeb|dsc|rpm|drpm)$',  # apt, yum/dnf
+        '\\.pkg\\.tar(\\.[a-z0-9]+)?(\\.sig)?$',  # pacman
+        '/distfiles/(?!layout\\.conf$)[^/]+$',  # Gentoo
+        '/by-hash/[^/]+/[^/]+$',  # apt
+        '/repodata/[0-9a-f]{32,}-[^/]+$',  # yum/dnf
+        '/pool/.+\\.(tar\\.[a-z0-9]+|diff\\.gz)$',  # apt sources
+        )))
+
+# NOTE: Indexes that change in place, to be revalidated on every use
+_revalidate_matcher = re.compile('|'.join((
+        '/dists/.+[^/]$',  # apt
+        '\\.(db|files)(\\.tar\\.[a-z0-9]+)?(\\.sig)?$',  # pacman
+        '/distfiles/layout\\.conf$',  # Gentoo
+        '/repodata/repomd\\.xml(\\.asc|\\.key)?$',  # yum/dnf
+        )))
+
+# NOTE: Headers not to be forwarded, see RFC 2616 section 13.5.1
+_HOP_BY_HOP_HEADERS = frozenset((
+        'connection',
+        'keep-alive',
+        'proxy-authenticate',
+        'proxy-authorization',
+        'proxy-connection',
+        'te',
+        'trailers',
+        'transfer-encoding',
+        'upgrade',
+        ))
+
+_FORWARDED_RESPONSE_HEADERS = (
+        'Accept-Ranges',
+        'Content-Encoding',
+        'Content-Range',
+        'Content-Type',
+        'ETag',
+        'Last-Modified',
+        )
+
+
+def get_caching_policy(url):
+    """
+    Returns CACHING_IMMUTABLE, CACHING_REVALIDATE or None (i.e. do not cache)
+
+    >>> get_caching_policy('http://httpredir.debian.org/debian/pool/main/b/bash/bash_4.3-11+b1_amd64.deb')
+    'immutable'
+    >>> get_caching_policy('http://httpredir.debian.org/debian/dists/jessie/InRelease')
+    'revalidate'
+    >>> get_caching_policy('http://mirror.example.org/archlinux/core/os/x86_64/core.db')
+    'revalidate'
+    >>> get_caching_policy('http://mirror.example.org/archlinux/core/os/x86_64/bash-4.4.005-2-x86_64.pkg.tar.xz')
+    'immutable'
+    >>> get_caching_policy('http://distfiles.gentoo.org/distfiles/bash-4.3.tar.gz')
+    'immutable'
+    >>> get_caching_policy('http://distfiles.gentoo.org/distfiles/layout.conf')
+    'revalidate'
+    >>> get_caching_policy('http://mirror.example.org/fedora/releases/25/Everything/x86_64/os/repodata/repomd.xml')
+    'revalidate'
+    >>> get_caching_policy('http://example.org/index.html') is None
+    True
+    """
+    parts = urlsplit(url)
+    if parts.query or '/../' in parts.path + '/':
+        return None
+    if _immutable_matcher.search(parts.path):
+        return CACHING_IMMUTABLE
+    if _revalidate_matcher.search(parts.path):
+        return CACHING_REVALIDATE
+    return None
+
+
+def _remove_if_exists(abs_path):
+    try:
+        os.remove(abs_path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class _ClientGone(Exception):
+    pass
+
+
+class _UpstreamIncomplete(Exception):
+    pass
+
+
+# NOTE: Anything that can go wrong talking to upstream
+_UPSTREAM_ERRORS = (requests.RequestException, requests.Urllib3Error, _UpstreamIncomplete)
+
+
+def _stream_content(response, write):
+    """
+    Hands response content to write(chunk), as received (i.e. not decoded).
+    Returns the number of bytes, raising _UpstreamIncomplete for
+    content shorter than announced.
+    """
+    size = 0
+    for chunk in response.raw.stream(_CHUNK_SIZE_BYTES, decode_content=False):
+        write(chunk)
+        size += len(chunk)
+
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and int(content_length) != size:
+        raise _UpstreamIncomplete('Content of "%s" ended after %d of %s bytes'
+                % (response.url, size, content_length))
+    return size
+
+
+class _CacheProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # i.e. we report through the messenger instead
+
+    def send_response(self, code, message=None):
+        self._response_started = True
+        BaseHTTPServer.BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def _write(self, data):
+        try:
+            self.wfile.write(data)
+        except IOError as e:
+            raise _ClientGone(e)
+
+    def _send_error_page(self, status_code, text):
+        body = '%s\n' % text
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self._write(body)
+
+    def _get_upstream_request_headers(self, with_client_headers):
+        headers = {}
+        if with_client_headers:
+            for key, value in self.headers.items():
+                if key.lower() not in _HOP_BY_HOP_HEADERS and key.lower() != 'host':
+                    headers[key] = value
+        else:
+            # NOTE: Avoid caching content in encodings not all clients understand
+            headers['Accept-Encoding'] = 'identity'
+        return headers
+
+    def _request_upstream(self, url, headers):
+        session = self.server.session_pool.get_session(url)
+        return session.request(self.command, url, headers=headers, stream=True,
+                allow_redirects=False,
+                timeout=(_CONNECT_TIMEOUT_SECONDS, _READ_TIMEOUT_SECONDS))
+
+    def _send_upstream_headers(self, response):
+        self.send_response(response.status_code)
+        for key in _FORWARDED_RESPONSE_HEADERS + ('Location',):
+            value = response.headers.get(key)
+            if value is not None:
+                self.send_header(key, value)
+
+        content_length = response.headers.get('Content-Length')
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        elif self.command != 'HEAD' and response.status_code != _HTTP_NOT_MODIFIED:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+    def _pass_through(self, url):
+        response = self._request_upstream(url, self._get_upstream_request_headers(True))
+        try:
+            self._send_upstream_headers(response)
+            if self.command != 'HEAD':
+                _stream_content(response, self._write)
+        finally:
+            response.close()
+
+    def _serve_cached(self, entry):
+        self.send_response(200)
+        for key in _FORWARDED_RESPONSE_HEADERS:
+            value = entry['headers'].get(key)
+            if value is not None:
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(entry['size']))
+        self.end_headers()
+
+        if self.command == 'HEAD':
+            return
+
+        with open(self.server.cache.get_content_filename(entry['url']), 'rb') as f:
+            while True:
+                chunk = f.read(_CHUNK_SIZE_BYTES)
+                if not chunk:
+                    break
+                self._write(chunk)
+
+    def _fetch_and_store(self, url, entry):
+        """
+        Fetches from upstream, passing content to the client and
+        into the cache at the same time.  Returns a description
+        of what happened, for the log.
+        """
+        headers = self._get_upstream_request_headers(False)
+        if entry is not None:
+            if entry['headers'].get('ETag'):
+                headers['If-None-Match'] = entry['headers']['ETag']
+            if entry['headers'].get('Last-Modified'):
+                headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        try:
+            response = self._request_upstream(url, headers)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            self._serve_cached(entry)
+            return 'upstream failed (%s), served from cache' % e
+
+        try:
+            if entry is not None and response.status_code == _HTTP_NOT_MODIFIED:
+                self._serve_cached(entry)
+                return 'revalidated, served from cache'
+
+            if response.status_code != 200 or self.command == 'HEAD':
+                self._send_upstream_headers(response)
+                if self.command != 'HEAD':
+                    _stream_content(response, self._write)
+                return 'passed through (%d)' % response.status_code
+
+            self._send_upstream_headers(response)
+            self.server.cache.store(url, response, self._write)
+            return 'fetched and stored'
+        finally:
+            response.close()
+
+    def _handle(self):
+        url = self.path
+        if not url.startswith('http://'):
+            self._send_error_page(400, 'Only proxy requests for http:// URLs are supported')
+            return
+
+        policy = get_caching_policy(url)
+        if policy is None or self.headers.get('Range'):
+            self._pass_through(url)
+            outcome = 'passed through'
+        else:
+            entry = self.server.cache.lookup(url)
+            if entry is not None and policy == CACHING_IMMUTABLE:
+                self._serve_cached(entry)
+                outcome = 'served from cache'
+            else:
+                outcome = self._fetch_and_store(url, entry)
+
+        self.server.messenger.info('%s "%s": %s.' % (self.command, url, outcome))
+
+    def _handle_reporting_errors(self):
+        self._response_started = False
+        try:
+            self._handle()
+        except _ClientGone:
+            self.close_connection = True
+        except _UPSTREAM_ERRORS as e:
+            self.server.messenger.warn('%s "%s" failed: %s' % (self.command, self.path, e))
+            if self._response_started:
+                # NOTE: Too late for an error page, dropping the connection
+                #       is all that tells the client that content is incomplete
+                self.close_connection = True
+                return
+            try:
+                self._send_error_page(502, 'Upstream request failed: %s' % e)
+            except _ClientGone:
+                self.close_connection = True
+
+    do_GET = _handle_reporting_errors
+    do_HEAD = _handle_reporting_errors
+
+    def do_CONNECT(self):
+        self._send_error_page(501, 'Tunneling (e.g. HTTPS) is not supported, use http_proxy only')
+
+
+class _ProxyCache(object):
+    """
+    Stores proxied content and response headers by URL
+    """
+    def __init__(self, abs_cache_dir):
+        self._abs_proxy_dir = os.path.join(abs_cache_dir, _PROXY_DIR)
+
+    def _get_basename(self, url):
+        sha256 = hashlib.sha256(url).hexdigest()
+        return os.path.join(sha256[:2], sha256)
+
+    def get_content_filename(self, url):
+        return os.path.join(self._abs_proxy_dir, self._get_basename(url))
+
+    def _get_meta_filename(self, url):
+        return self.get_content_filename(url) + _META_SUFFIX
+
+    def lookup(self, url):
+        try:
+            with open(self._get_meta_filename(url)) as f:
+                entry = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return None  # i.e. corrupted, fetch again
+
+        try:
+            size = os.path.getsize(self.get_content_filename(url))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        if entry.get('url') != url or entry.get('size') != size:
+            return None
+        return entry
+
+    def store(self, url, response, write):
+        """
+        Hands content to write(chunk) while storing it,
+        committing to the cache only once complete
+        (i.e. not if any of _UPSTREAM_ERRORS is raised)
+        """
+        abs_content_filename = self.get_content_filename(url)
+        abs_dir = os.path.dirname(abs_content_filename)
+        try:
+            os.makedirs(abs_dir, 0755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, abs_temp_filename = tempfile.mkstemp(dir=abs_dir, prefix='.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                os.fchmod(f.fileno(), 0644)
+
+                def write_and_store(chunk):
+                    f.write(chunk)
+                    write(chunk)
+
+                size = _stream_content(response, write_and_store)
+
+            os.rename(abs_temp_filename, abs_content_filename)
+        finally:
+            _remove_if_exists(abs_temp_filename)
+
+        entry = {
+            'url': url,
+            'size': size,
+            'stored': int(time.time()),
+            'headers': dict((key, response.headers[key])
+                    for key in _FORWARDED_RESPONSE_HEADERS
+                    if key in response.headers and key != 'Content-Range'),
+        }
+        fd, abs_temp_filename = tempfile.mkstemp(dir=abs_dir, prefix='.', suffix=_META_SUFFIX)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(entry, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, self._get_meta_filename(url))
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class CacheProxy(object):
+    """
+    Caching forward HTTP proxy for package downloads.
+
+    Knows the repository layouts of apt, pacman, Gentoo distfiles
+    and yum/dnf: packages (and other files that never change once published)
+    are served from cache forever, indexes are revalidated with upstream
+    on every request and served from cache if unchanged (or upstream is down).
+    Anything else is passed through.
+    """
+    def __init__(self, messenger, abs_cache_dir, host, port):
+        self._messenger = messenger
+        self._server = _ThreadingHTTPServer((host, port), _CacheProxyRequestHandler)
+        self._server.messenger = messenger
+        self._server.cache = _ProxyCache(abs_cache_dir)
+        self._cache_lock = ArtifactStore(abs_cache_dir).locked_pool(_PROXY_DIR)
+
+        # NOTE: Ignoring http_proxy of the environment avoids proxying to ourselves
+        self._server.session_pool = SessionPool(_CONNECTIONS_PER_HOST, trust_env=False)
+
+    def get_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%d/' % (host, port)
+
+    def shutdown(self):
+        """
+        Makes serve_forever return, e.g. from another thread
+        """
+        self._server.shutdown()
+
+    def serve_forever(self):
+        self._messenger.info('Serving caching HTTP proxy at "%s", '
+                'press Ctrl+C to stop...' % self.get_url())
+        # NOTE: Keeps cached content from eviction by concurrent cache clean-up
+        self._cache_lock.acquire(shared=True)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._cache_lock.release()
+
+
+def route_through_http_proxy(messenger, proxy_url):
+    """
+    Makes all child processes (debootstrap, pacstrap, emerge, yum, ...)
+    send plain HTTP requests through the given proxy
+    """
+    messenger.info('Routing HTTP downloads through proxy "%s"...' % proxy_url)
+    os.environ['http_proxy'] = proxy_url
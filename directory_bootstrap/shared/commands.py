@@ -8,6 +8,7 @@ import time
 
 COMMAND_BLKID = 'blkid'
 COMMAND_BLOCKDEV = 'blockdev'
+COMMAND_BZIP2 = 'bzip2'
 COMMAND_CHMOD = 'chmod'
 COMMAND_CHROOT = 'chroot'
 COMMAND_CP = 'cp'
@@ -16,15 +17,22 @@ COMMAND_EXTLINUX = 'extlinux'
 COMMAND_FILE = 'file'
 COMMAND_FIND = 'find'
 COMMAND_GPG = 'gpg'
+COMMAND_GZIP = 'gzip'
 COMMAND_INSTALL_MBR = 'install-mbr'
 COMMAND_KPARTX = 'kpartx'
+COMMAND_LBZIP2 = 'lbzip2'
 COMMAND_LSB_RELEASE = 'lsb_release'
 COMMAND_MD5SUM = 'md5sum'
 COMMAND_MKDIR = 'mkdir'
 COMMAND_MKFS_EXT4 = 'mkfs.ext4'
+COMMAND_MKSQUASHFS = 'mksquashfs'
 COMMAND_MOUNT = 'mount'
+COMMAND_PACMAN_KEY = 'pacman-key'
+COMMAND_PACSTRAP = 'pacstrap'
 COMMAND_PARTED = 'parted'
 COMMAND_PARTPROBE = 'partprobe'
+COMMAND_PBZIP2 = 'pbzip2'
+COMMAND_PIGZ = 'pigz'
 COMMAND_RM = 'rm'
 COMMAND_RMDIR = 'rmdir'
 COMMAND_RPM = 'rpm'
@@ -37,7 +45,9 @@ COMMAND_UNAME = 'uname'
 COMMAND_UNSHARE = 'unshare'
 COMMAND_UNXZ = 'unxz'
 COMMAND_WGET = 'wget'
+COMMAND_XZ = 'xz'
 COMMAND_YUM = 'yum'
+COMMAND_ZSTD = 'zstd'
 
 
 EXIT_COMMAND_NOT_FOUND = 127
@@ -0,0 +1,84 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+from directory_bootstrap.shared.commands import (
+        COMMAND_BZIP2, COMMAND_GZIP, COMMAND_LBZIP2, COMMAND_PBZIP2,
+        COMMAND_PIGZ, COMMAND_TAR, COMMAND_XZ, COMMAND_ZSTD,
+        EXIT_COMMAND_NOT_FOUND, find_command)
+
+# NOTE: Parallel implementations first, classic single-threaded ones last
+_DECOMPRESSORS_OF_EXTENSION = (
+    ('.bz2', (
+        [COMMAND_LBZIP2, '-d', '-c'],
+        [COMMAND_PBZIP2, '-d', '-c'],
+        [COMMAND_BZIP2, '-d', '-c'],
+    )),
+    ('.gz', (
+        [COMMAND_PIGZ, '-d', '-c'],
+        [COMMAND_GZIP, '-d', '-c'],
+    )),
+    ('.xz', (
+        # NOTE: Multi-block files (e.g. made by pixz) decompress in parallel with xz >=5.4
+        [COMMAND_XZ, '-d', '-c', '-T0'],
+    )),
+    ('.zst', (
+        [COMMAND_ZSTD, '-d', '-c'],
+    )),
+)
+
+
+def get_decompression_argv(filename):
+    """
+    Returns argv of a command writing the decompressed content of the
+    given file to stdout, preferring parallel decompressors if installed
+    """
+    for extension, argvs in _DECOMPRESSORS_OF_EXTENSION:
+        if not filename.endswith(extension):
+            continue
+        for argv in argvs:
+            try:
+                find_command(argv[0])
+            except OSError as e:
+                if e.errno != EXIT_COMMAND_NOT_FOUND:
+                    raise
+                continue
+            return argv + [filename]
+        raise OSError(EXIT_COMMAND_NOT_FOUND, 'None of commands %s found in PATH.'
+                % ', '.join('"%s"' % argv[0] for argv in argvs))
+    raise ValueError('File "%s" is not compressed in a supported format' % filename)
+
+
+def start_extracting_compressed_tarball(messenger, executor, tarball_filename, abs_target_root,
+        observe=None, member=None):
+    """
+    Starts decompression and extraction in one go, with decompressed content
+    passing by observe(chunk) (if given) on its way to tar.
+    Returns a pipe (see Executor.start_pipe) to call wait() on.
+
+    With member given, only that one file is extracted and reading
+    stops once it has been found.
+    """
+    if member is None:
+        messenger.info('Extracting file "%s" to "%s"...' % (tarball_filename, abs_target_root))
+        member_args = []
+    else:
+        messenger.info('Extracting "%s" from file "%s" to "%s"...'
+                % (member, tarball_filename, abs_target_root))
+        member_args = ['--occurrence=1', member]
+
+    return executor.start_pipe(get_decompression_argv(tarball_filename), [
+            COMMAND_TAR,
+            'xpf',
+            '-',
+        ] + member_args, observe=observe, cwd=abs_target_root)
+
+
+def extract_compressed_tarball(messenger, executor, tarball_filename, abs_target_root,
+        observe=None, member=None):
+    """
+    Decompresses and extracts in one go, see start_extracting_compressed_tarball
+    """
+    start_extracting_compressed_tarball(messenger, executor, tarball_filename,
+            abs_target_root, observe, member).wait()
@@ -0,0 +1,62 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import hashlib
+
+DIGEST_ALGORITHMS = ('md5', 'sha256', 'sha512')
+
+_HASH_CHUNK_SIZE_BYTES = 1024 * 1024
+
+
+class MultiHasher(object):
+    """
+    Computes all digests of DIGEST_ALGORITHMS in a single pass
+
+    >>> hasher = MultiHasher()
+    >>> hasher.update('abc')
+    >>> hasher.hexdigests()['md5']
+    '900150983cd24fb0d6963f7d28e17f72'
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._hashes = dict((algorithm, hashlib.new(algorithm))
+                for algorithm in DIGEST_ALGORITHMS)
+        self.byte_count = 0
+
+    def update(self, data):
+        for h in self._hashes.values():
+            h.update(data)
+        self.byte_count += len(data)
+
+    def update_from_file(self, abs_filename, max_byte_count=None):
+        """
+        Continues with content of the given file from where hashing
+        left off (i.e. at offset byte_count), up to max_byte_count
+        """
+        with open(abs_filename, 'rb') as f:
+            f.seek(self.byte_count)
+            while max_byte_count is None or self.byte_count < max_byte_count:
+                chunk_size = _HASH_CHUNK_SIZE_BYTES
+                if max_byte_count is not None:
+                    chunk_size = min(chunk_size, max_byte_count - self.byte_count)
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                self.update(chunk)
+
+    def hexdigests(self):
+        return dict((algorithm, h.hexdigest())
+                for algorithm, h in self._hashes.items())
+
+
+def hash_file(abs_filename):
+    """
+    Returns a dict of digests (by algorithm name) of the given file
+    """
+    hasher = MultiHasher()
+    hasher.update_from_file(abs_filename)
+    return hasher.hexdigests()
@@ -0,0 +1,154 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+from directory_bootstrap.shared.byte_size import format_byte_size
+from directory_bootstrap.shared.mirrors import get_mirror_key
+
+# NOTE: Minimum throughput is taken over windows of this length, per connection
+_THROUGHPUT_SAMPLE_SECONDS = 5
+
+# NOTE: Shorter windows at the end of a transfer say little
+_MIN_FINAL_SAMPLE_SECONDS = 1
+
+
+class ThroughputSampler(object):
+    """
+    Feeds the throughput of one connection to DownloadStats,
+    one sampling window at a time
+    """
+    def __init__(self, stats):
+        self._stats = stats
+        self._window_start_time = time.time()
+        self._window_bytes = 0
+
+    def add(self, byte_count):
+        self._window_bytes += byte_count
+        seconds = time.time() - self._window_start_time
+        if seconds >= _THROUGHPUT_SAMPLE_SECONDS:
+            self._stats.record_throughput_sample(self._window_bytes / seconds)
+            self._window_start_time += seconds
+            self._window_bytes = 0
+
+    def close(self):
+        """
+        Samples what is left at the end of a transfer, e.g. a stall
+        """
+        seconds = time.time() - self._window_start_time
+        if seconds >= _MIN_FINAL_SAMPLE_SECONDS:
+            self._stats.record_throughput_sample(self._window_bytes / seconds)
+
+
+class DownloadStats(object):
+    """
+    Telemetry of a single download (or cache hit):
+    bytes per mirror, duration, time to first byte,
+    average and minimum throughput, retries and failovers
+    """
+    def __init__(self, artifact_name):
+        self._lock = threading.Lock()
+        self.artifact_name = artifact_name
+        self.cached = False
+        self.url = None
+        self.segments = 1
+        self.retries = 0
+        self.started = time.time()
+        self.finished = None
+        self.first_byte_seconds = None
+        self.min_bytes_per_second = None
+        self.bytes_of_mirror = {}
+        self.failures_of_mirror = {}
+
+    def record_response(self, seconds):
+        with self._lock:
+            if self.first_byte_seconds is None:
+                self.first_byte_seconds = seconds
+
+    def record_bytes(self, url, byte_count):
+        mirror_key = get_mirror_key(url)
+        with self._lock:
+            self.bytes_of_mirror[mirror_key] = self.bytes_of_mirror.get(mirror_key, 0) + byte_count
+
+    def record_throughput_sample(self, bytes_per_second):
+        with self._lock:
+            if self.min_bytes_per_second is None or bytes_per_second < self.min_bytes_per_second:
+                self.min_bytes_per_second = bytes_per_second
+
+    def record_retry(self, url):
+        mirror_key = get_mirror_key(url)
+        with self._lock:
+            self.retries += 1
+            self.failures_of_mirror[mirror_key] = self.failures_of_mirror.get(mirror_key, 0) + 1
+
+    def finish(self, url, cached=False):
+        self.url = url
+        self.cached = cached
+        self.finished = time.time()
+
+    @property
+    def byte_count(self):
+        return sum(self.bytes_of_mirror.values())
+
+    @property
+    def seconds(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def bytes_per_second(self):
+        return self.byte_count / max(self.seconds, 0.001)
+
+    def describe(self):
+        if self.cached:
+            return 'Took "%s" from cache.' % self.artifact_name
+
+        details = [
+                '%s in %.1f seconds' % (format_byte_size(self.byte_count), self.seconds),
+                '%s/s on average' % format_byte_size(self.bytes_per_second),
+                ]
+        if self.min_bytes_per_second is not None:
+            details.append('%s/s at least' % format_byte_size(self.min_bytes_per_second))
+        if self.first_byte_seconds is not None:
+            details.append('first byte after %.2f seconds' % self.first_byte_seconds)
+        if self.segments > 1:
+            details.append('%d segments' % self.segments)
+        if self.retries:
+            details.append('%d retries' % self.retries)
+        return 'Downloaded "%s" from "%s" (%s).' % (self.artifact_name, self.url, ', '.join(details))
+
+    def to_dict(self):
+        return {
+            'artifact': self.artifact_name,
+            'cached': self.cached,
+            'url': self.url,
+            'bytes': self.byte_count,
+            'seconds': round(self.seconds, 3),
+            'bytes_per_second': int(self.bytes_per_second),
+            'min_bytes_per_second': None if self.min_bytes_per_second is None
+                    else int(self.min_bytes_per_second),
+            'first_byte_seconds': None if self.first_byte_seconds is None
+                    else round(self.first_byte_seconds, 3),
+            'segments': self.segments,
+            'retries': self.retries,
+            'bytes_of_mirror': self.bytes_of_mirror,
+            'failures_of_mirror': self.failures_of_mirror,
+        }
+
+
+def write_download_summary(abs_filename, download_stats_list):
+    downloads = [stats.to_dict() for stats in download_stats_list]
+    content = {
+        'downloads': downloads,
+        'total_bytes': sum(download['bytes'] for download in downloads),
+        'cache_hits': len([download for download in downloads if download['cached']]),
+    }
+    abs_temp_filename = '%s.%d.tmp' % (abs_filename, os.getpid())
+    with open(abs_temp_filename, 'w') as f:
+        json.dump(content, f, indent=4, separators=(',', ': '), sort_keys=True)
+        print(file=f)
+    os.rename(abs_temp_filename, abs_filename)
@@ -0,0 +1,395 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import json
+import os
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.digests import MultiHasher
+from directory_bootstrap.shared.download_stats import ThroughputSampler
+
+_HTTP_PARTIAL_CONTENT = 206
+_HTTP_RANGE_NOT_SATISFIABLE = 416
+
+_CONNECT_TIMEOUT_SECONDS = 30
+_STALL_TIMEOUT_SECONDS = 60
+
+# NOTE: Like curl's --speed-limit and --speed-time
+_LOW_SPEED_LIMIT_BYTES_PER_SECOND = 1024
+_LOW_SPEED_TIME_SECONDS = 60
+
+_CHUNK_SIZE_BYTES = 64 * 1024
+
+# NOTE: Below this size, extra connections cost more than they bring
+_SEGMENTED_DOWNLOAD_MIN_BYTES = 16 * 1024 * 1024
+
+_SEGMENTS_SUFFIX = '.segments'
+
+# NOTE: How often segment progress is saved for resuming in later runs
+_SEGMENT_STATE_SAVE_INTERVAL_BYTES = 8 * 1024 * 1024
+
+# NOTE: Waiting with a timeout keeps KeyboardInterrupt deliverable in Python 2
+_SEGMENT_WAIT_TIMEOUT_SECONDS = 365 * 24 * 60 * 60
+
+_content_range_total_matcher = re.compile('^bytes (?:\\*|[0-9]+-[0-9]+)/([0-9]+)$')
+
+_REQUEST_HEADERS = {
+    # NOTE: Avoid transparent decompression of e.g. .tar.gz files
+    'Accept-Encoding': 'identity',
+}
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _TooSlow(DownloadError):
+    pass
+
+
+class _Incomplete(DownloadError):
+    pass
+
+
+class _Changed(DownloadError):
+    pass
+
+
+def _split_into_segments(size, segment_count):
+    """
+    Returns [first byte, last byte, bytes received] triples
+
+    >>> _split_into_segments(10, 3)
+    [[0, 3, 0], [4, 7, 0], [8, 9, 0]]
+    """
+    segment_size = (size + segment_count - 1) // segment_count
+    return [[start, min(start + segment_size, size) - 1, 0]
+            for start in range(0, size, segment_size)]
+
+
+def _get_content_range_total(response):
+    m = _content_range_total_matcher.match(response.headers.get('Content-Range', ''))
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
+def _write_fully(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class Downloader(object):
+    """
+    Downloads files in-process over the connections of a SessionPool.
+
+    Files are written to a partial file that later attempts continue
+    from using HTTP Range requests.  Connections without progress, or
+    slower than a minimum rate for a while, are dropped and re-tried.
+
+    Large files can be downloaded in segments, over several connections
+    to one or more mirrors at once.
+    """
+    def __init__(self, messenger, session_pool, retry_wait_seconds):
+        self._messenger = messenger
+        self._session_pool = session_pool
+        self._retry_wait_seconds = retry_wait_seconds
+
+    def _get(self, url, extra_headers, stats):
+        headers = dict(_REQUEST_HEADERS)
+        headers.update(extra_headers)
+        session = self._session_pool.get_session(url)
+        before = time.time()
+        response = session.get(url, headers=headers, stream=True,
+                timeout=(_CONNECT_TIMEOUT_SECONDS, _STALL_TIMEOUT_SECONDS))
+        stats.record_response(time.time() - before)
+        return response
+
+    def _transfer(self, response, url, write, stats):
+        """
+        Hands response content to write(chunk), dropping transfers
+        that stay below the minimum rate for too long
+        """
+        received_bytes = 0
+        window_start_time = time.time()
+        window_start_bytes = 0
+        throughput_sampler = ThroughputSampler(stats)
+        try:
+            for chunk in response.iter_content(_CHUNK_SIZE_BYTES):
+                write(chunk)
+                received_bytes += len(chunk)
+                stats.record_bytes(url, len(chunk))
+                throughput_sampler.add(len(chunk))
+
+                now = time.time()
+                if now - window_start_time >= _LOW_SPEED_TIME_SECONDS:
+                    rate = (received_bytes - window_start_bytes) / (now - window_start_time)
+                    if rate < _LOW_SPEED_LIMIT_BYTES_PER_SECOND:
+                        raise _TooSlow('Transfer of "%s" too slow (%d bytes per second)'
+                                % (url, rate))
+                    window_start_time = now
+                    window_start_bytes = received_bytes
+        finally:
+            throughput_sampler.close()
+        return received_bytes
+
+    def _download_once(self, url, partial_filename, segmentable, hasher, stats):
+        """
+        Returns the size of the file, without downloading anything,
+        if segmentable and found to be worth segmenting; None otherwise.
+        Content is fed to hasher as it arrives.
+        """
+        offset = os.path.getsize(partial_filename) if os.path.exists(partial_filename) else 0
+
+        response = self._get(url, {'Range': 'bytes=%d-' % offset} if offset else {}, stats)
+        try:
+            if offset and response.status_code == _HTTP_RANGE_NOT_SATISFIABLE:
+                if _get_content_range_total(response) == offset:
+                    response.close()
+                    return  # i.e. complete already
+                offset = 0
+                os.remove(partial_filename)
+                raise _Incomplete('Partial file of "%s" could not be continued' % url)
+
+            response.raise_for_status()
+
+            if response.status_code != _HTTP_PARTIAL_CONTENT:
+                offset = 0  # i.e. server ignored our Range header
+
+            content_length = response.headers.get('Content-Length')
+            expected_bytes = int(content_length) if content_length else None
+
+            if segmentable and not offset and expected_bytes is not None \
+                    and expected_bytes >= _SEGMENTED_DOWNLOAD_MIN_BYTES \
+                    and response.headers.get('Accept-Ranges') == 'bytes':
+                response.close()
+                return expected_bytes
+
+            if hasher.byte_count != offset:
+                hasher.reset()
+                if offset:
+                    hasher.update_from_file(partial_filename, offset)
+
+            with open(partial_filename, 'ab' if offset else 'wb') as f:
+                def write(chunk):
+                    f.write(chunk)
+                    hasher.update(chunk)
+
+                received_bytes = self._transfer(response, url, write, stats)
+        except:
+            response.close()
+            raise
+
+        if expected_bytes is not None and received_bytes != expected_bytes:
+            raise _Incomplete('Transfer of "%s" ended after %d of %d bytes'
+                    % (url, received_bytes, expected_bytes))
+
+    def _retry(self, action, get_url, description, attempts, stats, retry_client_errors=False):
+        """
+        Calls action(attempt) until it succeeds, with get_url(attempt)
+        telling the URL used, for the record
+        """
+        for attempt in range(1, attempts + 1):
+            try:
+                return action(attempt)
+            except (requests.RequestException, DownloadError) as e:
+                if isinstance(e, requests.HTTPError) and e.response is not None \
+                        and e.response.status_code < 500 and not retry_client_errors:
+                    raise  # i.e. retrying would not help
+                if attempt == attempts:
+                    raise
+                stats.record_retry(get_url(attempt))
+                self._messenger.warn('%s failed (%s), resuming in %d seconds (attempt %d of %d)...'
+                        % (description, e, self._retry_wait_seconds, attempt + 1, attempts))
+                time.sleep(self._retry_wait_seconds)
+
+    def _load_segments(self, state_filename):
+        """
+        Returns (size, segments) of an earlier segmented download,
+        or None if there is none
+        """
+        try:
+            with open(state_filename) as f:
+                state = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return None  # i.e. corrupted, start over
+
+        return state['size'], state['segments']
+
+    def _save_segments(self, state_filename, size, segments):
+        abs_temp_filename = '%s.%d.tmp' % (state_filename, os.getpid())
+        with open(abs_temp_filename, 'w') as f:
+            json.dump({'size': size, 'segments': segments}, f)
+        os.rename(abs_temp_filename, state_filename)
+
+    def _download_segment_once(self, url, partial_filename, size, segment, save_progress,
+            hash_in_order, stats):
+        first_byte, last_byte, received_bytes = segment
+        if first_byte + received_bytes > last_byte:
+            return
+
+        response = self._get(url, {'Range': 'bytes=%d-%d' % (first_byte + received_bytes, last_byte)},
+                stats)
+        try:
+            response.raise_for_status()
+            if response.status_code != _HTTP_PARTIAL_CONTENT:
+                raise DownloadError('Server of "%s" ignored range request' % url)
+            if _get_content_range_total(response) != size:
+                raise _Changed('File at "%s" no longer is %d bytes in size' % (url, size))
+
+            fd = os.open(partial_filename, os.O_WRONLY)
+            try:
+                os.lseek(fd, first_byte + received_bytes, os.SEEK_SET)
+                progress = {'unsaved_bytes': 0}
+
+                def write(chunk):
+                    _write_fully(fd, chunk)
+                    segment[2] += len(chunk)
+                    hash_in_order(first_byte + segment[2] - len(chunk), chunk)
+                    progress['unsaved_bytes'] += len(chunk)
+                    if progress['unsaved_bytes'] >= _SEGMENT_STATE_SAVE_INTERVAL_BYTES:
+                        save_progress()
+                        progress['unsaved_bytes'] = 0
+
+                self._transfer(response, url, write, stats)
+            finally:
+                os.close(fd)
+        except:
+            response.close()
+            raise
+
+        if segment[0] + segment[2] <= segment[1]:
+            raise _Incomplete('Transfer of segment %d-%d of "%s" ended after %d bytes'
+                    % (segment[0], segment[1], url, segment[2]))
+
+    def _download_segmented(self, urls, partial_filename, state_filename,
+            size, segments, attempts, hasher, stats):
+        """
+        Feeds hasher in order as the contiguous prefix of the file grows:
+        content arriving right at the end of that prefix is hashed inline,
+        anything else is read back once all segments before it are done.
+        """
+        state_lock = threading.Lock()
+        hash_lock = threading.Lock()
+
+        def save_progress():
+            with state_lock:
+                self._save_segments(state_filename, size, segments)
+
+        def hash_in_order(offset, chunk):
+            # NOTE: Checked before locking so that only the segment
+            #       at the end of the prefix ever waits for the lock
+            if offset != hasher.byte_count:
+                return
+            with hash_lock:
+                if offset == hasher.byte_count:
+                    hasher.update(chunk)
+
+        def catch_up():
+            with hash_lock:
+                for segment in segments:
+                    if hasher.byte_count > segment[1]:
+                        continue
+                    # NOTE: Looping as the segment may still be growing, so that
+                    #       its upcoming content lines up for hashing inline
+                    while hasher.byte_count < segment[0] + segment[2]:
+                        hasher.update_from_file(partial_filename, segment[0] + segment[2])
+                    if segment[0] + segment[2] <= segment[1]:
+                        break  # i.e. segment incomplete
+
+        def download_segment(index):
+            segment = segments[index]
+            get_url = lambda attempt: urls[(index + attempt - 1) % len(urls)]
+            self._retry(lambda attempt: self._download_segment_once(
+                        get_url(attempt),
+                        partial_filename, size, segment, save_progress, hash_in_order, stats),
+                    get_url,
+                    'Downloading segment %d of %d of "%s"' % (index + 1, len(segments), urls[0]),
+                    attempts, stats,
+                    retry_client_errors=len(urls) > 1)  # i.e. with other mirrors
+            catch_up()
+
+        hasher.reset()
+        catch_up()  # i.e. content from an earlier run
+        save_progress()
+        pool = ThreadPool(len(segments))
+        try:
+            pool.map_async(download_segment, range(len(segments))) \
+                    .get(_SEGMENT_WAIT_TIMEOUT_SECONDS)
+        except _Changed:
+            # NOTE: Segments still running must be done writing (and saving progress)
+            #       before removal, or they would bring back a stale partial file
+            pool.close()
+            pool.join()
+            # NOTE: Start over next time rather than mixing versions of the file
+            os.remove(partial_filename)
+            os.remove(state_filename)
+            raise
+        except:
+            pool.close()
+            pool.join()
+            save_progress()
+            raise
+
+        pool.close()
+        pool.join()
+        os.remove(state_filename)
+
+    def _finish_digests(self, hasher, partial_filename):
+        """
+        Covers what could not be hashed on arrival, if anything
+        (e.g. a partial file found complete already)
+        """
+        if hasher.byte_count != os.path.getsize(partial_filename):
+            hasher.reset()
+            hasher.update_from_file(partial_filename)
+        return hasher.hexdigests()
+
+    def download(self, urls, partial_filename, attempts, stats, segment_count=1):
+        """
+        Downloads from urls[0].  With segment_count above one,
+        large files are downloaded in byte ranges instead,
+        concurrently and spread over all of urls (i.e. mirrors),
+        into a preallocated partial file.
+        Failed segments are retried with the next mirror in turn.
+
+        Returns digests of the file, computed while downloading
+        where possible.  Telemetry goes to stats (a DownloadStats).
+        """
+        hasher = MultiHasher()
+        state_filename = partial_filename + _SEGMENTS_SUFFIX
+        previous_state = self._load_segments(state_filename)
+        if previous_state is not None and os.path.exists(partial_filename):
+            size, segments = previous_state
+            self._messenger.info('Resuming download of "%s" in %d segments...'
+                    % (urls[0], len(segments)))
+        else:
+            size = self._retry(lambda attempt: self._download_once(
+                        urls[0], partial_filename, segment_count > 1, hasher, stats),
+                    lambda attempt: urls[0],
+                    'Downloading "%s"' % urls[0], attempts, stats)
+            if size is None:
+                return self._finish_digests(hasher, partial_filename)
+
+            self._messenger.info('Downloading "%s" in %d segments...'
+                    % (urls[0], segment_count))
+            segments = _split_into_segments(size, segment_count)
+            with open(partial_filename, 'wb') as f:
+                f.truncate(size)
+
+        stats.segments = len(segments)
+        self._download_segmented(urls, partial_filename, state_filename,
+                size, segments, attempts, hasher, stats)
+        return self._finish_digests(hasher, partial_filename)
@@ -3,9 +3,74 @@
 
 from __future__ import print_function
 
+import errno
+import signal
 import subprocess
 import sys
 
+_PIPE_CHUNK_SIZE_BYTES = 256 * 1024
+
+
+def _restore_sigpipe():
+    # NOTE: Python ignores SIGPIPE and children inherit that, so a producer
+    #       would not notice its consumer quitting early otherwise
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+class _Pipe(object):
+    """
+    Producer and consumer process started by Executor.start_pipe
+    """
+    def __init__(self, producer_argv, producer, consumer_argv, consumer, observe):
+        self._producer_argv = producer_argv
+        self._producer = producer
+        self._consumer_argv = consumer_argv
+        self._consumer = consumer
+        self._observe = observe
+
+    def wait(self):
+        """
+        Waits for both processes (passing data along if observed),
+        raising CalledProcessError for the process that failed
+        """
+        producer = self._producer
+        consumer = self._consumer
+
+        consumer_gone = False
+        try:
+            if self._observe is not None:
+                for chunk in iter(lambda: producer.stdout.read(_PIPE_CHUNK_SIZE_BYTES), ''):
+                    self._observe(chunk)
+                    try:
+                        consumer.stdin.write(chunk)
+                    except IOError as e:
+                        if e.errno != errno.EPIPE:
+                            raise
+                        consumer_gone = True
+                        break
+        finally:
+            # NOTE: Closing our end lets the producer see a consumer quitting early
+            producer.stdout.close()
+            if consumer.stdin is not None:
+                try:
+                    consumer.stdin.close()
+                except IOError as e:
+                    if e.errno != errno.EPIPE:
+                        raise
+            producer_returncode = producer.wait()
+            consumer_returncode = consumer.wait()
+
+        if producer_returncode == -signal.SIGPIPE:
+            consumer_gone = True
+
+        # NOTE: A consumer that quit early takes the producer down with it
+        if consumer_returncode and consumer_gone:
+            raise subprocess.CalledProcessError(consumer_returncode, self._consumer_argv)
+        if producer_returncode and not consumer_gone:
+            raise subprocess.CalledProcessError(producer_returncode, self._producer_argv)
+        if consumer_returncode:
+            raise subprocess.CalledProcessError(consumer_returncode, self._consumer_argv)
+
 
 class Executor(object):
     def __init__(self, messenger, stdout=None, stderr=None):
@@ -26,3 +91,55 @@ class Executor(object):
     def check_output(self, argv):
         self._messenger.announce_command(argv)
         return subprocess.check_output(argv, stderr=self._default_stderr)
+
+    def start_pipe(self, producer_argv, consumer_argv, observe=None, env=None, cwd=None):
+        """
+        Starts the equivalent of "producer | consumer", returning a pipe
+        to call wait() on later.  With observe given, data passes through
+        this process (during wait()) so that observe(chunk) gets to see
+        all of it (e.g. for computing checksums on the fly); otherwise the
+        two processes are connected directly and run on their own.
+
+        Several pipes can be started one after another and then be waited
+        for, running concurrently without any threads (that would make
+        process creation unsafe with Python 2).
+        """
+        self._messenger.announce_command(producer_argv)
+        self._messenger.announce_command(consumer_argv)
+
+        # NOTE: close_fds keeps processes of one pipe from holding on to
+        #       pipe ends of another, which would keep readers from seeing EOF
+        producer = subprocess.Popen(producer_argv,
+                stdout=subprocess.PIPE,
+                stderr=self._default_stderr,
+                env=env,
+                cwd=cwd,
+                close_fds=True,
+                preexec_fn=_restore_sigpipe,
+                )
+        try:
+            consumer = subprocess.Popen(consumer_argv,
+                    stdin=subprocess.PIPE if observe is not None else producer.stdout,
+                    stdout=self._default_stdout,
+                    stderr=self._default_stderr,
+                    env=env,
+                    cwd=cwd,
+                    close_fds=True,
+                    )
+        except:
+            producer.stdout.close()
+            producer.kill()
+            producer.wait()
+            raise
+
+        if observe is None:
+            # NOTE: Only the consumer reads, so that the producer notices it quitting early
+            producer.stdout.close()
+
+        return _Pipe(producer_argv, producer, consumer_argv, consumer, observe)
+
+    def check_pipe(self, producer_argv, consumer_argv, observe=None, env=None, cwd=None):
+        """
+        Runs the equivalent of "producer | consumer", see start_pipe
+        """
+        self.start_pipe(producer_argv, consumer_argv, observe, env, cwd).wait()
@@ -0,0 +1,42 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import threading
+from urlparse import urlsplit
+
+import directory_bootstrap.shared.loaders._requests as requests
+
+
+class SessionPool(object):
+    """
+    Hands out one HTTP session per mirror host (and scheme) so that
+    connections are kept alive and re-used across requests, rather than
+    paying for a TCP (and TLS) handshake per file.
+    """
+    def __init__(self, connections_per_host, trust_env=True):
+        self._connections_per_host = connections_per_host
+        self._trust_env = trust_env
+        self._session_of_origin = {}
+        self._lock = threading.Lock()
+
+    def _create_session(self):
+        session = requests.Session()
+        session.trust_env = self._trust_env  # i.e. whether to honor http_proxy, .netrc, ...
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, requests.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self._connections_per_host,
+                    ))
+        return session
+
+    def get_session(self, url):
+        parts = urlsplit(url)
+        origin = (parts.scheme, parts.netloc)
+        with self._lock:
+            session = self._session_of_origin.get(origin)
+            if session is None:
+                session = self._create_session()
+                self._session_of_origin[origin] = session
+            return session
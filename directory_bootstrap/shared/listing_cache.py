@@ -0,0 +1,122 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.lockfile import OfflineError
+
+_LISTINGS_DIR = 'listings'
+_LISTING_SUFFIX = '.json'
+
+_HTTP_NOT_MODIFIED = 304
+
+_REQUEST_TIMEOUT_SECONDS = 30
+
+
+class ListingCache(object):
+    """
+    Persistent cache of small upstream documents (directory listings,
+    latest-stage3.txt, ...) used for resolving "latest" releases.
+
+    Within the time-to-live, cached content is used without any network
+    traffic.  After that, content is revalidated using ETag and
+    Last-Modified, so that unchanged documents cost a 304 response only.
+    If upstream is slow or down, the last good copy is used.
+    Offline, cached content is used no matter its age.
+    """
+    def __init__(self, messenger, abs_cache_dir, ttl_seconds, session_pool, offline):
+        self._messenger = messenger
+        self._session_pool = session_pool
+        self._abs_listings_dir = os.path.join(abs_cache_dir, _LISTINGS_DIR)
+        self._ttl_seconds = ttl_seconds
+        self._offline = offline
+
+    def _get_entry_filename(self, url):
+        return os.path.join(self._abs_listings_dir,
+                hashlib.sha256(url).hexdigest() + _LISTING_SUFFIX)
+
+    def _read_entry(self, url):
+        try:
+            with open(self._get_entry_filename(url)) as f:
+                entry = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            return None  # i.e. corrupted, ignore
+
+        if entry.get('url') != url:
+            return None
+        return entry
+
+    def _write_entry(self, entry):
+        try:
+            os.makedirs(self._abs_listings_dir, 0755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, abs_temp_filename = tempfile.mkstemp(dir=self._abs_listings_dir,
+                prefix='.', suffix=_LISTING_SUFFIX)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(entry, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, self._get_entry_filename(entry['url']))
+
+    def get_url_content(self, url):
+        entry = self._read_entry(url)
+        now = time.time()
+
+        if entry is not None and now - entry['fetched'] < self._ttl_seconds:
+            self._messenger.info('Re-using cached copy of "%s".' % url)
+            return entry['content']
+
+        if self._offline:
+            if entry is None:
+                raise OfflineError('No cached copy of "%s" to use offline' % url)
+            self._messenger.info('Re-using cached copy of "%s" from %s (offline).'
+                    % (url, time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['fetched']))))
+            return entry['content']
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            session = self._session_pool.get_session(url)
+            response = session.get(url, headers=headers, timeout=_REQUEST_TIMEOUT_SECONDS)
+            if response.status_code != _HTTP_NOT_MODIFIED:
+                response.raise_for_status()
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            self._messenger.warn('Fetching "%s" failed (%s), re-using cached copy from %s.'
+                    % (url, e, time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['fetched']))))
+            return entry['content']
+
+        if response.status_code == _HTTP_NOT_MODIFIED:
+            self._messenger.info('Cached copy of "%s" is still up to date.' % url)
+        else:
+            entry = {
+                'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content': response.text,
+            }
+        entry['fetched'] = now
+        self._write_entry(entry)
+
+        return entry['content']
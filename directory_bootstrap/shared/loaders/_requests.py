@@ -6,7 +6,10 @@ from __future__ import print_function
 import sys
 
 try:
-    from requests import get
+    from requests import HTTPError, RequestException, Session, get
+    from requests.adapters import HTTPAdapter
+    # NOTE: Raised when reading from Response.raw, unlike those of Requests
+    from requests.packages.urllib3.exceptions import HTTPError as Urllib3Error
 except ImportError as e:
     print('ERROR: Please install Requests '
         '(https://pypi.python.org/pypi/requests).  '
@@ -14,6 +17,11 @@ except ImportError as e:
     sys.exit(1)
 
 # Mark as used
+HTTPAdapter
+HTTPError
+RequestException
+Session
+Urllib3Error
 get
 
 del sys
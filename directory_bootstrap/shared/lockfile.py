@@ -0,0 +1,76 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import json
+import os
+
+from directory_bootstrap.shared.digests import DIGEST_ALGORITHMS
+
+_FORMAT_VERSION = 1
+
+
+class LockfileError(Exception):
+    pass
+
+
+class OfflineError(Exception):
+    pass
+
+
+class Lockfile(object):
+    """
+    Records what a run resolved "latest" to (e.g. release dates)
+    and the artifacts it used (with URLs, size and digests),
+    so that later runs can repeat it exactly, even without network access.
+    """
+    def __init__(self, distro_key, resolved=None, artifacts=None):
+        self.distro_key = distro_key
+        self._resolved = resolved or {}
+        self._artifacts = artifacts or {}
+
+    @classmethod
+    def load(clazz, abs_filename):
+        with open(abs_filename) as f:
+            try:
+                content = json.load(f)
+            except ValueError as e:
+                raise LockfileError('Lock file "%s" is malformed: %s' % (abs_filename, e))
+
+        if content.get('version') != _FORMAT_VERSION:
+            raise LockfileError('Lock file "%s" has unsupported version %s'
+                    % (abs_filename, content.get('version')))
+
+        return clazz(content['distro'], content['resolved'], content['artifacts'])
+
+    def save(self, abs_filename):
+        content = {
+            'version': _FORMAT_VERSION,
+            'distro': self.distro_key,
+            'resolved': self._resolved,
+            'artifacts': self._artifacts,
+        }
+        abs_temp_filename = '%s.%d.tmp' % (abs_filename, os.getpid())
+        with open(abs_temp_filename, 'w') as f:
+            json.dump(content, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, abs_filename)
+
+    def get_resolved(self, key):
+        return self._resolved.get(key)
+
+    def set_resolved(self, key, value):
+        self._resolved[key] = value
+
+    def get_artifact(self, artifact_name):
+        return self._artifacts.get(artifact_name)
+
+    def add_artifact(self, artifact_name, urls, size, digests):
+        artifact = {
+            'urls': urls,
+            'size': size,
+        }
+        for algorithm in DIGEST_ALGORITHMS:
+            artifact[algorithm] = digests[algorithm]
+        self._artifacts[artifact_name] = artifact
@@ -0,0 +1,203 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import json
+import os
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from urlparse import urlsplit
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.byte_size import format_byte_size
+
+_HEALTH_FILENAME = 'mirror-health.json'
+
+# NOTE: Mirrors not measured for this long get probed again
+_MEASUREMENT_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# NOTE: Weight of a new measurement versus the history
+_SMOOTHING_FACTOR = 0.5
+
+# NOTE: Transfers this small say more about latency than throughput
+_MIN_THROUGHPUT_SAMPLE_BYTES = 256 * 1024
+
+# NOTE: Mirrors are ranked by estimated time to fetch a file of this size
+_RANKING_REFERENCE_BYTES = 10 * 1024 * 1024
+
+_PROBE_TIMEOUT_SECONDS = 10
+
+# NOTE: Enough for a throughput sample, without fetching all of large probe files
+_PROBE_MAX_BYTES = 2 * 1024 * 1024
+_PROBE_CHUNK_SIZE_BYTES = 64 * 1024
+
+# NOTE: Waiting with a timeout keeps KeyboardInterrupt deliverable in Python 2
+_PROBE_WAIT_TIMEOUT_SECONDS = 365 * 24 * 60 * 60
+
+
+def get_mirror_key(url):
+    """
+    >>> get_mirror_key('http://distfiles.gentoo.org/releases/amd64/')
+    'http://distfiles.gentoo.org'
+    """
+    parts = urlsplit(url)
+    return '%s://%s' % (parts.scheme, parts.netloc)
+
+
+def _smoothen(previous_value, value):
+    if previous_value is None:
+        return value
+    return _SMOOTHING_FACTOR * value + (1.0 - _SMOOTHING_FACTOR) * previous_value
+
+
+class MirrorHealthDatabase(object):
+    """
+    Remembers latency, throughput and failures per mirror host
+    across runs, in a small JSON file in the cache directory.
+    Concurrent runs may overwrite each other's latest measurements,
+    which is fine for the purpose of picking a good mirror.
+    """
+    def __init__(self, abs_cache_dir):
+        self._abs_filename = os.path.join(abs_cache_dir, _HEALTH_FILENAME)
+        self._lock = threading.Lock()
+        self._stats_of_mirror = None
+
+    def _load(self):
+        if self._stats_of_mirror is not None:
+            return
+
+        try:
+            with open(self._abs_filename) as f:
+                self._stats_of_mirror = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._stats_of_mirror = {}
+        except ValueError:
+            self._stats_of_mirror = {}  # i.e. corrupted, start over
+
+    def _save(self):
+        abs_dir = os.path.dirname(self._abs_filename)
+        try:
+            os.makedirs(abs_dir, 0755)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        fd, abs_temp_filename = tempfile.mkstemp(dir=abs_dir, prefix='.', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(self._stats_of_mirror, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, self._abs_filename)
+
+    def _update(self, url, update_stats):
+        with self._lock:
+            self._load()
+            stats = self._stats_of_mirror.setdefault(get_mirror_key(url), {})
+            update_stats(stats)
+            stats['updated'] = int(time.time())
+            self._save()
+
+    def record_success(self, url, byte_count, seconds, latency_seconds=None):
+        def update_stats(stats):
+            stats['failures'] = 0
+            if latency_seconds is not None:
+                stats['latency'] = _smoothen(stats.get('latency'), latency_seconds)
+            if byte_count >= _MIN_THROUGHPUT_SAMPLE_BYTES:
+                throughput = byte_count / max(seconds, 0.001)
+                stats['throughput'] = _smoothen(stats.get('throughput'), throughput)
+
+        self._update(url, update_stats)
+
+    def record_failure(self, url):
+        def update_stats(stats):
+            stats['failures'] = stats.get('failures', 0) + 1
+
+        self._update(url, update_stats)
+
+    def get_stats(self, url):
+        """
+        Returns measurements for the mirror of the given URL,
+        or None if there are none or they are outdated
+        """
+        with self._lock:
+            self._load()
+            stats = self._stats_of_mirror.get(get_mirror_key(url))
+        if stats is None or time.time() - stats['updated'] > _MEASUREMENT_TTL_SECONDS:
+            return None
+        return dict(stats)
+
+
+def _get_estimated_seconds(stats):
+    if 'latency' not in stats or not stats.get('throughput'):
+        return float('inf')
+    return stats['latency'] + _RANKING_REFERENCE_BYTES / stats['throughput']
+
+
+def _probe_mirror(session_pool, health_db, probe_url):
+    session = session_pool.get_session(probe_url)
+    before = time.time()
+    try:
+        response = session.get(probe_url, timeout=_PROBE_TIMEOUT_SECONDS, stream=True,
+                headers={'Range': 'bytes=0-%d' % (_PROBE_MAX_BYTES - 1)})
+        try:
+            response.raise_for_status()
+            latency_seconds = time.time() - before
+            byte_count = 0
+            for chunk in response.iter_content(_PROBE_CHUNK_SIZE_BYTES):
+                byte_count += len(chunk)
+                if byte_count >= _PROBE_MAX_BYTES:
+                    break
+        finally:
+            response.close()
+    except requests.RequestException:
+        health_db.record_failure(probe_url)
+        return
+    seconds = time.time() - before - latency_seconds
+    health_db.record_success(probe_url, byte_count, seconds, latency_seconds)
+
+
+def rank_mirrors(messenger, session_pool, health_db, mirror_urls, get_probe_url, probe=True):
+    """
+    Orders mirrors best first, using earlier measurements where recent
+    enough and probing the others in parallel (by fetching the start of
+    get_probe_url(mirror_url), which needs to be a file of a few megabytes
+    or more, as smaller transfers do not count towards throughput).
+    Without probing (e.g. when offline), mirrors not measured before
+    keep the order given.
+    """
+    if len(mirror_urls) < 2:
+        return list(mirror_urls)
+
+    unmeasured_probe_urls = [get_probe_url(mirror_url) for mirror_url in mirror_urls
+            if health_db.get_stats(get_probe_url(mirror_url)) is None]
+    if unmeasured_probe_urls and probe:
+        messenger.info('Probing %d mirror(s)...' % len(unmeasured_probe_urls))
+        pool = ThreadPool(len(unmeasured_probe_urls))
+        try:
+            pool.map_async(lambda probe_url: _probe_mirror(session_pool, health_db, probe_url),
+                    unmeasured_probe_urls).get(_PROBE_WAIT_TIMEOUT_SECONDS)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_rank_key(mirror_url):
+        stats = health_db.get_stats(get_probe_url(mirror_url)) or {}
+        return (stats.get('failures', 0), _get_estimated_seconds(stats))
+
+    ranked_mirror_urls = sorted(mirror_urls, key=get_rank_key)
+
+    best_stats = health_db.get_stats(get_probe_url(ranked_mirror_urls[0])) or {}
+    if 'latency' in best_stats and 'throughput' in best_stats:
+        messenger.info('Using mirror "%s" first (%d ms latency, %s/s).'
+                % (ranked_mirror_urls[0], best_stats['latency'] * 1000,
+                format_byte_size(best_stats['throughput'])))
+    else:
+        messenger.info('Using mirror "%s" first.' % ranked_mirror_urls[0])
+
+    return ranked_mirror_urls
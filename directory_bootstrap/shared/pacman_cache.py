@@ -0,0 +1,131 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import hashlib
+import os
+import shutil
+
+from directory_bootstrap.shared.artifact_store import ArtifactStore
+from directory_bootstrap.shared.commands import COMMAND_MOUNT
+from directory_bootstrap.shared.mount import try_unmounting
+
+_PACMAN_DIR = 'pacman'
+
+_REL_PACKAGES_DIR = 'var/cache/pacman/pkg'
+_REL_SYNC_DATABASES_DIR = 'var/lib/pacman/sync'
+
+# NOTE: Enough to tell apart different sets of mirrors
+_MIRRORS_DIGEST_PREFIX_LENGTH = 12
+
+
+def _ensure_directory(abs_path):
+    try:
+        os.makedirs(abs_path, 0755)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class PacmanCache(object):
+    """
+    Package files and sync databases of pacman, kept in the cache directory
+    for re-use by later runs.
+
+    Packages are shared by all runs of an architecture, through a bind mount.
+    Sync databases are shared by runs of the same architecture and mirrors.
+    They are copied in and out rather than mounted, as pacman replaces
+    them while running and concurrent runs must not get to see that.
+    Either is kept from eviction by cache clean-up while in use.
+    """
+    def __init__(self, messenger, executor, abs_cache_dir, architecture, mirror_urls):
+        self._messenger = messenger
+        self._executor = executor
+
+        mirrors_digest = hashlib.sha256('\n'.join(sorted(mirror_urls))).hexdigest()
+        abs_pacman_dir = os.path.join(abs_cache_dir, _PACMAN_DIR)
+        self._abs_packages_dir = os.path.join(abs_pacman_dir, 'pkg', architecture)
+        self._abs_sync_databases_dir = os.path.join(abs_pacman_dir, 'sync', '%s-%s'
+                % (architecture, mirrors_digest[:_MIRRORS_DIGEST_PREFIX_LENGTH]))
+        self._artifact_store = ArtifactStore(abs_cache_dir)
+        self._packages_lock = None
+
+    def _lock_shared(self):
+        lock = self._artifact_store.locked_pool(_PACMAN_DIR)
+        lock.acquire(shared=True)
+        return lock
+
+    def mount_packages_into(self, abs_root):
+        abs_target_dir = os.path.join(abs_root, _REL_PACKAGES_DIR)
+        _ensure_directory(self._abs_packages_dir)
+        _ensure_directory(abs_target_dir)
+
+        self._packages_lock = self._lock_shared()
+
+        self._messenger.info('Mounting pacman package cache "%s" at "%s"...'
+                % (self._abs_packages_dir, abs_target_dir))
+        self._executor.check_call([
+                COMMAND_MOUNT,
+                '-o', 'bind',
+                self._abs_packages_dir,
+                abs_target_dir,
+                ])
+
+    def unmount_packages_from(self, abs_root):
+        try_unmounting(self._executor, os.path.join(abs_root, _REL_PACKAGES_DIR))
+        self._packages_lock.release()
+        self._packages_lock = None
+
+    def restore_sync_databases_to(self, abs_root):
+        """
+        Copies cached sync databases in, keeping modification times
+        so that pacman only downloads those that changed upstream.
+        Databases at least as recent as the cached ones are left alone.
+        """
+        if not os.path.isdir(self._abs_sync_databases_dir):
+            return
+
+        abs_target_dir = os.path.join(abs_root, _REL_SYNC_DATABASES_DIR)
+        _ensure_directory(abs_target_dir)
+
+        self._messenger.info('Restoring pacman sync databases from "%s"...'
+                % self._abs_sync_databases_dir)
+        lock = self._lock_shared()
+        try:
+            for basename in sorted(os.listdir(self._abs_sync_databases_dir)):
+                if basename.startswith('.'):
+                    continue
+                abs_source_filename = os.path.join(self._abs_sync_databases_dir, basename)
+                abs_target_filename = os.path.join(abs_target_dir, basename)
+                if os.path.exists(abs_target_filename) \
+                        and os.path.getmtime(abs_target_filename) >= os.path.getmtime(abs_source_filename):
+                    continue
+                shutil.copy2(abs_source_filename, abs_target_filename)
+        finally:
+            lock.release()
+
+    def save_sync_databases_from(self, abs_root):
+        abs_source_dir = os.path.join(abs_root, _REL_SYNC_DATABASES_DIR)
+        if not os.path.isdir(abs_source_dir):
+            return
+
+        _ensure_directory(self._abs_sync_databases_dir)
+
+        self._messenger.info('Saving pacman sync databases to "%s"...'
+                % self._abs_sync_databases_dir)
+        lock = self._lock_shared()
+        try:
+            for basename in sorted(os.listdir(abs_source_dir)):
+                abs_source_filename = os.path.join(abs_source_dir, basename)
+                if not os.path.isfile(abs_source_filename):
+                    continue
+
+                # NOTE: Copy and rename for atomic replacement
+                abs_temp_filename = os.path.join(self._abs_sync_databases_dir,
+                        '.%s.%d.tmp' % (basename, os.getpid()))
+                shutil.copy2(abs_source_filename, abs_temp_filename)
+                os.rename(abs_temp_filename, os.path.join(self._abs_sync_databases_dir, basename))
+        finally:
+            lock.release()
@@ -0,0 +1,132 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import re
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+_range_matcher = re.compile('^bytes=([0-9]+)-([0-9]*)$')
+
+# NOTE: Keeps shutting down (i.e. every test) quick
+_POLL_INTERVAL_SECONDS = 0.01
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in sorted((headers or {}).items()):
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server.test_server
+        server.record_request(self.path, dict(self.headers.items()))
+
+        document = server.get_document(self.path)
+        if document is None:
+            self._send_empty(404)
+            return
+
+        content, etag, last_modified, truncate_to = document
+        validators = {}
+        if etag is not None:
+            validators['ETag'] = etag
+        if last_modified is not None:
+            validators['Last-Modified'] = last_modified
+
+        if (etag is not None and self.headers.get('If-None-Match') == etag) \
+                or (last_modified is not None
+                    and self.headers.get('If-Modified-Since') == last_modified):
+            self._send_empty(304, validators)
+            return
+
+        first_byte, last_byte = 0, len(content) - 1
+        status = 200
+        m = _range_matcher.match(self.headers.get('Range', ''))
+        if m is not None:
+            first_byte = int(m.group(1))
+            if m.group(2):
+                last_byte = min(int(m.group(2)), last_byte)
+            if first_byte >= len(content):
+                self._send_empty(416, {'Content-Range': 'bytes */%d' % len(content)})
+                return
+            status = 206
+
+        self.send_response(status)
+        for name, value in sorted(validators.items()):
+            self.send_header(name, value)
+        self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d'
+                    % (first_byte, last_byte, len(content)))
+        self.send_header('Content-Length', str(last_byte - first_byte + 1))
+        self.end_headers()
+        if truncate_to is not None:
+            self.wfile.write(content[first_byte:min(last_byte + 1, truncate_to)])
+            self.close_connection = 1
+            return
+        self.wfile.write(content[first_byte:last_byte + 1])
+
+
+class HttpServer(object):
+    """
+    Minimal HTTP server on localhost, for tests, serving documents
+    from memory with support for Range, ETag and Last-Modified.
+    Documents can be set to break off after truncate_to bytes
+    (with the full size announced), like a failing upstream.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._document_of_path = {}
+        self.requests = []
+
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.test_server = self
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                args=(_POLL_INTERVAL_SECONDS,))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def get_url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self._server.server_address[1], path)
+
+    def set_document(self, path, content, etag=None, last_modified=None, truncate_to=None):
+        with self._lock:
+            self._document_of_path[path] = (content, etag, last_modified, truncate_to)
+
+    def remove_document(self, path):
+        with self._lock:
+            del self._document_of_path[path]
+
+    def get_document(self, path):
+        with self._lock:
+            return self._document_of_path.get(path)
+
+    def record_request(self, path, headers):
+        with self._lock:
+            self.requests.append((path, headers))
+
+    def get_requests(self, path):
+        with self._lock:
+            return [headers for (request_path, headers) in self.requests
+                    if request_path == path]
@@ -0,0 +1,265 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import directory_bootstrap.shared.artifact_store as artifact_store
+from directory_bootstrap.shared.artifact_store import ArtifactStore
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+
+
+class TestArtifactStore(TestCase):
+    def setUp(self):
+        self._abs_cache_dir = tempfile.mkdtemp()
+        self._messenger = Messenger(VERBOSITY_QUIET, False)
+        self._store = ArtifactStore(self._abs_cache_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._abs_cache_dir)
+
+    def _add(self, artifact_name, content=None, accessed=None):
+        abs_partial_filename = self._store.get_partial_filename(artifact_name)
+        with open(abs_partial_filename, 'w') as f:
+            f.write(artifact_name if content is None else content)
+        entry = self._store.add(artifact_name, abs_partial_filename)
+        if accessed is not None:
+            entry['accessed'] = accessed
+            self._store._write_entry(entry)
+        self._store.link_to(entry, os.path.join(self._abs_cache_dir, artifact_name))
+        return entry
+
+    def _age_blob(self, entry):
+        abs_blob_filename = self._store.get_blob_filename(entry['sha256'])
+        old = time.time() - artifact_store._ORPHAN_BLOB_GRACE_SECONDS - 1
+        os.utime(abs_blob_filename, (old, old))
+        return abs_blob_filename
+
+    def _provide(self, artifact_name, content):
+        def create_file(abs_partial_filename):
+            with open(abs_partial_filename, 'w') as f:
+                f.write(content)
+
+        return self._store.provide(self._messenger,
+                os.path.join(self._abs_cache_dir, artifact_name), create_file)
+
+    def test_add_deduplicates_by_content(self):
+        entry1 = self._add('a-20160101.tar', 'same')
+        entry2 = self._add('b-20160101.tar', 'same')
+        self.assertEquals(entry1['sha256'], entry2['sha256'])
+        abs_blob_filename = self._store.get_blob_filename(entry1['sha256'])
+        self.assertEquals(os.listdir(os.path.dirname(abs_blob_filename)),
+                [entry1['sha256']])
+        with open(os.path.join(self._abs_cache_dir, 'b-20160101.tar')) as f:
+            self.assertEquals(f.read(), 'same')
+
+    def test_provide_creates_once(self):
+        entry, lock = self._provide('a-20160101.tar', 'content')
+        lock.release()
+
+        def create_file(abs_partial_filename):
+            self.fail('Cache miss')
+
+        entry2, lock = self._store.provide(self._messenger,
+                os.path.join(self._abs_cache_dir, 'a-20160101.tar'), create_file)
+        lock.release()
+        self.assertEquals(entry2['sha256'], entry['sha256'])
+
+    def test_keep_last(self):
+        for date_str in ('20151001', '20151008', '20151015'):
+            self._add('stage3-amd64-%s.tar.bz2' % date_str)
+        self._add('portage-20151001.tar.xz')
+
+        self._store.collect_garbage(self._messenger, keep_last=2)
+
+        self.assertEquals(self._store.lookup('stage3-amd64-20151001.tar.bz2'), None)
+        self.assertFalse(os.path.lexists(os.path.join(self._abs_cache_dir,
+                'stage3-amd64-20151001.tar.bz2')))
+        for artifact_name in (
+                'stage3-amd64-20151008.tar.bz2',
+                'stage3-amd64-20151015.tar.bz2',
+                'portage-20151001.tar.xz',
+                ):
+            self.assertTrue(self._store.lookup(artifact_name) is not None)
+
+    def test_max_size_evicts_least_recently_used(self):
+        now = int(time.time())
+        self._add('a-20160101.tar', 'a' * 100, accessed=now - 30)
+        self._add('b-20160101.tar', 'b' * 100, accessed=now - 10)
+        self._add('c-20160101.tar', 'c' * 100, accessed=now - 20)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=150)
+
+        self.assertEquals(self._store.lookup('a-20160101.tar'), None)
+        self.assertEquals(self._store.lookup('c-20160101.tar'), None)
+        self.assertTrue(self._store.lookup('b-20160101.tar') is not None)
+
+    def test_max_size_counts_shared_blobs_once(self):
+        self._add('a-20160101.tar', 'x' * 100)
+        self._add('b-20160101.tar', 'x' * 100)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=100)
+
+        self.assertTrue(self._store.lookup('a-20160101.tar') is not None)
+        self.assertTrue(self._store.lookup('b-20160101.tar') is not None)
+
+    def test_max_size_removes_blobs_right_away(self):
+        now = int(time.time())
+        entry_a = self._add('a-20160101.tar', 'a' * 100, accessed=now - 20)
+        entry_b = self._add('b-20160101.tar', 'b' * 100, accessed=now - 10)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=150)
+
+        self.assertEquals(self._store.lookup('a-20160101.tar'), None)
+        self.assertFalse(os.path.exists(self._store.get_blob_filename(entry_a['sha256'])))
+        self.assertTrue(self._store.lookup('b-20160101.tar') is not None)
+        self.assertTrue(os.path.exists(self._store.get_blob_filename(entry_b['sha256'])))
+
+    def test_orphan_grace(self):
+        entry = self._add('a-20160101.tar')
+        self._store.collect_garbage(self._messenger, keep_last=0)
+        abs_blob_filename = self._store.get_blob_filename(entry['sha256'])
+        self.assertEquals(self._store.lookup('a-20160101.tar'), None)
+        self.assertTrue(os.path.exists(abs_blob_filename))
+
+        self._age_blob(entry)
+        self._store.collect_garbage(self._messenger)
+        self.assertFalse(os.path.exists(abs_blob_filename))
+
+    def test_in_use_is_kept(self):
+        entry, lock = self._provide('a-20160101.tar', 'content')
+        entry2, lock2 = self._provide('b-20160101.tar', 'content')  # i.e. same blob
+        lock2.release()
+        self._age_blob(entry)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertTrue(self._store.lookup('a-20160101.tar') is not None)
+        self.assertTrue(os.path.exists(self._store.get_blob_filename(entry['sha256'])))
+
+        lock.release()
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertEquals(self._store.lookup('a-20160101.tar'), None)
+        self.assertEquals(self._store.lookup('b-20160101.tar'), None)
+
+    def test_in_use_orphan_blob_is_kept(self):
+        entry, lock = self._provide('a-20160101.tar', 'content')
+        os.remove(self._store._get_index_filename('a-20160101.tar'))
+        abs_blob_filename = self._age_blob(entry)
+
+        self._store.collect_garbage(self._messenger)
+        self.assertTrue(os.path.exists(abs_blob_filename))
+
+        lock.release()
+        self._store.collect_garbage(self._messenger)
+        self.assertFalse(os.path.exists(abs_blob_filename))
+
+    def test_trees_follow_their_source(self):
+        entry = self._add('a-20160101.tar')
+        self.assertEquals(self._store.lookup_tree('a-tree'), None)
+
+        abs_partial_dirname = self._store.get_partial_tree_dirname('a-tree')
+        os.makedirs(os.path.join(abs_partial_dirname, 'etc'))
+        abs_tree_dirname = self._store.add_tree('a-tree', abs_partial_dirname, entry)
+        self.assertEquals(self._store.lookup_tree('a-tree'), abs_tree_dirname)
+        self.assertTrue(os.path.isdir(os.path.join(abs_tree_dirname, 'etc')))
+
+        self._store.collect_garbage(self._messenger)
+        self.assertEquals(self._store.lookup_tree('a-tree'), abs_tree_dirname)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertEquals(self._store.lookup_tree('a-tree'), None)
+        self.assertFalse(os.path.exists(abs_tree_dirname))
+
+    def test_trees_in_use_are_kept(self):
+        entry = self._add('a-20160101.tar')
+        abs_partial_dirname = self._store.get_partial_tree_dirname('a-tree')
+        os.makedirs(abs_partial_dirname)
+        abs_tree_dirname = self._store.add_tree('a-tree', abs_partial_dirname, entry)
+
+        lock = self._store.locked('a-tree')
+        lock.acquire(shared=True)
+        try:
+            self._store.collect_garbage(self._messenger, max_size_bytes=0)
+            self.assertEquals(self._store.lookup_tree('a-tree'), abs_tree_dirname)
+        finally:
+            lock.release()
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertEquals(self._store.lookup_tree('a-tree'), None)
+
+    def _add_tree(self, tree_name, entry, content):
+        abs_partial_dirname = self._store.get_partial_tree_dirname(tree_name)
+        os.makedirs(abs_partial_dirname)
+        with open(os.path.join(abs_partial_dirname, 'file'), 'w') as f:
+            f.write(content)
+        return self._store.add_tree(tree_name, abs_partial_dirname, entry)
+
+    def _add_pool_file(self, rel_filename, content, accessed):
+        abs_filename = os.path.join(self._abs_cache_dir, rel_filename)
+        if not os.path.isdir(os.path.dirname(abs_filename)):
+            os.makedirs(os.path.dirname(abs_filename))
+        with open(abs_filename, 'w') as f:
+            f.write(content)
+        os.utime(abs_filename, (accessed, accessed))
+        return abs_filename
+
+    def test_eviction_removes_lock_files(self):
+        self._provide('a-20160101.tar', 'content')[1].release()
+        abs_lock_filename = os.path.join(self._abs_cache_dir, 'store', 'locks', 'a-20160101.tar.lock')
+        self.assertTrue(os.path.exists(abs_lock_filename))
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertFalse(os.path.exists(abs_lock_filename))
+
+    def test_lock_of_removed_lock_file_is_not_held(self):
+        lock = self._store.locked('a-20160101.tar')
+        lock.acquire()
+        lock.remove()
+        lock.release()
+
+        lock2 = self._store.locked('a-20160101.tar')
+        self.assertTrue(lock2.acquire(blocking=False))
+        lock2.release()
+
+    def test_max_size_counts_trees_and_pools(self):
+        now = int(time.time())
+        entry = self._add('a-20160101.tar', 'a' * 100, accessed=now)
+        abs_tree_dirname = self._add_tree('a-tree', entry, 't' * 100)
+        abs_old_filename = self._add_pool_file('pacman/pkg/old.pkg.tar.xz', 'o' * 100, now - 20)
+        abs_new_filename = self._add_pool_file('pacman/pkg/new.pkg.tar.xz', 'n' * 100, now - 10)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=300)
+
+        self.assertFalse(os.path.exists(abs_old_filename))
+        self.assertTrue(os.path.exists(abs_new_filename))
+        self.assertEquals(self._store.lookup_tree('a-tree'), abs_tree_dirname)
+        self.assertTrue(self._store.lookup('a-20160101.tar') is not None)
+
+    def test_max_size_evicts_trees(self):
+        now = int(time.time())
+        entry = self._add('a-20160101.tar', 'a' * 100, accessed=now)
+        self._add_tree('a-tree', entry, 't' * 100)
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=150)
+
+        self.assertEquals(self._store.lookup_tree('a-tree'), None)
+        self.assertTrue(self._store.lookup('a-20160101.tar') is not None)
+
+    def test_pools_in_use_are_kept(self):
+        abs_filename = self._add_pool_file('proxy/ab/abcd', 'p' * 100, time.time() - 10)
+
+        lock = self._store.locked_pool('proxy')
+        lock.acquire(shared=True)
+        try:
+            self._store.collect_garbage(self._messenger, max_size_bytes=0)
+            self.assertTrue(os.path.exists(abs_filename))
+        finally:
+            lock.release()
+
+        self._store.collect_garbage(self._messenger, max_size_bytes=0)
+        self.assertFalse(os.path.exists(abs_filename))
@@ -5,7 +5,8 @@ from __future__ import print_function
 
 from unittest import TestCase
 
-from directory_bootstrap.shared.byte_size import format_byte_size
+from directory_bootstrap.shared.byte_size import (
+        format_byte_size, parse_byte_size)
 
 
 class TestByteSizeFormatter(TestCase):
@@ -28,3 +29,25 @@ class TestByteSizeFormatter(TestCase):
                 ):
             received = format_byte_size(size_bytes)
             self.assertEquals(received, expected)
+
+
+class TestByteSizeParser(TestCase):
+    def test_well_formed(self):
+        for text, expected in (
+                ('0', 0),
+                ('512', 512),
+                ('512B', 512),
+                ('1K', 1024),
+                ('1k', 1024),
+                ('1KiB', 1024),
+                ('1.5M', 1024 * 1024 * 3 / 2),
+                ('2 GiB', 2 * 1024**3),
+                ('20G', 20 * 1024**3),
+                ('1T', 1024**4),
+                ):
+            received = parse_byte_size(text)
+            self.assertEquals(received, expected)
+
+    def test_malformed(self):
+        for text in ('', 'G', '-1G', '1X', '1.G'):
+            self.assertRaises(ValueError, parse_byte_size, text)
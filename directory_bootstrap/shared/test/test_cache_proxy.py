@@ -0,0 +1,94 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.cache_proxy import CacheProxy
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.test.http_server import HttpServer
+
+_PACKAGE_PATH = '/debian/pool/main/b/bash/bash_4.3-11+b1_amd64.deb'
+_RELEASE_PATH = '/debian/dists/jessie/InRelease'
+_CONTENT = ''.join(chr(i % 251) for i in range(100000))
+
+_REQUEST_TIMEOUT_SECONDS = 10
+
+
+class TestCacheProxy(TestCase):
+    def setUp(self):
+        self._abs_cache_dir = tempfile.mkdtemp()
+        self._upstream = HttpServer()
+        self._upstream.start()
+
+        self._proxy = CacheProxy(Messenger(VERBOSITY_QUIET, False), self._abs_cache_dir,
+                '127.0.0.1', 0)
+        self._proxy_thread = threading.Thread(target=self._proxy.serve_forever)
+        self._proxy_thread.daemon = True
+        self._proxy_thread.start()
+
+        self._session = requests.Session()
+        self._session.trust_env = False
+
+    def tearDown(self):
+        self._session.close()
+        self._proxy.shutdown()
+        self._proxy_thread.join()
+        self._upstream.stop()
+        shutil.rmtree(self._abs_cache_dir)
+
+    def _get(self, url):
+        return self._session.get(url, proxies={'http': self._proxy.get_url()},
+                timeout=_REQUEST_TIMEOUT_SECONDS)
+
+    def _list_stored_files(self):
+        return [basename
+                for abs_root, dirnames, basenames in os.walk(self._abs_cache_dir)
+                for basename in basenames
+                if not abs_root.endswith('locks')]
+
+    def test_cache_miss_then_hit(self):
+        self._upstream.set_document(_PACKAGE_PATH, _CONTENT)
+        url = self._upstream.get_url(_PACKAGE_PATH)
+
+        for _ in range(2):
+            response = self._get(url)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response.content, _CONTENT)
+
+        self.assertEquals(len(self._upstream.get_requests(_PACKAGE_PATH)), 1)
+
+        self._upstream.remove_document(_PACKAGE_PATH)
+        self.assertEquals(self._get(url).content, _CONTENT)
+
+    def test_revalidation(self):
+        self._upstream.set_document(_RELEASE_PATH, 'one', etag='"1"')
+        url = self._upstream.get_url(_RELEASE_PATH)
+        self.assertEquals(self._get(url).content, 'one')
+        self.assertEquals(self._get(url).content, 'one')
+        self.assertEquals([headers.get('if-none-match')
+                for headers in self._upstream.get_requests(_RELEASE_PATH)], [None, '"1"'])
+
+        self._upstream.set_document(_RELEASE_PATH, 'two', etag='"2"')
+        self.assertEquals(self._get(url).content, 'two')
+
+    def test_upstream_down(self):
+        response = self._get('http://127.0.0.1:1' + _PACKAGE_PATH)
+        self.assertEquals(response.status_code, 502)
+
+    def test_upstream_failing_midway(self):
+        self._upstream.set_document(_PACKAGE_PATH, _CONTENT, truncate_to=1000)
+        url = self._upstream.get_url(_PACKAGE_PATH)
+
+        # NOTE: The connection is dropped rather than waiting for content to follow
+        self.assertTrue(len(self._get(url).content) < len(_CONTENT))
+        self.assertEquals(self._list_stored_files(), [])
+
+        self._upstream.set_document(_PACKAGE_PATH, _CONTENT)
+        self.assertEquals(self._get(url).content, _CONTENT)
@@ -0,0 +1,133 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import directory_bootstrap.shared.downloader as downloader
+from directory_bootstrap.shared.digests import MultiHasher, hash_file
+from directory_bootstrap.shared.download_stats import DownloadStats
+from directory_bootstrap.shared.downloader import Downloader, DownloadError
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.test.http_server import HttpServer
+
+_PATH = '/stage3.tar.bz2'
+_MIRROR_PATH = '/mirror/stage3.tar.bz2'
+_CONTENT = ''.join(chr(i % 251) for i in range(10000))
+
+
+class TestDownloader(TestCase):
+    def setUp(self):
+        self._abs_temp_dir = tempfile.mkdtemp()
+        self._abs_partial_filename = os.path.join(self._abs_temp_dir, 'stage3.tar.bz2.part')
+        self._abs_state_filename = self._abs_partial_filename + downloader._SEGMENTS_SUFFIX
+        self._downloader = Downloader(Messenger(VERBOSITY_QUIET, False),
+                SessionPool(4, trust_env=False), 0)
+        self._stats = DownloadStats('stage3.tar.bz2')
+        self._server = HttpServer()
+        self._server.start()
+        self._server.set_document(_PATH, _CONTENT)
+        self._server.set_document(_MIRROR_PATH, _CONTENT)
+        self._segmented_download_min_bytes = downloader._SEGMENTED_DOWNLOAD_MIN_BYTES
+        downloader._SEGMENTED_DOWNLOAD_MIN_BYTES = 1000
+
+        self._read_back_bytes = []
+        self._update_from_file = MultiHasher.update_from_file
+
+        def update_from_file(hasher, abs_filename, max_byte_count=None):
+            byte_count = hasher.byte_count
+            self._update_from_file(hasher, abs_filename, max_byte_count)
+            self._read_back_bytes.append(hasher.byte_count - byte_count)
+
+        MultiHasher.update_from_file = update_from_file
+
+    def tearDown(self):
+        MultiHasher.update_from_file = self._update_from_file
+        downloader._SEGMENTED_DOWNLOAD_MIN_BYTES = self._segmented_download_min_bytes
+        self._server.stop()
+        shutil.rmtree(self._abs_temp_dir)
+
+    def _write_partial(self, content):
+        with open(self._abs_partial_filename, 'wb') as f:
+            f.write(content)
+
+    def _read_partial(self):
+        with open(self._abs_partial_filename, 'rb') as f:
+            return f.read()
+
+    def _download(self, paths, attempts=2, segment_count=1):
+        urls = [self._server.get_url(path) for path in paths]
+        return self._downloader.download(urls, self._abs_partial_filename,
+                attempts, self._stats, segment_count)
+
+    def _get_ranges(self, path):
+        return [headers.get('range') for headers in self._server.get_requests(path)]
+
+    def _assert_complete(self, digests):
+        self.assertEquals(self._read_partial(), _CONTENT)
+        self.assertEquals(digests, hash_file(self._abs_partial_filename))
+
+    def test_download(self):
+        digests = self._download([_PATH])
+        self._assert_complete(digests)
+        self.assertEquals(self._get_ranges(_PATH), [None])
+
+    def test_resume(self):
+        self._write_partial(_CONTENT[:4000])
+        digests = self._download([_PATH])
+        self._assert_complete(digests)
+        self.assertEquals(self._get_ranges(_PATH), ['bytes=4000-'])
+
+    def test_complete_already(self):
+        self._write_partial(_CONTENT)
+        digests = self._download([_PATH])
+        self._assert_complete(digests)  # i.e. re-hashed from disk
+        self.assertEquals(self._get_ranges(_PATH), ['bytes=10000-'])
+
+    def test_range_not_satisfiable_restarts(self):
+        self._write_partial(_CONTENT + 'stale')
+        digests = self._download([_PATH])
+        self._assert_complete(digests)
+        self.assertEquals(self._get_ranges(_PATH), ['bytes=10005-', None])
+
+    def test_segmented(self):
+        digests = self._download([_PATH, _MIRROR_PATH], segment_count=4)
+        read_back_bytes = sum(self._read_back_bytes)
+        self._assert_complete(digests)
+        self.assertEquals(self._stats.segments, 4)
+        self.assertFalse(os.path.exists(self._abs_state_filename))
+
+        # NOTE: The first segment is always hashed inline
+        self.assertTrue(read_back_bytes <= len(_CONTENT) - 2500)
+
+        ranges = self._get_ranges(_PATH) + self._get_ranges(_MIRROR_PATH)
+        self.assertEquals(sorted(ranges[1:]), [
+                'bytes=0-2499',
+                'bytes=2500-4999',
+                'bytes=5000-7499',
+                'bytes=7500-9999',
+                ])
+
+    def test_segmented_resume(self):
+        self._write_partial(_CONTENT[:3000] + '\0' * 2000 + _CONTENT[5000:])
+        with open(self._abs_state_filename, 'w') as f:
+            json.dump({'size': 10000, 'segments': [[0, 4999, 3000], [5000, 9999, 5000]]}, f)
+
+        digests = self._download([_PATH], segment_count=2)
+        self.assertEquals(sum(self._read_back_bytes), 3000 + 5000)  # i.e. resumed content only
+        self._assert_complete(digests)
+        self.assertEquals(self._get_ranges(_PATH), ['bytes=3000-4999'])
+        self.assertFalse(os.path.exists(self._abs_state_filename))
+
+    def test_segmented_changed(self):
+        self._server.set_document(_MIRROR_PATH, _CONTENT + 'changed')
+        self.assertRaises(DownloadError, self._download, [_PATH, _MIRROR_PATH],
+                attempts=1, segment_count=2)
+        self.assertFalse(os.path.exists(self._abs_partial_filename))
+        self.assertFalse(os.path.exists(self._abs_state_filename))
@@ -0,0 +1,88 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+from unittest import TestCase
+
+import directory_bootstrap.shared.loaders._requests as requests
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.listing_cache import ListingCache
+from directory_bootstrap.shared.lockfile import OfflineError
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.test.http_server import HttpServer
+
+_PATH = '/releases/latest.txt'
+_LAST_MODIFIED = 'Fri, 01 Jan 2016 00:00:00 GMT'
+
+
+class TestListingCache(TestCase):
+    def setUp(self):
+        self._abs_cache_dir = tempfile.mkdtemp()
+        self._messenger = Messenger(VERBOSITY_QUIET, False)
+        self._session_pool = SessionPool(1, trust_env=False)
+        self._server = HttpServer()
+        self._server.start()
+        self._url = self._server.get_url(_PATH)
+
+    def tearDown(self):
+        self._server.stop()
+        shutil.rmtree(self._abs_cache_dir)
+
+    def _create_cache(self, ttl_seconds=0, offline=False):
+        return ListingCache(self._messenger, self._abs_cache_dir, ttl_seconds,
+                self._session_pool, offline)
+
+    def test_ttl(self):
+        self._server.set_document(_PATH, 'one', etag='"1"')
+        self.assertEquals(self._create_cache(60).get_url_content(self._url), 'one')
+
+        self._server.set_document(_PATH, 'two', etag='"2"')
+        self.assertEquals(self._create_cache(60).get_url_content(self._url), 'one')
+        self.assertEquals(len(self._server.get_requests(_PATH)), 1)
+
+    def test_etag_revalidation(self):
+        self._server.set_document(_PATH, 'one', etag='"1"')
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'one')
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'one')
+
+        headers = self._server.get_requests(_PATH)[-1]
+        self.assertEquals(headers.get('if-none-match'), '"1"')
+
+        self._server.set_document(_PATH, 'two', etag='"2"')
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'two')
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'two')
+        self.assertEquals(self._server.get_requests(_PATH)[-1].get('if-none-match'), '"2"')
+
+    def test_last_modified_revalidation(self):
+        self._server.set_document(_PATH, 'one', last_modified=_LAST_MODIFIED)
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'one')
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'one')
+
+        headers = self._server.get_requests(_PATH)[-1]
+        self.assertEquals(headers.get('if-modified-since'), _LAST_MODIFIED)
+        self.assertEquals(headers.get('if-none-match'), None)
+
+    def test_offline(self):
+        cache = self._create_cache(offline=True)
+        self.assertRaises(OfflineError, cache.get_url_content, self._url)
+
+        self._server.set_document(_PATH, 'one', etag='"1"')
+        self._create_cache().get_url_content(self._url)
+        self._server.set_document(_PATH, 'two', etag='"2"')
+
+        self.assertEquals(self._create_cache(offline=True).get_url_content(self._url), 'one')
+        self.assertEquals(len(self._server.get_requests(_PATH)), 1)
+
+    def test_stale_fallback(self):
+        self._server.set_document(_PATH, 'one', etag='"1"')
+        self._create_cache().get_url_content(self._url)
+        self._server.remove_document(_PATH)
+
+        self.assertEquals(self._create_cache().get_url_content(self._url), 'one')
+
+    def test_failure_without_cached_copy(self):
+        self.assertRaises(requests.RequestException,
+                self._create_cache().get_url_content, self._url)
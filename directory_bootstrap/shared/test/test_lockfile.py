@@ -0,0 +1,40 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from directory_bootstrap.shared.lockfile import Lockfile, LockfileError
+
+
+class TestLockfile(TestCase):
+    def setUp(self):
+        self._abs_temp_dir = tempfile.mkdtemp()
+        self._abs_filename = os.path.join(self._abs_temp_dir, 'gentoo.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self._abs_temp_dir)
+
+    def test_round_trip(self):
+        lock = Lockfile('gentoo')
+        lock.set_resolved('stage3_date', '20160101')
+        lock.add_artifact('stage3-amd64-20160101.tar.bz2',
+                ['http://example.org/stage3-amd64-20160101.tar.bz2'], 123,
+                {'md5': 'm', 'sha256': 's', 'sha512': 'S'})
+        lock.save(self._abs_filename)
+
+        loaded = Lockfile.load(self._abs_filename)
+        self.assertEquals(loaded.distro_key, 'gentoo')
+        self.assertEquals(loaded.get_resolved('stage3_date'), '20160101')
+        self.assertEquals(loaded.get_resolved('snapshot_date'), None)
+        self.assertEquals(loaded.get_artifact('stage3-amd64-20160101.tar.bz2')['sha256'], 's')
+        self.assertEquals(loaded.get_artifact('stage3-amd64-20160101.tar.bz2')['size'], 123)
+
+    def test_malformed(self):
+        with open(self._abs_filename, 'w') as f:
+            f.write('{')
+        self.assertRaises(LockfileError, Lockfile.load, self._abs_filename)
@@ -0,0 +1,56 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+from unittest import TestCase
+
+import directory_bootstrap.shared.mirrors as mirrors
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.mirrors import MirrorHealthDatabase, rank_mirrors
+from directory_bootstrap.shared.test.http_server import HttpServer
+
+_PATH = '/releases/snapshots/current/portage-latest.tar.xz'
+_CONTENT = 'x' * (mirrors._MIN_THROUGHPUT_SAMPLE_BYTES * 2)
+
+
+class TestMirrors(TestCase):
+    def setUp(self):
+        self._abs_cache_dir = tempfile.mkdtemp()
+        self._health_db = MirrorHealthDatabase(self._abs_cache_dir)
+        self._server = HttpServer()
+        self._server.start()
+        self._server.set_document(_PATH, _CONTENT)
+        self._probe_max_bytes = mirrors._PROBE_MAX_BYTES
+        mirrors._PROBE_MAX_BYTES = mirrors._MIN_THROUGHPUT_SAMPLE_BYTES
+
+    def tearDown(self):
+        mirrors._PROBE_MAX_BYTES = self._probe_max_bytes
+        self._server.stop()
+        shutil.rmtree(self._abs_cache_dir)
+
+    def test_small_transfers_do_not_count_as_throughput(self):
+        url = 'http://mirror.example.org/latest-stage3.txt'
+        self._health_db.record_success(url, 1024, 0.001, 0.1)
+        stats = self._health_db.get_stats(url)
+        self.assertEquals(stats['latency'], 0.1)
+        self.assertFalse('throughput' in stats)
+
+        self._health_db.record_success(url, mirrors._MIN_THROUGHPUT_SAMPLE_BYTES, 1.0)
+        self.assertEquals(self._health_db.get_stats(url)['throughput'],
+                mirrors._MIN_THROUGHPUT_SAMPLE_BYTES)
+
+    def test_probe_reads_a_range(self):
+        base_url = self._server.get_url('')
+        ranked_urls = rank_mirrors(Messenger(VERBOSITY_QUIET, False),
+                SessionPool(1, trust_env=False), self._health_db,
+                [base_url, 'http://127.0.0.1:1'],
+                lambda mirror_url: mirror_url + _PATH)
+
+        self.assertEquals(ranked_urls[0], base_url)
+        self.assertEquals([headers.get('range') for headers in self._server.get_requests(_PATH)],
+                ['bytes=0-%d' % (mirrors._MIN_THROUGHPUT_SAMPLE_BYTES - 1)])
+        self.assertTrue(self._health_db.get_stats(base_url + _PATH)['throughput'] > 0)
@@ -0,0 +1,100 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from directory_bootstrap.shared.commands import COMMAND_MOUNT
+from directory_bootstrap.shared.messenger import Messenger, VERBOSITY_QUIET
+from directory_bootstrap.shared.pacman_cache import PacmanCache
+
+_MIRROR_URLS = ['https://mirror.example.org/$repo/os/$arch']
+
+
+class _RecordingExecutor(object):
+    def __init__(self):
+        self.argvs = []
+
+    def check_call(self, argv, env=None, cwd=None):
+        self.argvs.append(argv)
+
+
+class TestPacmanCache(TestCase):
+    def setUp(self):
+        self._abs_temp_dir = tempfile.mkdtemp()
+        self._abs_cache_dir = os.path.join(self._abs_temp_dir, 'cache')
+        self._executor = _RecordingExecutor()
+
+    def tearDown(self):
+        shutil.rmtree(self._abs_temp_dir)
+
+    def _create_cache(self, architecture='x86_64', mirror_urls=_MIRROR_URLS):
+        return PacmanCache(Messenger(VERBOSITY_QUIET, False), self._executor,
+                self._abs_cache_dir, architecture, mirror_urls)
+
+    def _get_sync_dir(self, root_name):
+        return os.path.join(self._abs_temp_dir, root_name, 'var/lib/pacman/sync')
+
+    def _write_database(self, root_name, basename, content, mtime):
+        abs_sync_dir = self._get_sync_dir(root_name)
+        if not os.path.isdir(abs_sync_dir):
+            os.makedirs(abs_sync_dir)
+        abs_filename = os.path.join(abs_sync_dir, basename)
+        with open(abs_filename, 'w') as f:
+            f.write(content)
+        os.utime(abs_filename, (mtime, mtime))
+
+    def _read_database(self, root_name, basename):
+        abs_filename = os.path.join(self._get_sync_dir(root_name), basename)
+        with open(abs_filename) as f:
+            return f.read(), int(os.path.getmtime(abs_filename))
+
+    def test_sync_databases_round_trip(self):
+        self._write_database('first', 'core.db', 'core', 1451606400)
+        self._write_database('first', 'extra.db', 'extra', 1451606401)
+        self._create_cache().save_sync_databases_from(os.path.join(self._abs_temp_dir, 'first'))
+
+        self._create_cache().restore_sync_databases_to(os.path.join(self._abs_temp_dir, 'second'))
+        self.assertEquals(sorted(os.listdir(self._get_sync_dir('second'))),
+                ['core.db', 'extra.db'])
+        self.assertEquals(self._read_database('second', 'core.db'), ('core', 1451606400))
+        self.assertEquals(self._read_database('second', 'extra.db'), ('extra', 1451606401))
+
+    def test_restore_keeps_newer_databases(self):
+        self._write_database('first', 'core.db', 'core', 1451606400)
+        self._create_cache().save_sync_databases_from(os.path.join(self._abs_temp_dir, 'first'))
+
+        self._write_database('second', 'core.db', 'newer core', 1451606500)
+        self._create_cache().restore_sync_databases_to(os.path.join(self._abs_temp_dir, 'second'))
+        self.assertEquals(self._read_database('second', 'core.db'), ('newer core', 1451606500))
+
+    def test_restore_without_saved_databases(self):
+        self._create_cache().restore_sync_databases_to(os.path.join(self._abs_temp_dir, 'second'))
+        self.assertFalse(os.path.exists(self._get_sync_dir('second')))
+
+    def test_sync_databases_per_architecture_and_mirrors(self):
+        self._write_database('first', 'core.db', 'core', 1451606400)
+        self._create_cache().save_sync_databases_from(os.path.join(self._abs_temp_dir, 'first'))
+
+        for cache in (
+                self._create_cache(architecture='i686'),
+                self._create_cache(mirror_urls=['https://other.example.org/$repo/os/$arch']),
+                ):
+            cache.restore_sync_databases_to(os.path.join(self._abs_temp_dir, 'second'))
+            self.assertFalse(os.path.exists(self._get_sync_dir('second')))
+
+    def test_mount_packages(self):
+        abs_root = os.path.join(self._abs_temp_dir, 'root')
+        self._create_cache().mount_packages_into(abs_root)
+
+        abs_packages_dir = os.path.join(self._abs_cache_dir, 'pacman', 'pkg', 'x86_64')
+        abs_target_dir = os.path.join(abs_root, 'var/cache/pacman/pkg')
+        self.assertTrue(os.path.isdir(abs_packages_dir))
+        self.assertTrue(os.path.isdir(abs_target_dir))
+        self.assertEquals(self._executor.argvs, [
+                [COMMAND_MOUNT, '-o', 'bind', abs_packages_dir, abs_target_dir],
+                ])
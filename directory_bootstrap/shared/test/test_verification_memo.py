@@ -0,0 +1,98 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+import directory_bootstrap.shared.verification_memo as verification_memo
+from directory_bootstrap.shared.verification_memo import VerificationMemo
+
+_SHA256 = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+
+
+class TestVerificationMemo(TestCase):
+    def setUp(self):
+        self._abs_cache_dir = tempfile.mkdtemp()
+        self._abs_filename = os.path.join(self._abs_cache_dir, 'stage3.tar.bz2')
+        self._write('content')
+
+    def tearDown(self):
+        shutil.rmtree(self._abs_cache_dir)
+
+    def _write(self, content, mtime=1451606400):
+        with open(self._abs_filename, 'w') as f:
+            f.write(content)
+        os.utime(self._abs_filename, (mtime, mtime))
+
+    def _make_key(self, trust_anchor='keyring-digest', sha256=_SHA256):
+        return VerificationMemo.make_key('gpg', [(self._abs_filename, sha256)], trust_anchor)
+
+    def _add(self, key):
+        VerificationMemo(self._abs_cache_dir).add(key)
+
+    def _contains(self, key):
+        return VerificationMemo(self._abs_cache_dir).contains(key)
+
+    def test_round_trip(self):
+        key = self._make_key()
+        self.assertFalse(self._contains(key))
+        self._add(key)
+        self.assertTrue(self._contains(key))
+        self.assertEquals(self._make_key(), key)
+
+    def test_size_change(self):
+        key = self._make_key()
+        self._add(key)
+        self._write('content, modified')
+        self.assertNotEquals(self._make_key(), key)
+
+    def test_mtime_change(self):
+        key = self._make_key()
+        self._add(key)
+        self._write('content', mtime=1451606401)
+        self.assertNotEquals(self._make_key(), key)
+
+    def test_inode_change(self):
+        key = self._make_key()
+        self._add(key)
+
+        abs_temp_filename = self._abs_filename + '.new'
+        shutil.copy2(self._abs_filename, abs_temp_filename)
+        os.rename(abs_temp_filename, self._abs_filename)
+        self.assertNotEquals(self._make_key(), key)
+
+    def test_trust_anchor_and_sha256(self):
+        key = self._make_key()
+        self.assertNotEquals(self._make_key(trust_anchor='other-keyring-digest'), key)
+        self.assertNotEquals(self._make_key(trust_anchor=None), key)
+        self.assertNotEquals(self._make_key(sha256='0' * 64), key)
+
+    def test_ttl(self):
+        expired_key = self._make_key(trust_anchor='old')
+        abs_memo_filename = os.path.join(self._abs_cache_dir, verification_memo._MEMO_FILENAME)
+        with open(abs_memo_filename, 'w') as f:
+            json.dump({expired_key: int(time.time()) - verification_memo._ENTRY_TTL_SECONDS - 1}, f)
+
+        key = self._make_key()
+        self._add(key)
+        self.assertTrue(self._contains(key))
+        self.assertFalse(self._contains(expired_key))
+
+    def test_ttl_without_adding(self):
+        key = self._make_key()
+        abs_memo_filename = os.path.join(self._abs_cache_dir, verification_memo._MEMO_FILENAME)
+        with open(abs_memo_filename, 'w') as f:
+            json.dump({key: int(time.time()) - verification_memo._ENTRY_TTL_SECONDS - 1}, f)
+
+        self.assertFalse(self._contains(key))
+
+    def test_corrupted(self):
+        with open(os.path.join(self._abs_cache_dir, verification_memo._MEMO_FILENAME), 'w') as f:
+            f.write('{')
+        self.assertFalse(self._contains(self._make_key()))
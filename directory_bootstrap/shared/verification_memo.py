@@ -0,0 +1,92 @@
+# Copyright (C) 2016 Sebastian Pipping <sebastian@pipping.org>
+# Licensed under AGPL v3 or later
+
+from __future__ import print_function
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+_MEMO_FILENAME = 'verifications.json'
+
+# NOTE: Older entries are dropped, so that files get verified afresh once in a while
+_ENTRY_TTL_SECONDS = 30 * 24 * 60 * 60
+
+
+def _get_file_identity(filename, sha256):
+    """
+    Changes whenever the file is replaced or modified in place
+    """
+    st = os.stat(filename)
+    return '%d:%d:%d:%d:%s' % (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime), sha256)
+
+
+class VerificationMemo(object):
+    """
+    Remembers successful verifications (GnuPG signatures, checksums)
+    of cached files across runs, in a small JSON file in the cache directory.
+
+    A verification is identified by its kind, the device, inode, size,
+    modification time and SHA-256 of every file involved, and the trusted
+    keys used (e.g. by digest of the keyring), so that any change to
+    either of them makes it count as new.
+    """
+    def __init__(self, abs_cache_dir):
+        self._abs_filename = os.path.join(abs_cache_dir, _MEMO_FILENAME)
+        self._lock = threading.Lock()
+        self._verified_of_key = None
+
+    def _load(self):
+        if self._verified_of_key is not None:
+            return
+
+        try:
+            with open(self._abs_filename) as f:
+                self._verified_of_key = json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._verified_of_key = {}
+        except ValueError:
+            self._verified_of_key = {}  # i.e. corrupted, start over
+
+    def _save(self):
+        now = time.time()
+        for key, verified in self._verified_of_key.items():
+            if now - verified > _ENTRY_TTL_SECONDS:
+                del self._verified_of_key[key]
+
+        abs_dir = os.path.dirname(self._abs_filename)
+        fd, abs_temp_filename = tempfile.mkstemp(dir=abs_dir, prefix='.', suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0644)
+            json.dump(self._verified_of_key, f, indent=4, separators=(',', ': '), sort_keys=True)
+            print(file=f)
+        os.rename(abs_temp_filename, self._abs_filename)
+
+    @staticmethod
+    def make_key(kind, filename_sha256_pairs, trust_anchor):
+        """
+        Takes (filename, SHA-256) pairs of the files involved
+        and a string identifying the trusted keys, if any
+        """
+        parts = [kind, trust_anchor or '']
+        for filename, sha256 in filename_sha256_pairs:
+            parts.append(_get_file_identity(filename, sha256))
+        return hashlib.sha256('\n'.join(parts)).hexdigest()
+
+    def contains(self, key):
+        with self._lock:
+            self._load()
+            verified = self._verified_of_key.get(key)
+            return verified is not None and time.time() - verified <= _ENTRY_TTL_SECONDS
+
+    def add(self, key):
+        with self._lock:
+            self._load()
+            self._verified_of_key[key] = int(time.time())
+            self._save()
@@ -9,11 +9,15 @@ _year = '([2-9][0-9]{3})'
 _month = '(0[1-9]|1[0-2])'
 _day = '(0[1-9]|[12][0-9]|3[01])'
 
-_STAGE3_TARBALL_DATE_PATTERN = '^(?P<date>%s%s%s)/stage3-(?P<arch>[^ -]+)-[0-9]+\\.tar\\.[^ ]+ [1-9]+[0-9]*$' % (_year, _month, _day)
+_STAGE3_TARBALL_DATE_PATTERN = '^(?P<date>%s%s%s)/stage3-(?P<arch>[^ -]+)-[0-9]+\\.tar\\.(?P<compression>[^ ]+) [1-9]+[0-9]*$' % (_year, _month, _day)
 _stage3_tarball_date_matcher = re.compile(_STAGE3_TARBALL_DATE_PATTERN)
 
 
-def find_latest_stage3_date(stage3_latest_file_content, stage3_latest_file_url, architecture):
+def find_latest_stage3(stage3_latest_file_content, stage3_latest_file_url, architecture):
+    """
+    Returns the date (as a triple) and the compression (e.g. "bz2" or "xz")
+    of the latest stage3 tarball
+    """
     matches = []
     for line in stage3_latest_file_content.split('\n'):
         m = _stage3_tarball_date_matcher.match(line)
@@ -37,4 +41,8 @@ def find_latest_stage3_date(stage3_latest_file_content, stage3_latest_file_url,
         raise ValueError(message)
 
     m = matches[0]
-    return int(m.group(2)), int(m.group(3)), int(m.group(4))
+    return (int(m.group(2)), int(m.group(3)), int(m.group(4))), m.group('compression')
+
+
+def find_latest_stage3_date(stage3_latest_file_content, stage3_latest_file_url, architecture):
+    return find_latest_stage3(stage3_latest_file_content, stage3_latest_file_url, architecture)[0]
@@ -6,8 +6,8 @@ from __future__ import print_function
 from textwrap import dedent
 from unittest import TestCase
 
-from directory_bootstrap.tools.stage3_latest_parser import \
-        find_latest_stage3_date
+from directory_bootstrap.tools.stage3_latest_parser import (
+        find_latest_stage3, find_latest_stage3_date)
 
 
 class TestStag3LatestParser(TestCase):
@@ -25,3 +25,14 @@ class TestStag3LatestParser(TestCase):
                 """)
         year, month, day = find_latest_stage3_date(content, 'http://distfiles.gentoo.org/releases/amd64/autobuilds/latest-stage3.txt', 'amd64')
         self.assertEquals((year, month, day), (2015, 10, 1))
+
+    def test_xz(self):
+        content = dedent("""\
+                # Latest as of Sun, 26 Feb 2017 07:30:01 +0000
+                # ts=1488094201
+                20170223/stage3-amd64-20170223.tar.xz 201497240
+                20170223/hardened/stage3-amd64-hardened-20170223.tar.bz2 238470563
+                """)
+        date_triple, compression = find_latest_stage3(content, 'http://distfiles.gentoo.org/releases/amd64/autobuilds/latest-stage3.txt', 'amd64')
+        self.assertEquals(date_triple, (2017, 2, 23))
+        self.assertEquals(compression, 'xz')
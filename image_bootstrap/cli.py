@@ -5,6 +5,9 @@ import os
 
 from directory_bootstrap.distros.base import \
         add_general_directory_bootstrapping_options
+from directory_bootstrap.shared.cache_proxy import (
+        DEFAULT_CACHE_PROXY_HOST, DEFAULT_CACHE_PROXY_PORT, CacheProxy,
+        route_through_http_proxy)
 from directory_bootstrap.shared.executor import Executor
 from directory_bootstrap.shared.loaders._argparse import (
         ArgumentParser, RawDescriptionHelpFormatter)
@@ -37,14 +40,42 @@ _BOOTLOADER_APPROACHES = (
         BOOTLOADER__NONE
         )
 
+_CACHE_PROXY_FIELD = 'cache_proxy'
+
 
 def _abspath_or_none(path_or_none):
     return path_or_none and os.path.abspath(path_or_none)
 
 
+def _run_cache_proxy(messenger, options):
+    proxy = CacheProxy(messenger, os.path.abspath(options.cache_dir),
+            options.cache_proxy_host, options.cache_proxy_port)
+    proxy.serve_forever()
+
+
+def _add_cache_proxy_parser_to(distros):
+    cache_proxy = distros.add_parser('cache-proxy',
+            help='run a caching HTTP proxy for package downloads '
+                '(for use with --http-proxy)')
+    cache_proxy.set_defaults(**{_CACHE_PROXY_FIELD: True})
+    cache_proxy.add_argument('--host', dest='cache_proxy_host', metavar='ADDRESS',
+            default=DEFAULT_CACHE_PROXY_HOST,
+            help='address to listen on (default: %(default)s)')
+    cache_proxy.add_argument('--port', dest='cache_proxy_port', metavar='PORT', type=int,
+            default=DEFAULT_CACHE_PROXY_PORT,
+            help='port to listen on (default: %(default)s)')
+
+
 def _main__level_three(messenger, options):
     messenger.banner()
 
+    if getattr(options, _CACHE_PROXY_FIELD, False):
+        _run_cache_proxy(messenger, options)
+        return
+
+    if options.http_proxy:
+        route_through_http_proxy(messenger, options.http_proxy)
+
     stdout_wanted = options.verbosity is VERBOSITY_VERBOSE
 
     if stdout_wanted:
@@ -152,7 +183,7 @@ def _main__level_two():
     distros = parser.add_subparsers(title='subcommands (choice of distribution)',
             description='Run "%(prog)s DISTRIBUTION --help" for details '
                     'on options specific to that distribution.',
-            metavar='DISTRIBUTION', help='choice of distribution, pick from:')
+            metavar='DISTRIBUTION', help='choice of distribution (or caching proxy), pick from:')
 
 
     for strategy_clazz in (
@@ -161,11 +192,11 @@ def _main__level_two():
             GentooStrategy,
             UbuntuStrategy,
             ):
-        strategy_clazz.add_parser_to(distros)
-
+        distro = strategy_clazz.add_parser_to(distros)
+        distro.add_argument('target_path', metavar='DEVICE',
+            help='block device to install to')
 
-    parser.add_argument('target_path', metavar='DEVICE',
-        help='block device to install to')
+    _add_cache_proxy_parser_to(distros)
 
     options = parser.parse_args()
 
@@ -3,18 +3,38 @@
 
 from __future__ import print_function
 
+import hashlib
 import os
+import shutil
 from textwrap import dedent
 
 from pkg_resources import resource_filename
 
 from directory_bootstrap.distros.arch import (
-        SUPPORTED_ARCHITECTURES, ArchBootstrapper)
+        SUPPORTED_ARCHITECTURES, ArchBootstrapper, enable_pacman_parallel_downloads)
+from directory_bootstrap.distros.base import DownloadConfig
+from directory_bootstrap.shared.artifact_store import ArtifactStore
 from directory_bootstrap.shared.commands import (
         COMMAND_CHROOT, COMMAND_CP, COMMAND_FIND, COMMAND_RM, COMMAND_SED,
         COMMAND_WGET)
+from directory_bootstrap.shared.pacman_cache import PacmanCache
 from image_bootstrap.distros.base import DISTRO_CLASS_FIELD, DistroStrategy
 
+_CLOUD_INIT_COMMIT = 'adf3e2d5d311903e3a4429d50764b6add2c21e8b'
+_CLOUD_INIT_PATCH = 'patches/cloud-init-0-7-6-pkgbuild.patch'
+_CLOUD_INIT_PACKAGE_BASENAME = 'cloud-init-9999-1-any.pkg.tar.xz'
+_CLOUD_INIT_BUILD_DIR = '/var/tmp/cloud-init-build'
+_CLOUD_INIT_DEPENDENCIES = (
+        'python2', 'python2-boto', 'python2-cheetah',
+        'python2-configobj', 'python2-jsonpatch',
+        'python2-jsonpointer', 'python2-oauth',
+        'python2-prettytable', 'python2-requests',
+        'python2-setuptools', 'python2-yaml', 'net-tools',
+        )
+
+# NOTE: Enough to tell apart builds from different commits and patches
+_CLOUD_INIT_DIGEST_PREFIX_LENGTH = 12
+
 
 class ArchStrategy(DistroStrategy):
     DISTRO_KEY = 'arch'
@@ -22,17 +42,23 @@ class ArchStrategy(DistroStrategy):
     DISTRO_NAME_LONG = 'Arch Linux'
 
     def __init__(self, messenger, executor,
-                abs_cache_dir, image_date_triple_or_none, mirror_url,
-                abs_resolv_conf):
+                abs_cache_dir, download_config, image_date_triple_or_none, mirror_urls,
+                image_mirror_urls, abs_resolv_conf, host_pacstrap, with_pacman_cache):
         super(ArchStrategy, self).__init__(
                 messenger,
                 executor,
                 abs_cache_dir,
+                download_config,
                 abs_resolv_conf,
                 )
 
         self._image_date_triple_or_none = image_date_triple_or_none
-        self._mirror_url = mirror_url
+        self._mirror_urls = mirror_urls
+        self._image_mirror_urls = image_mirror_urls
+        self._host_pacstrap = host_pacstrap
+        self._with_pacman_cache = with_pacman_cache
+        self._pacman_cache = None
+        self._architecture = None
 
     def get_commands_to_check_for(self):
         return ArchBootstrapper.get_commands_to_check_for() + [
@@ -68,12 +94,29 @@ class ArchStrategy(DistroStrategy):
                 self._executor,
                 self._abs_mountpoint,
                 self._abs_cache_dir,
+                self._download_config,
                 architecture,
                 self._image_date_triple_or_none,
-                self._mirror_url,
+                self._mirror_urls,
+                self._image_mirror_urls,
                 self._abs_resolv_conf,
+                self._host_pacstrap,
+                self._with_pacman_cache,
                 )
         bootstrap.run()
+        bootstrap.write_lock_file()
+        bootstrap.summarize_downloads()
+        bootstrap.collect_cache_garbage()
+        bootstrap.release_cached_files()
+
+        # NOTE: For installing further packages in the chroot
+        enable_pacman_parallel_downloads(self._messenger,
+                os.path.join(self._abs_mountpoint, 'etc/pacman.conf'))
+
+        self._architecture = architecture
+        if self._with_pacman_cache:
+            self._pacman_cache = PacmanCache(self._messenger, self._executor,
+                    self._abs_cache_dir, architecture, self._mirror_urls)
 
     def create_network_configuration(self, use_mtu_tristate):
         self._messenger.info('Making sure that network interfaces get named eth*...')
@@ -205,7 +248,17 @@ class ArchStrategy(DistroStrategy):
         self._executor.check_call(cmd)
 
 
+    def prepare_installation_of_packages(self):
+        if self._pacman_cache is not None:
+            self._pacman_cache.restore_sync_databases_to(self._abs_mountpoint)
+            self._pacman_cache.mount_packages_into(self._abs_mountpoint)
+
     def perform_post_chroot_clean_up(self):
+        if self._pacman_cache is not None:
+            self._pacman_cache.unmount_packages_from(self._abs_mountpoint)
+            self._pacman_cache.save_sync_databases_from(self._abs_mountpoint)
+            return
+
         self._messenger.info('Cleaning chroot pacman cache...')
         cmd = [
                 COMMAND_FIND,
@@ -221,11 +274,16 @@ class ArchStrategy(DistroStrategy):
     def install_sudo(self):
         self._install_packages(['sudo'])
 
-    def _install_cloud_init_0_7_6(self):
-        pkgbuild_patch_filename = resource_filename('image_bootstrap',
-                'patches/cloud-init-0-7-6-pkgbuild.patch')
-        inner_script_filename = '/root/install-cloud-init-0-7-6.sh'
+    def _build_cloud_init_0_7_6(self, abs_package_filename):
+        """
+        Builds the cloud-init package inside the chroot,
+        moving it out to the given location
+        """
+        pkgbuild_patch_filename = resource_filename('image_bootstrap', _CLOUD_INIT_PATCH)
+        inner_script_filename = '/root/build-cloud-init-0-7-6.sh'
         inner_patch_filename = '/root/cloud-init-pkgbuild.patch'
+        inner_package_filename = os.path.join(_CLOUD_INIT_BUILD_DIR,
+                'community-%s' % _CLOUD_INIT_COMMIT, 'trunk', _CLOUD_INIT_PACKAGE_BASENAME)
 
         self._executor.check_call([
                 COMMAND_CP, pkgbuild_patch_filename,
@@ -241,22 +299,25 @@ class ArchStrategy(DistroStrategy):
 
                 pacman --noconfirm --sync binutils fakeroot git patch sudo wget
 
-                COMMIT=adf3e2d5d311903e3a4429d50764b6add2c21e8b
+                rm -Rf %(build_dir)s
+                mkdir %(build_dir)s
+                cd %(build_dir)s
+
+                COMMIT=%(commit)s
                 wget https://git.archlinux.org/svntogit/community.git/snapshot/community-${COMMIT}.tar.xz
                 tar xf community-${COMMIT}.tar.xz
                 chmod a+rw community-${COMMIT}/trunk/
                 cd community-${COMMIT}/trunk/
 
-                patch PKGBUILD %s
-                pacman --noconfirm --sync \
-                        python2 python2-boto python2-cheetah \
-                        python2-configobj python2-jsonpatch \
-                        python2-jsonpointer python2-oauth \
-                        python2-prettytable python2-requests \
-                        python2-setuptools python2-yaml net-tools
+                patch PKGBUILD %(patch)s
+                pacman --noconfirm --sync %(dependencies)s
                 sudo -u nobody makepkg
-                pacman --noconfirm --upgrade cloud-init-9999-1-any.pkg.tar.xz
-            """ % inner_patch_filename))
+            """ % {
+                'build_dir': _CLOUD_INIT_BUILD_DIR,
+                'commit': _CLOUD_INIT_COMMIT,
+                'patch': inner_patch_filename,
+                'dependencies': ' '.join(_CLOUD_INIT_DEPENDENCIES),
+                }))
             os.fchmod(f.fileno(), 0755)
 
         self._executor.check_call([
@@ -264,6 +325,46 @@ class ArchStrategy(DistroStrategy):
                 inner_script_filename,
                 ], env=self.create_chroot_env())
 
+        shutil.move(os.path.join(self._abs_mountpoint, inner_package_filename.lstrip('/')),
+                abs_package_filename)
+        for inner_path in (inner_script_filename, inner_patch_filename):
+            os.remove(os.path.join(self._abs_mountpoint, inner_path.lstrip('/')))
+        shutil.rmtree(os.path.join(self._abs_mountpoint, _CLOUD_INIT_BUILD_DIR.lstrip('/')))
+
+    def _install_cloud_init_0_7_6(self):
+        """
+        Installs cloud-init built from a fixed commit and patch,
+        building it only if not found in the cache from an earlier run
+        """
+        with open(resource_filename('image_bootstrap', _CLOUD_INIT_PATCH)) as f:
+            patch_sha256 = hashlib.sha256(f.read()).hexdigest()
+        abs_cached_package_filename = os.path.join(self._abs_cache_dir,
+                'cloud-init-0.7.6-%s-%s-%s.pkg.tar.xz' % (
+                    _CLOUD_INIT_COMMIT[:_CLOUD_INIT_DIGEST_PREFIX_LENGTH],
+                    patch_sha256[:_CLOUD_INIT_DIGEST_PREFIX_LENGTH],
+                    self._architecture,
+                    ))
+        inner_package_filename = os.path.join('/root', _CLOUD_INIT_PACKAGE_BASENAME)
+        abs_package_filename = os.path.join(self._abs_mountpoint, inner_package_filename.lstrip('/'))
+
+        _, lock = ArtifactStore(self._abs_cache_dir).provide(self._messenger,
+                abs_cached_package_filename, self._build_cloud_init_0_7_6)
+        try:
+            shutil.copyfile(abs_cached_package_filename, abs_package_filename)
+        finally:
+            lock.release()
+
+        try:
+            self._install_packages(['--needed'] + list(_CLOUD_INIT_DEPENDENCIES))
+            self._executor.check_call([
+                    COMMAND_CHROOT, self._abs_mountpoint,
+                    'pacman',
+                    '--noconfirm',
+                    '--upgrade', inner_package_filename,
+                    ], env=self.create_chroot_env())
+        finally:
+            os.remove(abs_package_filename)
+
     def install_cloud_init_and_friends(self):
         self._install_cloud_init_0_7_6()
         self.disable_cloud_init_syslog_fix_perms()
@@ -323,13 +424,19 @@ class ArchStrategy(DistroStrategy):
 
         ArchBootstrapper.add_arguments_to(arch)
 
+        return arch
+
     @classmethod
     def create(clazz, messenger, executor, options):
         return clazz(
                 messenger,
                 executor,
                 os.path.abspath(options.cache_dir),
+                DownloadConfig.create(options),
                 options.image_date,
-                options.mirror_url,
+                options.mirror_urls or [ArchBootstrapper.DEFAULT_MIRROR_URL],
+                options.image_mirror_urls or [ArchBootstrapper.DEFAULT_IMAGE_MIRROR_URL],
                 os.path.abspath(options.resolv_conf),
+                options.host_pacstrap,
+                options.pacman_cache,
                 )
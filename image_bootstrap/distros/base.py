@@ -16,11 +16,12 @@ DISTRO_CLASS_FIELD = 'distro_class'
 class DistroStrategy(object):
     __metaclass__ = ABCMeta
 
-    def __init__(self, messenger, executor, abs_cache_dir, abs_resolv_conf):
+    def __init__(self, messenger, executor, abs_cache_dir, download_config, abs_resolv_conf):
         self._messenger = messenger
         self._executor = executor
 
         self._abs_cache_dir = abs_cache_dir
+        self._download_config = download_config
         self._abs_resolv_conf = abs_resolv_conf
 
     def set_mountpoint(self, abs_mountpoint):
@@ -203,6 +204,9 @@ class DistroStrategy(object):
 
     @classmethod
     def add_parser_to(clazz, distros):
+        """
+        Returns the parser added
+        """
         raise NotImplementedError()
 
     @classmethod
@@ -11,6 +11,8 @@ from textwrap import dedent
 
 from directory_bootstrap.shared.commands import (
         COMMAND_FIND, COMMAND_UNAME, COMMAND_UNSHARE)
+from directory_bootstrap.shared.http_sessions import SessionPool
+from directory_bootstrap.shared.mirrors import MirrorHealthDatabase, rank_mirrors
 from image_bootstrap.distros.base import DISTRO_CLASS_FIELD, DistroStrategy
 from image_bootstrap.engine import (
         BOOTLOADER__ANY_GRUB, BOOTLOADER__HOST_EXTLINUX, COMMAND_CHROOT)
@@ -43,18 +45,22 @@ class DebianBasedDistroStrategy(DistroStrategy):
             messenger,
             executor,
 
+            abs_cache_dir,
             release,
-            mirror_url,
+            mirror_urls,
             command_debootstrap,
             debootstrap_opt,
+            offline,
             ):
         self._messenger = messenger
         self._executor = executor
 
+        self._abs_cache_dir = abs_cache_dir
         self._release = release
-        self._mirror_url = mirror_url
+        self._mirror_urls = mirror_urls
         self._command_debootstrap = command_debootstrap
         self._debootstrap_opt = debootstrap_opt
+        self._offline = offline
 
     @abstractmethod
     def check_release(self):
@@ -115,7 +121,28 @@ class DebianBasedDistroStrategy(DistroStrategy):
                         """), file=f)
                 os.fchmod(f.fileno(), 0755)
 
+    def _get_packages_file_url(self, mirror_url, architecture):
+        return '%s/dists/%s/main/binary-%s/Packages.xz' \
+                % (mirror_url.rstrip('/'), self._release, architecture)
+
+    def _select_mirror(self, architecture):
+        """
+        Picks the fastest of the mirrors given (as debootstrap
+        takes a single mirror, there is no failing over later).
+        With --offline, only earlier measurements are used,
+        falling back to the first mirror given.
+        """
+        ranked_mirror_urls = rank_mirrors(self._messenger,
+                SessionPool(1),
+                MirrorHealthDatabase(self._abs_cache_dir),
+                self._mirror_urls,
+                lambda mirror_url: self._get_packages_file_url(mirror_url, architecture),
+                probe=not self._offline)
+        return ranked_mirror_urls[0]
+
     def run_directory_bootstrap(self, architecture, bootloader_approach):
+        mirror_url = self._select_mirror(architecture)
+
         self._messenger.info('Bootstrapping %s "%s" into "%s"...'
                 % (self.DISTRO_NAME_SHORT, self._release, self._abs_mountpoint))
 
@@ -142,7 +169,7 @@ class DebianBasedDistroStrategy(DistroStrategy):
                 + [
                 self._release,
                 self._abs_mountpoint,
-                self._mirror_url,
+                mirror_url,
                 ]
         self._executor.check_call(cmd)
 
@@ -252,11 +279,13 @@ class DebianBasedDistroStrategy(DistroStrategy):
                 metavar='RELEASE',
                 help='specify %s release (default: %%(default)s)'
                 % clazz.DISTRO_NAME_SHORT)
-        debian.add_argument('--mirror', dest='mirror_url', metavar='URL',
-                default=clazz.DEFAULT_MIRROR_URL,
+        debian.add_argument('--mirror', dest='mirror_urls', metavar='URL',
+                action='append',
                 help='specify %s mirror to use (e.g. %s for '
-                    'a local instance of apt-cacher-ng; default: %%(default)s)'
-                    % (clazz.DISTRO_NAME_SHORT, clazz.APT_CACHER_NG_URL))
+                    'a local instance of apt-cacher-ng); '
+                    'can be passed several times to have the fastest one picked '
+                    '(default: %s)'
+                    % (clazz.DISTRO_NAME_SHORT, clazz.APT_CACHER_NG_URL, clazz.DEFAULT_MIRROR_URL))
 
         debian.add_argument('--debootstrap-opt', dest='debootstrap_opt',
                 metavar='OPTION', action='append', default=[],
@@ -264,13 +293,17 @@ class DebianBasedDistroStrategy(DistroStrategy):
                     'can be passed several times; '
                     'use with --debootstrap-opt=... syntax, i.e. with "="')
 
+        return debian
+
     @classmethod
     def create(clazz, messenger, executor, options):
         return clazz(
                 messenger,
                 executor,
+                os.path.abspath(options.cache_dir),
                 options.release,
-                options.mirror_url,
+                options.mirror_urls or [clazz.DEFAULT_MIRROR_URL],
                 options.command_debootstrap,
                 options.debootstrap_opt,
+                options.offline,
                 )
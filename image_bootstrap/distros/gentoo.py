@@ -5,13 +5,19 @@ from __future__ import print_function
 
 import errno
 import glob
+import hashlib
 import os
 import shutil
 from textwrap import dedent
 
+from directory_bootstrap.distros.base import DownloadConfig
 from directory_bootstrap.distros.gentoo import GentooBootstrapper
+from directory_bootstrap.shared.artifact_store import ArtifactStore
 from directory_bootstrap.shared.commands import (
-        COMMAND_CHROOT, COMMAND_FIND, COMMAND_WGET)
+        COMMAND_CHROOT, COMMAND_FIND, COMMAND_MKSQUASHFS, COMMAND_MOUNT,
+        COMMAND_TAR, COMMAND_WGET)
+from directory_bootstrap.shared.decompression import extract_compressed_tarball
+from directory_bootstrap.shared.mount import try_unmounting
 from image_bootstrap.distros.base import DISTRO_CLASS_FIELD, DistroStrategy
 
 _ABS_PACKAGE_USE = '/etc/portage/package.use'
@@ -19,27 +25,49 @@ _ABS_PACKAGE_KEYWORDS = '/etc/portage/package.keywords'
 _ABS_PACKAGE_MASK = '/etc/portage/package.mask'
 _ABS_PACKAGE_UNMASK = '/etc/portage/package.unmask'
 
+_ABS_PORTAGE_DIR = '/usr/portage'
+_ABS_PORTAGE_OVERLAY_DIR = '/var/tmp/image-bootstrap-portage'
+
+_ABS_MAKE_CONF = '/etc/portage/make.conf'
+_ABS_MAKE_PROFILE = '/etc/portage/make.profile'
+_ABS_BINARY_PACKAGES_DIR = '/var/cache/image-bootstrap-binpkgs'
+
+_BINARY_PACKAGES_CACHE_DIR = 'gentoo-binpkgs'
+
+# NOTE: Enough to tell apart different profiles and make.conf files
+_BINARY_PACKAGES_DIGEST_PREFIX_LENGTH = 12
+
+# NOTE: Enough to tell apart different kernel configurations and toolchains
+_KERNEL_BUILD_DIGEST_PREFIX_LENGTH = 12
+
 
 class GentooStrategy(DistroStrategy):
     DISTRO_KEY = 'gentoo'
     DISTRO_NAME_SHORT = 'Gentoo'
     DISTRO_NAME_LONG = 'Gentoo'
 
-    def __init__(self, messenger, executor, abs_cache_dir,
-                mirror_url, max_age_days,
+    def __init__(self, messenger, executor, abs_cache_dir, download_config,
+                mirror_urls, max_age_days,
                 stage3_date_triple_or_none, repository_date_triple_or_none,
-                abs_resolv_conf):
+                abs_resolv_conf, with_portage_squashfs, with_binary_packages_cache):
         super(GentooStrategy, self).__init__(
                 messenger,
                 executor,
                 abs_cache_dir,
+                download_config,
                 abs_resolv_conf,
                 )
 
-        self._mirror_url = mirror_url
+        self._mirror_urls = mirror_urls
         self._max_age_days = max_age_days
         self._stage3_date_triple_or_none = stage3_date_triple_or_none
         self._repository_date_triple_or_none = repository_date_triple_or_none
+        self._with_portage_squashfs = with_portage_squashfs
+        self._abs_portage_squashfs_filename = None
+        self._directory_bootstrapper = None
+        self._with_binary_packages_cache = with_binary_packages_cache
+        self._binary_packages_cache_lock = None
+        self._architecture = None
 
     def _write_etc_conf_d_hostname(self):
         etc_conf_d = os.path.join(self._abs_mountpoint, 'etc/conf.d')
@@ -140,22 +168,55 @@ class GentooStrategy(DistroStrategy):
             print('# generated by image-bootstrap', file=f)
             print(package_atom, file=f)
 
+    def _get_binary_packages_dir(self):
+        """
+        Returns the in-chroot PKGDIR to use with the current profile
+        and make.conf.  Binary packages built with other USE flags than
+        wanted are rejected by emerge (--binpkg-respect-use), so that
+        package settings need not be part of the key.
+        """
+        hasher = hashlib.sha256()
+        abs_make_profile = os.path.join(self._abs_mountpoint, _ABS_MAKE_PROFILE.lstrip('/'))
+        hasher.update('profile %s\n' % (os.readlink(abs_make_profile)
+                if os.path.islink(abs_make_profile) else ''))
+
+        abs_make_conf = os.path.join(self._abs_mountpoint, _ABS_MAKE_CONF.lstrip('/'))
+        if os.path.isfile(abs_make_conf):
+            with open(abs_make_conf) as f:
+                hasher.update(f.read())
+
+        return os.path.join(_ABS_BINARY_PACKAGES_DIR, '%s-%s' % (
+                self._architecture,
+                hasher.hexdigest()[:_BINARY_PACKAGES_DIGEST_PREFIX_LENGTH],
+                ))
+
     def _install_package_atoms(self, packages):
         env = self.create_chroot_env().update({
             'DONT_MOUNT_BOOT': '1',  # sys-boot/grub
             'MAKEOPTS': '-j2',
         })
+
+        env_assignments = ['FEATURES=-news']
+        emerge_options = []
+        if self._with_binary_packages_cache:
+            env_assignments.append('PKGDIR=%s' % self._get_binary_packages_dir())
+            emerge_options += [
+                    '--buildpkg',
+                    '--usepkg',
+                    '--binpkg-respect-use=y',
+                    ]
+
         self._executor.check_call([
                 COMMAND_CHROOT,
                 self._abs_mountpoint,
                 'env',
-                'FEATURES=-news',
+                ] + env_assignments + [
                 'emerge',
                 '--ignore-default-opts',
                 '--tree',
                 '--verbose',
                 '--jobs', '2',
-                ] + list(packages),
+                ] + emerge_options + list(packages),
                 env=env)
 
     def ensure_chroot_has_grub2_installed(self):
@@ -244,11 +305,19 @@ class GentooStrategy(DistroStrategy):
         return '/etc/cloud/cloud.cfg.d/90_datasource.cfg'
 
     def get_commands_to_check_for(self):
-        return GentooBootstrapper.get_commands_to_check_for() + [
+        res = GentooBootstrapper.get_commands_to_check_for() + [
                 COMMAND_CHROOT,
                 COMMAND_FIND,
                 COMMAND_WGET,
                 ]
+        if self._with_portage_squashfs:
+            res += [
+                    COMMAND_MKSQUASHFS,
+                    COMMAND_MOUNT,
+                    ]
+        if self._with_binary_packages_cache:
+            res.append(COMMAND_MOUNT)
+        return res
 
     def get_initramfs_path(self):
         return '/boot/initramfs'
@@ -345,8 +414,93 @@ class GentooStrategy(DistroStrategy):
                 ]
         self._executor.check_call(cmd)
 
+    def _get_portage_overlay_dirs(self):
+        abs_overlay_dir = os.path.join(self._abs_mountpoint, _ABS_PORTAGE_OVERLAY_DIR.lstrip('/'))
+        return [os.path.join(abs_overlay_dir, name) for name in ('lower', 'upper', 'work')]
+
+    def _mount_portage_squashfs(self):
+        """
+        Mounts the squashfs image of the portage snapshot at /usr/portage,
+        with an overlay taking writes (e.g. to distfiles) that are
+        thrown away afterwards
+        """
+        abs_portage_dir = os.path.join(self._abs_mountpoint, _ABS_PORTAGE_DIR.lstrip('/'))
+        abs_lower_dir, abs_upper_dir, abs_work_dir = self._get_portage_overlay_dirs()
+        for abs_dir in (abs_lower_dir, abs_upper_dir, abs_work_dir):
+            os.makedirs(abs_dir, 0755)
+
+        self._messenger.info('Mounting portage repository image "%s" at "%s"...'
+                % (self._abs_portage_squashfs_filename, abs_portage_dir))
+        self._executor.check_call([
+                COMMAND_MOUNT,
+                '-t', 'squashfs',
+                '-o', 'loop,ro',
+                self._abs_portage_squashfs_filename,
+                abs_lower_dir,
+                ])
+        self._executor.check_call([
+                COMMAND_MOUNT,
+                '-t', 'overlay',
+                '-o', 'lowerdir=%s,upperdir=%s,workdir=%s'
+                    % (abs_lower_dir, abs_upper_dir, abs_work_dir),
+                'overlay',
+                abs_portage_dir,
+                ])
+
+    def _unmount_portage_squashfs(self):
+        abs_portage_dir = os.path.join(self._abs_mountpoint, _ABS_PORTAGE_DIR.lstrip('/'))
+        abs_lower_dir = self._get_portage_overlay_dirs()[0]
+
+        self._messenger.info('Unmounting portage repository image...')
+        try_unmounting(self._executor, abs_portage_dir)
+        try_unmounting(self._executor, abs_lower_dir)
+
+        abs_overlay_dir = os.path.dirname(abs_lower_dir)
+        self._messenger.info('Removing directory "%s"...' % abs_overlay_dir)
+        shutil.rmtree(abs_overlay_dir)
+
+    def _mount_binary_packages_cache(self):
+        abs_cache_dir = os.path.join(self._abs_cache_dir, _BINARY_PACKAGES_CACHE_DIR)
+        abs_target_dir = os.path.join(self._abs_mountpoint, _ABS_BINARY_PACKAGES_DIR.lstrip('/'))
+        for abs_dir in (abs_cache_dir, abs_target_dir):
+            try:
+                os.makedirs(abs_dir, 0755)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # NOTE: Keeps packages from eviction by concurrent cache clean-up
+        self._binary_packages_cache_lock = ArtifactStore(self._abs_cache_dir) \
+                .locked_pool(_BINARY_PACKAGES_CACHE_DIR)
+        self._binary_packages_cache_lock.acquire(shared=True)
+
+        self._messenger.info('Mounting binary package cache "%s" at "%s"...'
+                % (abs_cache_dir, abs_target_dir))
+        self._executor.check_call([
+                COMMAND_MOUNT,
+                '-o', 'bind',
+                abs_cache_dir,
+                abs_target_dir,
+                ])
+
+    def _unmount_binary_packages_cache(self):
+        abs_target_dir = os.path.join(self._abs_mountpoint, _ABS_BINARY_PACKAGES_DIR.lstrip('/'))
+
+        self._messenger.info('Unmounting binary package cache...')
+        try_unmounting(self._executor, abs_target_dir)
+        os.rmdir(abs_target_dir)
+
+        self._binary_packages_cache_lock.release()
+        self._binary_packages_cache_lock = None
+
     def perform_post_chroot_clean_up(self):
-        self._clean_distfiles()
+        if self._with_binary_packages_cache:
+            self._unmount_binary_packages_cache()
+
+        if self._with_portage_squashfs:
+            self._unmount_portage_squashfs()  # also drops distfiles
+        else:
+            self._clean_distfiles()
 
     def run_directory_bootstrap(self, architecture, bootloader_approach):
         self._messenger.info('Bootstrapping %s into "%s"...'
@@ -357,16 +511,31 @@ class GentooStrategy(DistroStrategy):
                 self._executor,
                 self._abs_mountpoint,
                 self._abs_cache_dir,
+                self._download_config,
                 architecture,
-                self._mirror_url,
+                self._mirror_urls,
                 self._max_age_days,
                 self._stage3_date_triple_or_none,
                 self._repository_date_triple_or_none,
                 self._abs_resolv_conf,
+                self._with_portage_squashfs,
                 )
         bootstrap.run()
+        self._abs_portage_squashfs_filename = bootstrap.get_portage_squashfs_filename()
+        bootstrap.write_lock_file()
+        bootstrap.summarize_downloads()
+        bootstrap.collect_cache_garbage()
+        self._directory_bootstrapper = bootstrap  # i.e. with cached files to release
+        self._architecture = architecture
 
     def prepare_installation_of_packages(self):
+        if self._with_portage_squashfs:
+            self._mount_portage_squashfs()
+        self._directory_bootstrapper.release_cached_files()  # e.g. once mounted
+
+        if self._with_binary_packages_cache:
+            self._mount_binary_packages_cache()
+
         for chroot_abs_path in (
                 _ABS_PACKAGE_KEYWORDS,
                 _ABS_PACKAGE_MASK,
@@ -443,6 +612,89 @@ class GentooStrategy(DistroStrategy):
                 '/usr/src/linux/.config',
                 ], env=self.create_chroot_env())
 
+    def _get_first_line_of_chroot_output(self, argv):
+        return self._executor.check_output([
+                COMMAND_CHROOT, self._abs_mountpoint,
+                ] + argv).strip().split('\n')[0]
+
+    def _get_kernel_build_artifact_filename(self, kernel_release):
+        """
+        Returns the cache location of the build of the configured kernel,
+        named after kernel release, final .config and toolchain
+        """
+        hasher = hashlib.sha256()
+        with open(os.path.join(self._abs_mountpoint, 'usr/src/linux/.config')) as f:
+            hasher.update(f.read())
+        for argv in (['gcc', '--version'], ['ld', '--version']):
+            hasher.update('%s\n' % self._get_first_line_of_chroot_output(argv))
+
+        return os.path.join(self._abs_cache_dir, 'linux-%s-%s.tar.gz' % (
+                kernel_release,
+                hasher.hexdigest()[:_KERNEL_BUILD_DIGEST_PREFIX_LENGTH],
+                ))
+
+    def _build_kernel(self, kernel_release, abs_partial_filename):
+        """
+        Builds and installs the configured kernel,
+        packing up what got installed (to /boot and /lib/modules) for later runs
+        """
+        abs_boot_dir = os.path.join(self._abs_mountpoint, 'boot')
+        boot_basenames_before = set(os.listdir(abs_boot_dir))
+
+        self._executor.check_call([
+                COMMAND_CHROOT, self._abs_mountpoint,
+                'make',
+                '-C', '/usr/src/linux',
+                '-j2',
+                ], env=self.create_chroot_env())
+        self._executor.check_call([
+                COMMAND_CHROOT, self._abs_mountpoint,
+                'make',
+                '-C', '/usr/src/linux',
+                'modules_install', 'install',
+                ], env=self.create_chroot_env())
+
+        installed_rel_paths = [os.path.join('boot', basename) for basename
+                in sorted(set(os.listdir(abs_boot_dir)) - boot_basenames_before)]
+        installed_rel_paths.append(os.path.join('lib/modules', kernel_release))
+
+        self._executor.check_call([
+                COMMAND_TAR,
+                '--create',
+                '--gzip',
+                '--file', abs_partial_filename,
+                '--directory', self._abs_mountpoint,
+                ] + installed_rel_paths)
+
+    def _install_kernel_build(self):
+        """
+        Builds and installs the configured kernel, or installs the build
+        of an earlier run with the same kernel configuration and toolchain
+        """
+        kernel_release = self._get_first_line_of_chroot_output([
+                'make', '--silent', '--no-print-directory',
+                '-C', '/usr/src/linux',
+                'kernelrelease',
+                ])
+        abs_artifact_filename = self._get_kernel_build_artifact_filename(kernel_release)
+
+        built = []
+
+        def build_kernel(abs_partial_filename):
+            self._build_kernel(kernel_release, abs_partial_filename)
+            built.append(True)
+
+        _, lock = ArtifactStore(self._abs_cache_dir).provide(self._messenger,
+                abs_artifact_filename, build_kernel)
+        try:
+            if not built:
+                self._messenger.info('Installing kernel %s from "%s"...'
+                        % (kernel_release, abs_artifact_filename))
+                extract_compressed_tarball(self._messenger, self._executor,
+                        abs_artifact_filename, self._abs_mountpoint)
+        finally:
+            lock.release()
+
     def install_kernel(self):
         self._set_package_keywords('sys-kernel/vanilla-sources', '**')  # TODO ~arch
         self._set_package_use_flags('sys-kernel/vanilla-sources', 'symlink')
@@ -459,18 +711,7 @@ class GentooStrategy(DistroStrategy):
         self._configure_kernel__enable_kvm_support()
         self._configure_kernel__finish()
 
-        self._executor.check_call([
-                COMMAND_CHROOT, self._abs_mountpoint,
-                'make',
-                '-C', '/usr/src/linux',
-                '-j2',
-                ], env=self.create_chroot_env())
-        self._executor.check_call([
-                COMMAND_CHROOT, self._abs_mountpoint,
-                'make',
-                '-C', '/usr/src/linux',
-                'modules_install', 'install',
-                ], env=self.create_chroot_env())
+        self._install_kernel_build()
 
     def uses_systemd(self):
         return False
@@ -491,6 +732,18 @@ class GentooStrategy(DistroStrategy):
         gentoo.set_defaults(**{DISTRO_CLASS_FIELD: clazz})
 
         GentooBootstrapper.add_arguments_to(gentoo)
+        gentoo.add_argument('--portage-squashfs', action='store_true',
+                help='keep the portage repository snapshot as a cached squashfs image '
+                    'mounted during the chroot phase only, rather than extracting it '
+                    '(the image ships with an empty /usr/portage)')
+        gentoo.add_argument('--binpkg-cache', action='store_true',
+                help='keep binary packages built by emerge in the cache directory, '
+                    'for later runs with the same profile and make.conf '
+                    'to install them (where built with matching USE flags) '
+                    'rather than compiling again '
+                    '(default: compile everything each time)')
+
+        return gentoo
 
     @classmethod
     def create(clazz, messenger, executor, options):
@@ -498,9 +751,12 @@ class GentooStrategy(DistroStrategy):
                 messenger,
                 executor,
                 os.path.abspath(options.cache_dir),
-                options.mirror_url,
+                DownloadConfig.create(options),
+                options.mirror_urls or [GentooBootstrapper.DEFAULT_MIRROR_URL],
                 options.max_age_days,
                 options.stage3_date,
                 options.repository_date,
                 os.path.abspath(options.resolv_conf),
+                options.portage_squashfs,
+                options.binpkg_cache,
                 )
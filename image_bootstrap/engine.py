@@ -420,7 +420,7 @@ class BootstrapEngine(object):
                 self._config.bootloader_approach,
                 )
 
-    def _unmount_directory_bootstrap_leftovers(self):
+    def _unmount_leftover_mounts(self):
         mounts = MountFinder()
         mounts.load()
         for abs_mount_point in reversed(list(mounts.below(self._abs_mountpoint))):
@@ -729,6 +729,7 @@ class BootstrapEngine(object):
             self._run_scripts_from(self._abs_scripts_dir_post, env)
 
     def _unmount_disk_chroot_mounts(self):
+        self._unmount_leftover_mounts()  # e.g. of distros, after failure
         self._messenger.info('Unmounting partitions...')
         self._try_unmounting(self._abs_mountpoint)
 
@@ -925,7 +926,7 @@ class BootstrapEngine(object):
                     try:
                         self.run_directory_bootstrap()
                     finally:
-                        self._unmount_directory_bootstrap_leftovers()
+                        self._unmount_leftover_mounts()
                     self._configure_hostname()  # re-write
                     self._create_etc_resolv_conf()  # re-write
                     self._create_etc_fstab()